@@ -37,6 +37,12 @@ type_to_tables_fields={
         'samplemeta':OrderedDict([(SampleData,['value']), (SampleDataType,['data_key', 'data_section'])]),
         'samplemetaids':OrderedDict([(SampleDataType,['sample_data_type_id'])])
 }
+# Numeric versions of text columns, used when filtering on a number
+numeric_fields={
+        SampleData: {'value': 'value_num'}
+}
+# Comparators that work on the text of a column, even with a numeric filter value
+text_comparators=['in', 'not in', 'inlist']
 comparators={
         'gt':'__gt__',
         '>':'__gt__',
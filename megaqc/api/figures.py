@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""Build plot data from query rows with NumPy.
+
+Report plots can cover tens of thousands of samples, so rows are pivoted
+into arrays once and the traces are taken from the array columns, instead
+of looking values up sample by sample.
+
+Figures can also be built as plain dicts with `plain_graph_objs`, which
+mirrors the parts of plotly.graph_objs used by MegaQC without validating
+every property, and encoded with `encode_figure`.
+"""
+from __future__ import division, unicode_literals
+from builtins import object
+
+import datetime
+import decimal
+import json
+import numpy as np
+import plotly.utils
+import warnings
+
+# Percentiles drawn by envelope plots of many line series
+ENVELOPE_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def first_seen_index(keys):
+    """ Number the distinct keys in order of first appearance
+
+    Returns (distinct keys, index of each key in the distinct keys).
+    """
+    keys = np.asarray(keys, dtype=object)
+    if not len(keys):
+        return ([], np.zeros(0, dtype=int))
+    distinct, first, inverse = np.unique(keys.astype('U'), return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='mergesort')
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order))
+    return (keys[first[order]].tolist(), rank[inverse])
+
+
+def pivot_bar_data(sample_names, categories, values):
+    """ Pivot (sample, category, value) rows into a samples x categories matrix
+
+    Samples and categories keep the order they first appear in. Missing
+    bars are 0. Returns (samples, categories, counts, percentages), where
+    percentages are relative to each sample's total.
+    """
+    samples, sample_idx = first_seen_index(sample_names)
+    series, series_idx = first_seen_index(categories)
+    values = np.asarray(values, dtype=float)
+    counts = np.zeros((len(samples), len(series)))
+    counts[sample_idx, series_idx] = values
+    totals = np.bincount(sample_idx, weights=values, minlength=len(samples))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentages = 100 * counts / totals[:, np.newaxis]
+    percentages[~np.isfinite(percentages)] = 0
+    return (samples, series, counts, percentages)
+
+
+def numeric_array(values):
+    """ Float array of the values, NaN where a value is missing or not a number """
+    try:
+        return np.array(values, dtype=float)
+    except (TypeError, ValueError):
+        pass
+    out = np.full(len(values), np.nan)
+    for idx, value in enumerate(values):
+        try:
+            out[idx] = float(value)
+        except (TypeError, ValueError):
+            pass
+    return out
+
+
+def downsample_points(columns, max_points, grid_size=None, max_outliers=0.1, seed=0):
+    """ Pick at most about max_points of the points given by a list of coordinate arrays
+
+    Returns the sorted indices of the points to keep. The most extreme points
+    of each coordinate, up to a max_outliers fraction of max_points in total,
+    are all kept. The others are binned on a grid over the first two
+    coordinates and each cell keeps a share of its points proportional to its
+    count, and at least one, so sparse regions stay visible and dense ones
+    keep their density. The grid has about max_points / 4 cells unless grid_size is given.
+    Points with a missing coordinate cannot be drawn and are dropped.
+    """
+    n_points = len(columns[0])
+    if not max_points or n_points <= max_points:
+        return np.arange(n_points)
+    finite = np.all([np.isfinite(c) for c in columns], axis=0)
+    outlier = np.zeros(n_points, dtype=bool)
+    tail = min(0.005, max_outliers * max_points / (2.0 * len(columns) * max(np.count_nonzero(finite), 1)))
+    for column in columns:
+        low, high = np.percentile(column[finite], [100 * tail, 100 * (1 - tail)])
+        with np.errstate(invalid='ignore'):
+            outlier |= (column < low) | (column > high)
+    outlier &= finite
+    inliers = np.flatnonzero(finite & ~outlier)
+    if not len(inliers):
+        return np.flatnonzero(outlier)
+
+    # Cell of each inlier on a grid_size x grid_size grid
+    if grid_size is None:
+        grid_size = max(int(np.sqrt(max_points / 4)), 1)
+    cells = np.zeros(len(inliers), dtype=np.int64)
+    for column in columns[:2]:
+        values = column[inliers]
+        span = values.max() - values.min()
+        scaled = (values - values.min()) / span * (grid_size - 1) if span > 0 else np.zeros(len(values))
+        cells = cells * grid_size + scaled.astype(np.int64)
+    budget = max(max_points - np.count_nonzero(outlier), 1)
+    counts = np.bincount(cells)
+    share = budget / len(inliers)
+    # Cells that would get less than one point get one, the others share what is left
+    sparse = counts * share < 1
+    dense_total = counts[~sparse].sum()
+    if dense_total:
+        share = max(budget - np.count_nonzero(sparse & (counts > 0)), 0) / dense_total
+    quota = np.maximum(np.round(counts * share), 1)
+
+    # Shuffle, then keep the first `quota` points of each cell
+    shuffled = np.random.RandomState(seed).permutation(len(inliers))
+    by_cell = shuffled[np.argsort(cells[shuffled], kind='mergesort')]
+    cell_starts = np.cumsum(counts) - counts
+    rank = np.arange(len(by_cell)) - cell_starts[cells[by_cell]]
+    keep = by_cell[rank < quota[cells[by_cell]]]
+    return np.sort(np.concatenate([inliers[keep], np.flatnonzero(outlier)]))
+
+
+def quantile(sorted_values, fraction):
+    """ Quantile of sorted values, interpolated the way plotly.js does for box plots """
+    pos = fraction * len(sorted_values) - 0.5
+    if pos < 0:
+        return sorted_values[0]
+    if pos > len(sorted_values) - 1:
+        return sorted_values[-1]
+    low = int(np.floor(pos))
+    high = int(np.ceil(pos))
+    frac = pos - low
+    return frac * sorted_values[high] + (1 - frac) * sorted_values[low]
+
+
+def box_stats(values):
+    """ Box plot statistics of a non-empty array, as plotly.js would compute them
+
+    Returns a dict with the quartiles, the whisker ends (the most extreme
+    values within 1.5 IQR of the box) and the outliers beyond them.
+    """
+    values = np.sort(values)
+    q1, median, q3 = [quantile(values, f) for f in (0.25, 0.5, 0.75)]
+    iqr = q3 - q1
+    within = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+    lowerfence = min(q1, within[0]) if len(within) else q1
+    upperfence = max(q3, within[-1]) if len(within) else q3
+    return dict(
+        q1 = q1,
+        median = median,
+        q3 = q3,
+        lowerfence = lowerfence,
+        upperfence = upperfence,
+        outliers = values[(values < lowerfence) | (values > upperfence)]
+    )
+
+
+def box_values(stats):
+    """ The fewest values that plotly.js draws as the box described by stats """
+    return [
+        stats['lowerfence'], stats['q1'], stats['q1'], stats['median'],
+        stats['median'], stats['q3'], stats['q3'], stats['upperfence']
+    ]
+
+
+def sample_values(values, max_points, seed=0):
+    """ A random subset of at most max_points values, always including the extremes """
+    if not max_points or len(values) <= max_points:
+        return values
+    order = np.argsort(values)
+    keep = np.random.RandomState(seed).choice(order[1:-1], max(max_points - 2, 0), replace=False)
+    return values[np.concatenate([order[:1], np.sort(keep), order[-1:]])]
+
+
+def kde_grid(values, n_points=100):
+    """ Gaussian kernel density estimate of the values on a grid of n_points
+
+    The values are binned on the grid first, so the cost does not depend on
+    the number of values beyond one pass. Returns (grid, density).
+    """
+    std = np.std(values)
+    if len(values) < 2 or std == 0:
+        return (np.array([values[0]]), np.array([1.0]))
+    # Silverman's rule of thumb
+    bandwidth = 1.06 * std * len(values) ** (-1 / 5)
+    edges = np.linspace(values.min() - 3 * bandwidth, values.max() + 3 * bandwidth, n_points + 1)
+    counts, edges = np.histogram(values, bins=edges)
+    grid = (edges[:-1] + edges[1:]) / 2
+    kernel = np.exp(-0.5 * ((grid[:, np.newaxis] - grid[np.newaxis, :]) / bandwidth) ** 2)
+    density = kernel.dot(counts) / (len(values) * bandwidth * np.sqrt(2 * np.pi))
+    return (grid, density)
+
+
+def align_series(series, max_columns=None):
+    """ Line up (x, y) series on their x values in a series x positions matrix
+
+    x is either a float array or a list of labels. Numeric x values are
+    merged and sorted; with more than max_columns of them, the series are
+    interpolated on an even grid instead. Labels keep the order they first
+    appear in. Returns (x values, matrix), NaN where a series has no value.
+    """
+    lengths = [len(y) for x, y in series]
+    rows = np.repeat(np.arange(len(series)), lengths)
+    values = np.concatenate([np.asarray(y, dtype=float) for x, y in series]) if series else np.zeros(0)
+    if series and all(isinstance(x, np.ndarray) for x, y in series):
+        positions = np.concatenate([x for x, y in series]).astype(float)
+        finite = np.isfinite(positions)
+        columns = np.unique(positions[finite])
+        if max_columns and len(columns) > max_columns:
+            columns = np.linspace(columns[0], columns[-1], max_columns)
+            matrix = np.full((len(series), max_columns), np.nan)
+            for idx, (x, y) in enumerate(series):
+                x = np.asarray(x, dtype=float)
+                order = np.argsort(x)
+                matrix[idx] = np.interp(columns, x[order], np.asarray(y, dtype=float)[order], left=np.nan, right=np.nan)
+            return (columns, matrix)
+        rows, positions, values = rows[finite], positions[finite], values[finite]
+        cols = np.searchsorted(columns, positions)
+    else:
+        columns, cols = first_seen_index([label for x, y in series for label in x])
+    matrix = np.full((len(series), len(columns)), np.nan)
+    matrix[rows, cols] = values
+    return (columns, matrix)
+
+
+def envelope_stats(matrix, percentiles=ENVELOPE_PERCENTILES):
+    """ Percentiles of each column of a series x positions matrix, ignoring NaN
+
+    Returns a percentiles x positions array, NaN for columns without values.
+    """
+    with warnings.catch_warnings():
+        # All-NaN columns
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanpercentile(matrix, percentiles, axis=0)
+
+
+def extreme_series(matrix, n):
+    """ Indices of the n series furthest from the median, most unusual first
+
+    The distance is the mean absolute difference from the median at each
+    position, in units of the interquartile range there.
+    """
+    if not n or not len(matrix):
+        return np.zeros(0, dtype=int)
+    q1, median, q3 = envelope_stats(matrix, (25, 50, 75))
+    iqr = q3 - q1
+    positive = iqr[iqr > 0]
+    floor = np.median(positive) * 0.1 if len(positive) else 1.0
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        score = np.nanmean(np.abs(matrix - median) / np.maximum(iqr, floor), axis=1)
+    score[~np.isfinite(score)] = -1
+    return np.argsort(-score, kind='mergesort')[:n]
+
+
+def _plain(trace_type=None):
+    def build(*args, **kwargs):
+        obj = dict(*args, **kwargs)
+        if trace_type is not None:
+            obj['type'] = trace_type
+        return obj
+    return staticmethod(build)
+
+
+class plain_graph_objs(object):
+    """ Drop-in for plotly.graph_objs that builds plain dicts """
+    Bar = _plain('bar')
+    Box = _plain('box')
+    Histogram = _plain('histogram')
+    Scatter = _plain('scatter')
+    Scattergl = _plain('scattergl')
+    Scatter3d = _plain('scatter3d')
+    Layout = _plain()
+    Annotation = _plain()
+    Annotations = list
+
+    @staticmethod
+    def Figure(data=None, layout=None):
+        return dict(data=list(data or []), layout=layout or {})
+
+
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind == 'f' and np.isnan(obj).any():
+            return np.where(np.isnan(obj), None, obj.astype(object)).tolist()
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError("{!r} is not JSON serializable".format(obj))
+
+
+def encode_figure(obj):
+    """ Encode a figure as strict JSON, NumPy arrays included and NaN as null
+
+    A single json.dumps pass, unlike plotly's encoder which encodes, decodes
+    and encodes again to get rid of NaN. That slower path is only taken if
+    a NaN or infinite value shows up outside of a NumPy array.
+    """
+    try:
+        return json.dumps(obj, default=_json_default, allow_nan=False)
+    except ValueError:
+        return json.dumps(obj, cls=plotly.utils.PlotlyJSONEncoder)
@@ -0,0 +1,768 @@
+# -*- coding: utf-8 -*-
+"""Bulk ingestion of MultiQC report data.
+
+Rows are collected in memory and written with batched multi-row INSERT
+statements through SQLAlchemy Core. Everything belonging to one report is
+written inside a single transaction, so a report that fails partway leaves
+nothing behind.
+
+Queued upload files can be parsed incrementally with ReportStream, so that
+the full JSON document never has to be held in memory.
+"""
+from __future__ import division, unicode_literals
+from builtins import object, str
+
+from collections import OrderedDict, defaultdict
+from decimal import Decimal
+from flask import current_app
+from hashlib import md5
+from ijson.common import ObjectBuilder
+from sqlalchemy import bindparam, select
+from sqlalchemy.exc import IntegrityError
+from megaqc.extensions import db
+from megaqc.api.series import pack_arrays, pack_series, series_levels, unpack_series
+from megaqc.model.models import Report, ReportMeta, PlotConfig, PlotData, PlotDataLevel, PlotCategory, SampleDataType, SampleData, Sample
+
+import datetime
+import gzip
+import ijson
+import io
+import json
+import math
+import numpy as np
+import threading
+import time
+
+# SQLite refuses statements with more than this number of bound parameters
+SQLITE_MAX_VARIABLES = 999
+# Number of keys per IN (...) lookup
+IN_CHUNK_SIZE = 500
+# Top-level sections that are handed to the ingester one entry at a time
+STREAMED_SECTIONS = ('report_saved_raw_data', 'report_plot_data')
+
+
+def numeric_value(value):
+    """ The value as a finite float for SampleData.value_num, or None """
+    if isinstance(value, bool):
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(value) or math.isinf(value):
+        return None
+    return value
+
+
+def plot_data_levels(report_id, config_id, sample_id, packed, factors, min_points, **pack_options):
+    """ PlotDataLevel rows with coarser copies of a packed series, see series_levels """
+    x, y = unpack_series(packed)
+    rows = []
+    for level, level_x, level_y in series_levels(x, y, factors, min_points):
+        finite_x = level_x[np.isfinite(level_x)]
+        rows.append(dict(
+            report_id = report_id,
+            config_id = config_id,
+            sample_id = sample_id,
+            level = level,
+            n_points = len(level_y),
+            x_min = float(finite_x.min()) if len(finite_x) else None,
+            x_max = float(finite_x.max()) if len(finite_x) else None,
+            data_packed = pack_arrays(level_x, level_y, **pack_options)
+        ))
+    return rows
+
+
+class BulkWriter(object):
+    """ Buffer rows per table and write them as batched multi-row INSERTs """
+
+    def __init__(self, connection, batch_size=1000):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.buffers = OrderedDict()
+        self.counts = defaultdict(int)
+        self.queued = 0
+        if connection.dialect.name == 'sqlite':
+            self.max_variables = SQLITE_MAX_VARIABLES
+        else:
+            self.max_variables = None
+
+    def add(self, table, row):
+        """ Queue a row (a dict of column values) for insertion into table """
+        rows = self.buffers.setdefault(table, [])
+        rows.append(row)
+        self.queued += 1
+        if len(rows) >= self.batch_rows(row):
+            self.flush(table)
+
+    def batch_rows(self, row):
+        """ Number of rows to send per statement for rows shaped like row """
+        if self.max_variables:
+            return max(1, min(self.batch_size, self.max_variables // len(row)))
+        return self.batch_size
+
+    def flush(self, table=None):
+        """ Write the buffered rows for one table, or for all tables """
+        tables = [table] if table is not None else list(self.buffers)
+        for t in tables:
+            rows = self.buffers.get(t)
+            if rows:
+                self.connection.execute(t.insert().values(rows))
+                self.counts[t.name] += len(rows)
+                self.buffers[t] = []
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+
+class LookupCache(object):
+    """ In-memory map from the natural key of a dimension table to its primary key
+
+    Small tables are loaded once with preload=True. Larger ones (samples) are
+    looked up lazily, with one query per batch of unknown keys. Keys that are
+    still missing are inserted in a batch and read back, so resolving any
+    number of keys costs a handful of queries.
+    """
+
+    def __init__(self, connection, table, key_columns, id_column, preload=True, value_column=None):
+        self.connection = connection
+        self.table = table
+        self.key_columns = [table.c[c] for c in key_columns]
+        self.id_column = table.c[id_column]
+        self.value_column = table.c[value_column] if value_column else None
+        self.preloaded = preload
+        self.ids = {}
+        self.values = {}
+        if preload:
+            self._load(self._select())
+
+    def __getitem__(self, key):
+        return self.ids[key]
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    def _select(self):
+        columns = [self.id_column] + self.key_columns
+        if self.value_column is not None:
+            columns.append(self.value_column)
+        return select(columns).order_by(self.id_column)
+
+    def _load(self, query, wanted=None):
+        for row in self.connection.execute(query):
+            key = row[1] if len(self.key_columns) == 1 else tuple(row[1:len(self.key_columns) + 1])
+            if wanted is not None and key not in wanted:
+                continue
+            # Keep the oldest row when a key is duplicated, as .first() used to
+            if key not in self.ids:
+                self.ids[key] = row[0]
+                if self.value_column is not None:
+                    self.values[row[0]] = row[-1]
+
+    def _fetch(self, keys):
+        """ Load the ids of the given keys from the database """
+        keys = list(keys)
+        for i in range(0, len(keys), IN_CHUNK_SIZE):
+            chunk = keys[i:i + IN_CHUNK_SIZE]
+            if len(self.key_columns) == 1:
+                self._load(self._select().where(self.key_columns[0].in_(chunk)))
+            else:
+                self._load(self._select().where(self.key_columns[0].in_(set(k[0] for k in chunk))), wanted=set(chunk))
+
+    def resolve(self, rows):
+        """ Make sure every key in rows is known, inserting the missing ones
+
+        rows maps each key to the column values used if it has to be inserted.
+        Returns the number of inserted rows.
+        """
+        missing = [key for key in rows if key not in self.ids]
+        if missing and not self.preloaded:
+            self._fetch(missing)
+            missing = [key for key in missing if key not in self.ids]
+        if not missing:
+            return 0
+        new_rows = [rows[key] for key in missing]
+        batch = max(1, SQLITE_MAX_VARIABLES // len(new_rows[0]))
+        for i in range(0, len(new_rows), batch):
+            self.connection.execute(self.table.insert().values(new_rows[i:i + batch]))
+        self._fetch(missing)
+        return len(missing)
+
+
+class IngestProgress(object):
+    """ Rows and time spent in each phase (metadata, raw samples, plot data) of an ingestion
+
+    The ingester moves between phases while the heartbeat thread reads
+    as_dict() to record the progress on the upload.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.writer = None
+        self.phase = None
+        self.phases = OrderedDict()
+        self.mark_rows = 0
+        self.mark_time = self.started
+        self.lock = threading.Lock()
+
+    def _rows(self):
+        return self.writer.queued if self.writer is not None else 0
+
+    def _close_phase(self, now):
+        if self.phase is not None:
+            stats = self.phases[self.phase]
+            stats['rows'] += self._rows() - self.mark_rows
+            stats['elapsed'] += now - self.mark_time
+        self.mark_rows = self._rows()
+        self.mark_time = now
+
+    def enter(self, phase):
+        """ Count the rows queued from now on towards phase """
+        if phase == self.phase:
+            return
+        with self.lock:
+            self._close_phase(time.time())
+            self.phase = phase
+            self.phases.setdefault(phase, {'rows': 0, 'elapsed': 0.0})
+
+    def finish(self):
+        with self.lock:
+            self.finished = time.time()
+            self._close_phase(self.finished)
+            self.phase = None
+
+    def as_dict(self):
+        """ JSON-serialisable snapshot of the progress """
+        with self.lock:
+            now = self.finished or time.time()
+            phases = []
+            for name, stats in self.phases.items():
+                rows, elapsed = stats['rows'], stats['elapsed']
+                if name == self.phase:
+                    rows += self._rows() - self.mark_rows
+                    elapsed += now - self.mark_time
+                phases.append({'name': name, 'rows': rows, 'elapsed': round(elapsed, 2)})
+            return {
+                'phase': self.phase,
+                'finished': self.finished is not None,
+                'elapsed': round(now - self.started, 2),
+                'phases': phases
+            }
+
+
+class ReportIngester(object):
+    """ Write a single MultiQC report to the database in one transaction
+
+    Call begin() once, feed the report sections with add_config(),
+    add_raw_data() and add_plot() and then call finish() to commit.
+    On any error call rollback() and nothing will have been written.
+    Pass an IngestProgress to follow the ingestion from another thread.
+    """
+
+    def __init__(self, user, batch_size=None, progress=None):
+        self.user = user
+        if batch_size is None:
+            batch_size = current_app.config.get('INGEST_BATCH_SIZE', 1000)
+        self.batch_size = batch_size
+        self.progress = progress if progress is not None else IngestProgress()
+        if current_app.config.get('PLOT_DATA_PACKED', True):
+            self.pack_options = dict(
+                compress = current_app.config.get('PLOT_DATA_COMPRESS', True),
+                allow_float32 = current_app.config.get('PLOT_DATA_FLOAT32', True)
+            )
+        else:
+            self.pack_options = None
+        self.levels = current_app.config.get('PLOT_DATA_LEVELS', ())
+        self.level_min_points = current_app.config.get('PLOT_DATA_LEVEL_MIN_POINTS', 250)
+        self.connection = None
+        self.writer = None
+        self.samples = None
+        self.data_types = None
+        self.plot_configs = None
+        self.plot_categories = None
+        self.category_data = {}
+        self.report_id = None
+        self.started = None
+        self.meta_cnt = 0
+        self.samp_cnt = 0
+        self.plotcfg_cnt = 0
+        self.plotdata_cnt = 0
+
+    def begin(self, report_hash, created_at, file_hash=None):
+        """ Open the transaction and create the report row
+
+        file_hash identifies the uploaded file, to skip identical uploads later.
+        Raises an IntegrityError if a report with this hash already exists.
+        """
+        self.started = time.time()
+        self.connection = db.session.connection()
+        self.writer = BulkWriter(self.connection, self.batch_size)
+        self.progress.writer = self.writer
+        self.progress.enter('metadata')
+        # Dimension tables are small and change rarely: load them once
+        self.data_types = LookupCache(self.connection, SampleDataType.__table__, ['data_id'], 'sample_data_type_id')
+        self.plot_configs = LookupCache(self.connection, PlotConfig.__table__, ['config_type', 'config_name', 'config_dataset'], 'config_id')
+        self.plot_categories = LookupCache(self.connection, PlotCategory.__table__, ['category_name'], 'plot_category_id', value_column='data')
+        self.samples = LookupCache(self.connection, Sample.__table__, ['sample_name'], 'sample_id', preload=False)
+        result = self.connection.execute(Report.__table__.insert().values(
+            report_hash = report_hash,
+            file_hash = file_hash,
+            user_id = self.user.user_id,
+            created_at = created_at,
+            uploaded_at = datetime.datetime.utcnow()
+        ))
+        self.report_id = result.inserted_primary_key[0]
+        current_app.logger.info("Created new report {} from {}".format(self.report_id, self.user.email))
+
+        # Save the user as a report meta value
+        # TODO: Replace this with special cases in get_report_metadata_fields()
+        self.writer.add(ReportMeta.__table__, dict(
+            report_meta_key = 'username',
+            report_meta_value = self.user.username,
+            report_id = self.report_id
+        ))
+        return self.report_id
+
+    def add_config(self, key, value):
+        """ Save a top-level `config_` JSON key (strings only)
+
+        eg. config_title / config_short_version / config_creation_date etc
+        """
+        if key.startswith("config") and not isinstance(value, list) and not isinstance(value, dict) and value:
+            self.progress.enter('metadata')
+            self.meta_cnt += 1
+            self.writer.add(ReportMeta.__table__, dict(
+                report_meta_key = key,
+                report_meta_value = value,
+                report_id = self.report_id
+            ))
+
+    def add_raw_data(self, s_key, samples):
+        """ Save one module of the raw parsed data (what ends up in the multiqc_data directory) """
+        section = s_key.replace('multiqc_', '')
+        self.progress.enter('raw samples')
+        self.resolve_samples(samples)
+        self.data_types.resolve(OrderedDict(
+            (d_key, dict(data_key="{}__{}".format(section, d_key), data_section=section, data_id=d_key))
+            for s_name in samples for d_key in samples[s_name]
+        ))
+        # Go through each sample
+        for s_name in samples:
+            self.samp_cnt += 1
+            sample_id = self.samples[s_name]
+            # Go through each data key
+            for d_key in samples[s_name]:
+                self.writer.add(SampleData.__table__, dict(
+                    report_id = self.report_id,
+                    sample_data_type_id = self.data_types[d_key],
+                    sample_id = sample_id,
+                    value = str(samples[s_name][d_key]),
+                    value_num = numeric_value(samples[s_name][d_key])
+                ))
+
+    def add_plot(self, plot, plot_data):
+        """ Save the config and data of one report plot """
+        #  skip custom plots
+        if 'mqc_hcplot_' in plot:
+            return
+        # TODO: Add support for scatter / beeswarm / heatmap
+        plot_type = plot_data['plot_type']
+        if plot_type not in ["bar_graph", "xy_line"]:
+            return
+        plot_config = plot_data['config']
+        self.progress.enter('plot data')
+        # Save the plot config as a JSON string
+        config = json.dumps(plot_config)
+        for dst_idx, dataset in enumerate(plot_data['datasets']):
+            try:
+                if isinstance(plot_config['data_labels'][dst_idx], dict):
+                    dataset_name = plot_config['data_labels'][dst_idx]['ylab']
+                else:
+                    dataset_name = plot_config['data_labels'][dst_idx]
+            except KeyError:
+                try:
+                    dataset_name = plot_config['ylab']
+                except KeyError:
+                    dataset_name = plot_config['title']
+            config_id = self.plot_config_id(plot_type, plot, dataset_name, config)
+
+            # Save bar graph data
+            if plot_type == "bar_graph":
+                self.resolve_samples(plot_data['samples'][dst_idx])
+                for sub_dict in dataset:
+                    category_id = self.plot_category_id(
+                        str(sub_dict['name']),
+                        config_id,
+                        json.dumps({x:y for x,y in list(sub_dict.items()) if x != 'data'})
+                    )
+                    for sa_idx, actual_data in enumerate(sub_dict['data']):
+                        self.plotdata_cnt += 1
+                        value = numeric_value(actual_data)
+                        self.writer.add(PlotData.__table__, dict(
+                            report_id = self.report_id,
+                            config_id = config_id,
+                            sample_id = self.samples[plot_data['samples'][dst_idx][sa_idx]],
+                            plot_category_id = category_id,
+                            value = value,
+                            data = json.dumps(actual_data) if value is None else None,
+                            data_packed = None
+                        ))
+
+            # Save line plot data
+            elif plot_type == "xy_line":
+                try:
+                    data_key = plot_config['data_labels'][dst_idx]['ylab']
+                except (KeyError, TypeError):
+                    try:
+                        data_key = plot_config['ylab']
+                    except KeyError:
+                        data_key = plot_config['title']
+                self.resolve_samples(sub_dict['name'] for sub_dict in dataset)
+                for sub_dict in dataset:
+                    category_id = self.plot_category_id(
+                        data_key,
+                        config_id,
+                        json.dumps({x:y for x,y in list(sub_dict.items()) if x != 'data'})
+                    )
+                    self.plotdata_cnt += 1
+                    packed = pack_series(sub_dict['data'], **self.pack_options) if self.pack_options is not None else None
+                    self.writer.add(PlotData.__table__, dict(
+                        report_id = self.report_id,
+                        config_id = config_id,
+                        sample_id = self.samples[sub_dict['name']],
+                        plot_category_id = category_id,
+                        value = None,
+                        data = json.dumps(sub_dict['data']) if packed is None else None,
+                        data_packed = packed
+                    ))
+                    if packed is not None and self.levels:
+                        self.add_levels(config_id, self.samples[sub_dict['name']], packed)
+
+    def add_levels(self, config_id, sample_id, packed):
+        """ Store coarser copies of a packed series, see series_levels """
+        for row in plot_data_levels(self.report_id, config_id, sample_id, packed,
+                                    self.levels, self.level_min_points, **self.pack_options):
+            self.writer.add(PlotDataLevel.__table__, row)
+
+    def finish(self):
+        """ Flush the remaining rows and commit the report """
+        self.writer.flush()
+        self.update_categories()
+        db.session.commit()
+        self.progress.finish()
+        elapsed = time.time() - self.started
+        current_app.logger.info("Finished writing {} metadata fields, {} samples and plot data ({} cfg, {} data points) for report {}".format(
+            self.meta_cnt, self.samp_cnt, self.plotcfg_cnt, self.plotdata_cnt, self.report_id))
+        current_app.logger.info("Wrote {} rows for report {} in {:.2f}s ({:.0f} rows/s)".format(
+            self.writer.total, self.report_id, elapsed, self.writer.total / max(elapsed, 1e-6)))
+
+    def rollback(self):
+        """ Throw away everything written since begin() """
+        db.session.rollback()
+
+    def resolve_samples(self, sample_names):
+        self.samples.resolve(OrderedDict(
+            (s_name, dict(sample_name=s_name, report_id=self.report_id)) for s_name in sample_names
+        ))
+
+    def plot_config_id(self, plot_type, plot, dataset_name, config):
+        key = (plot_type, plot, dataset_name)
+        self.plotcfg_cnt += self.plot_configs.resolve({key: dict(
+            config_type = plot_type,
+            config_name = plot,
+            config_dataset = dataset_name,
+            data = config
+        )})
+        return self.plot_configs[key]
+
+    def plot_category_id(self, category_name, config_id, data):
+        if category_name not in self.plot_categories:
+            self.plot_categories.resolve({category_name: dict(
+                report_id = self.report_id,
+                config_id = config_id,
+                category_name = category_name,
+                data = data
+            )})
+        category_id = self.plot_categories[category_name]
+        # Existing categories take the most recent display settings
+        self.category_data[category_id] = data
+        return category_id
+
+    def update_categories(self):
+        """ Write the changed plot category settings in one statement """
+        table = PlotCategory.__table__
+        changed = [
+            {'_id': category_id, '_data': data}
+            for category_id, data in self.category_data.items()
+            if self.plot_categories.values.get(category_id) != data
+        ]
+        if changed:
+            self.connection.execute(
+                table.update().where(table.c.plot_category_id == bindparam('_id')).values(data=bindparam('_data')),
+                changed
+            )
+
+
+class CanonicalHasher(object):
+    """ md5 of json.dumps(data), computed from parse events without building data
+
+    Gives the same digest as hashing the serialised report, so streamed and
+    fully loaded reports are recognised as duplicates of each other.
+    """
+
+    def __init__(self):
+        self.md5 = md5()
+        self.stack = []
+        self.after_key = False
+
+    def _write(self, text):
+        self.md5.update(text.encode('utf-8'))
+
+    def _separator(self):
+        if self.stack:
+            if self.stack[-1]:
+                self._write(', ')
+            self.stack[-1] = True
+
+    def event(self, event, value):
+        if event == 'map_key':
+            self._separator()
+            self._write(json.dumps(value) + ': ')
+            self.after_key = True
+        elif event in ('end_map', 'end_array'):
+            self.stack.pop()
+            self._write('}' if event == 'end_map' else ']')
+        else:
+            if self.after_key:
+                self.after_key = False
+            else:
+                self._separator()
+            if event == 'start_map':
+                self._write('{')
+                self.stack.append(False)
+            elif event == 'start_array':
+                self._write('[')
+                self.stack.append(False)
+            else:
+                self._write(json.dumps(value))
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+def _map_items(events):
+    """ Yield (key, first event of the value) until the current map ends """
+    for event, value in events:
+        if event == 'end_map':
+            return
+        yield value, next(events)
+
+
+def _basic_parse_raw_numbers(fh):
+    """ ijson 2.x turns 1000.0 and 1e3 into ints, so rebuild numbers from the raw token """
+    from ijson.backends import python as backend
+    last = [None]
+
+    def lexer():
+        for pos, symbol in backend.Lexer(fh):
+            last[0] = symbol
+            yield pos, symbol
+
+    for event, value in backend.parse_value(lexer()):
+        if event == 'number':
+            # The number is always the last token the lexer handed out
+            value = json.loads(last[0])
+        yield event, value
+
+
+# ijson 3 keeps every non-integer literal as a Decimal
+_basic_parse = ijson.basic_parse if hasattr(ijson, '__version__') else _basic_parse_raw_numbers
+
+
+class ReportStream(object):
+    """ Incrementally parse a MultiQC JSON export
+
+    scan() reads the file once to set report_hash and creation_date without
+    building anything, so duplicates are found before any row is written.
+    Iterating then reads it again and yields (section, key, value) tuples:
+    ('config', key, value) for top-level `config_` keys, and one tuple per
+    module / plot for the report_saved_raw_data and report_plot_data
+    sections. Other sections are skipped without being built. A report
+    wrapped in {"data": {...}}, as posted by MultiQC, is read from the inner
+    object whatever its position, like handle_report_data() does.
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.report_hash = None
+        self.creation_date = None
+        self.wrapped = False
+
+    def _events(self):
+        for event, value in _basic_parse(self.fh):
+            # ijson gives Decimals for non-integers, json.loads gives floats
+            if event == 'number' and isinstance(value, Decimal):
+                value = float(value)
+            yield event, value
+
+    def _root(self, events):
+        event, value = next(events)
+        if event != 'start_map':
+            raise ValueError("MultiQC data should be a JSON object")
+
+    def _value(self, events, first, hasher=None, build=False):
+        """ Consume one complete value, returning it if build is True """
+        builder = ObjectBuilder() if build else None
+        depth = 0
+        event, value = first
+        while True:
+            if hasher is not None:
+                hasher.event(event, value)
+            if build:
+                builder.event(event, value)
+            if event in ('start_map', 'start_array'):
+                depth += 1
+            elif event in ('end_map', 'end_array'):
+                depth -= 1
+            if depth == 0:
+                return builder.value if build else None
+            event, value = next(events)
+
+    def _hash_items(self, events):
+        """ Hash the items of the current map, returning (hash, creation date) """
+        hasher = CanonicalHasher()
+        hasher.event('start_map', None)
+        creation_date = None
+        for key, first in _map_items(events):
+            if key == 'config_creation_date':
+                # Left out of the hash, as in generate_hash()
+                creation_date = self._value(events, first, build=True)
+            else:
+                hasher.event('map_key', key)
+                self._value(events, first, hasher)
+        hasher.event('end_map', None)
+        return (hasher.hexdigest(), creation_date)
+
+    def scan(self):
+        """ Read the whole file to set report_hash and creation_date """
+        events = self._events()
+        self._root(events)
+        hasher = CanonicalHasher()
+        hasher.event('start_map', None)
+        self.wrapped = False
+        self.creation_date = None
+        for key, first in _map_items(events):
+            if self.wrapped:
+                self._value(events, first)
+            elif key == 'data' and first[0] == 'start_map':
+                # Only the inner object is the report
+                self.wrapped = True
+                self.report_hash, self.creation_date = self._hash_items(events)
+            elif key == 'config_creation_date':
+                self.creation_date = self._value(events, first, build=True)
+            else:
+                hasher.event('map_key', key)
+                self._value(events, first, hasher)
+        if not self.wrapped:
+            hasher.event('end_map', None)
+            self.report_hash = hasher.hexdigest()
+
+    def _root_items(self, events):
+        self._root(events)
+        for key, first in _map_items(events):
+            if not self.wrapped:
+                yield key, first
+            elif key == 'data' and first[0] == 'start_map':
+                for item in _map_items(events):
+                    yield item
+            else:
+                self._value(events, first)
+
+    def __iter__(self):
+        if self.report_hash is None:
+            self.scan()
+        self.fh.seek(0)
+        events = self._events()
+        for key, first in self._root_items(events):
+            if key in STREAMED_SECTIONS and first[0] == 'start_map':
+                for sub_key, sub_first in _map_items(events):
+                    yield key, sub_key, self._value(events, sub_first, build=True)
+            elif key.startswith('config') and first[0] not in ('start_map', 'start_array'):
+                yield 'config', key, self._value(events, first, build=True)
+            else:
+                self._value(events, first)
+
+
+def open_report_file(path):
+    """ Open a queued upload for binary reading, whether it is gzipped or not """
+    with open(path, 'rb') as fh:
+        gzipped = fh.read(3) == b'\x1f\x8b\x08'
+    if gzipped:
+        return io.BufferedReader(gzip.open(path, 'rb'))
+    return io.open(path, 'rb')
+
+
+def load_report_file(path):
+    """ Parse and hash a MultiQC JSON export, for ingestion in another process
+
+    Returns a (path, report_hash, creation_date, items, error) tuple, where
+    items are the (section, key, value) tuples of ReportStream, so it can
+    run in a multiprocessing pool and report failures instead of raising.
+    """
+    try:
+        with open_report_file(path) as fh:
+            stream = ReportStream(fh)
+            stream.scan()
+            items = list(stream)
+        return (path, stream.report_hash, stream.creation_date, items, None)
+    except Exception as e:
+        return (path, None, None, None, '{}: {}'.format(type(e).__name__, e))
+
+
+def ingest_report_items(user, report_hash, creation_date, items, progress=None, file_hash=None):
+    """ Save one report given as (section, key, value) tuples
+
+    Returns a (success, message) tuple, like handle_report_data().
+    """
+    if db.session.query(Report.report_id).filter(Report.report_hash == report_hash).first() is not None:
+        return (False, 'Report already uploaded')
+    try:
+        created_at = datetime.datetime.strptime(creation_date, "%Y-%m-%d, %H:%M")
+    except (TypeError, ValueError):
+        created_at = datetime.datetime.now()
+    ingester = ReportIngester(user, progress=progress)
+    try:
+        ingester.begin(report_hash, created_at, file_hash)
+    except IntegrityError:
+        ingester.rollback()
+        return (False, 'Report already processed')
+    try:
+        for section, key, value in items:
+            if section == 'config':
+                ingester.add_config(key, value)
+            elif section == 'report_saved_raw_data':
+                ingester.add_raw_data(key, value)
+            elif section == 'report_plot_data':
+                ingester.add_plot(key, value)
+        ingester.finish()
+    except IntegrityError:
+        ingester.rollback()
+        return (False, 'Report already processed')
+    except Exception:
+        ingester.rollback()
+        raise
+    return (True, 'Data upload successful')
+
+
+def ingest_report_file(user, path, progress=None, file_hash=None):
+    """ Stream a queued upload file into the database
+
+    Returns a (success, message) tuple, like handle_report_data().
+    """
+    with open_report_file(path) as fh:
+        stream = ReportStream(fh)
+        # A first pass only hashes the file, duplicates are turned down before anything is written
+        stream.scan()
+        return ingest_report_items(user, stream.report_hash, stream.creation_date, stream, progress, file_hash)
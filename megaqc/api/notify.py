@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Wake up upload workers as soon as an upload is queued.
+
+Workers in the same process are woken through a threading.Event. On
+Postgres, NOTIFY / LISTEN also reaches workers in other processes and on
+other hosts. Workers still poll every UPLOAD_POLL_INTERVAL seconds as a
+fallback, e.g. for separate worker processes on SQLite, where they poll
+every 30 seconds by default.
+"""
+from __future__ import unicode_literals
+from builtins import object, str
+
+from flask import current_app
+from sqlalchemy import text
+from megaqc.extensions import db
+
+import select
+import threading
+
+UPLOAD_CHANNEL = 'megaqc_uploads'
+
+upload_queued = threading.Event()
+
+
+def notify_upload(upload_id):
+    """ Tell the upload workers that a new upload is waiting """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text("SELECT pg_notify(:channel, :payload)"), {'channel': UPLOAD_CHANNEL, 'payload': str(upload_id)})
+        db.session.commit()
+    upload_queued.set()
+
+
+class UploadWaiter(object):
+    """ Block until an upload is queued or the timeout passes """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.conn = None
+
+    def listen(self):
+        """ Open a dedicated connection listening for upload notifications """
+        self.conn = self.engine.raw_connection()
+        dbapi_conn = self.conn.connection
+        dbapi_conn.autocommit = True
+        cursor = dbapi_conn.cursor()
+        cursor.execute("LISTEN {}".format(UPLOAD_CHANNEL))
+        cursor.close()
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.invalidate()
+            except Exception:
+                pass
+            self.conn = None
+
+    def wait(self, timeout):
+        """ Returns True if woken by a notification, False on timeout """
+        if self.engine.dialect.name != 'postgresql':
+            woken = upload_queued.wait(timeout)
+            upload_queued.clear()
+            return woken
+        try:
+            if self.conn is None:
+                self.listen()
+            dbapi_conn = self.conn.connection
+            if select.select([dbapi_conn], [], [], timeout) == ([], [], []):
+                return False
+            dbapi_conn.poll()
+            del dbapi_conn.notifies[:]
+            return True
+        except Exception as e:
+            # Lost the connection: wait out the timeout and listen again next time
+            current_app.logger.warning("Stopped listening for upload notifications: {}".format(e))
+            self.close()
+            woken = upload_queued.wait(timeout)
+            upload_queued.clear()
+            return woken
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Packed binary storage for xy_line plot series.
+
+A series is stored as a small header followed by the raw little-endian x
+and y buffers, optionally zlib-compressed:
+
+    flags (uint8) | number of points (uint32) | x values | y values
+
+Missing values (null in the MultiQC JSON) are stored as NaN. Series that
+only have y values (plots with `categories`) have no x buffer. Decoding
+wraps the buffers with np.frombuffer, so no copy is made.
+
+Long series are downsampled with `lttb` before they are plotted, and
+`series_levels` gives the coarser copies stored next to them at ingestion,
+so that zoomed out plots do not need to decode every point.
+"""
+from __future__ import division, unicode_literals
+
+from numbers import Number
+
+import numpy as np
+import struct
+import zlib
+
+HEADER = struct.Struct('<BI')
+
+FLAG_ZLIB = 1
+FLAG_FLOAT64 = 2
+FLAG_HAS_X = 4
+
+# Only keep the compressed buffers if they save at least this fraction
+MIN_COMPRESSION_GAIN = 0.1
+
+
+def _is_number(value):
+    return value is None or (isinstance(value, Number) and not isinstance(value, bool))
+
+
+def _as_floats(values):
+    return np.array([np.nan if v is None else v for v in values], dtype='<f8')
+
+
+def pack_series(data, compress=True, allow_float32=True):
+    """ Pack the data of one xy_line series, or return None if it cannot be packed
+
+    data is either a list of [x, y] pairs or a list of y values. Values are
+    stored as float32 when that loses no precision, float64 otherwise.
+    """
+    if not isinstance(data, list):
+        return None
+    if all(isinstance(d, list) and len(d) == 2 and _is_number(d[0]) and _is_number(d[1]) for d in data):
+        x = _as_floats(d[0] for d in data)
+        y = _as_floats(d[1] for d in data)
+    elif all(_is_number(d) for d in data):
+        x = None
+        y = _as_floats(data)
+    else:
+        # eg. text x values
+        return None
+    return pack_arrays(x, y, compress, allow_float32)
+
+
+def pack_arrays(x, y, compress=True, allow_float32=True):
+    """ Pack a series given as float arrays, x is None for y-only series """
+    flags = 0
+    arrays = [a for a in (x, y) if a is not None]
+    if x is not None:
+        flags |= FLAG_HAS_X
+    narrow = [a.astype('<f4') for a in arrays]
+    lossless = allow_float32 and all(
+        np.all((n.astype('<f8') == a) | (np.isnan(a) & np.isnan(n))) for n, a in zip(narrow, arrays)
+    )
+    if lossless:
+        arrays = narrow
+    else:
+        flags |= FLAG_FLOAT64
+    payload = b''.join(a.tobytes() for a in arrays)
+    if compress and payload:
+        compressed = zlib.compress(payload, 6)
+        if len(compressed) <= len(payload) * (1 - MIN_COMPRESSION_GAIN):
+            payload = compressed
+            flags |= FLAG_ZLIB
+    return HEADER.pack(flags, len(y)) + payload
+
+
+def unpack_series(packed):
+    """ Decode a packed series into (x, y) NumPy arrays, x is None for y-only series
+
+    The arrays are read-only views on the packed (or decompressed) buffer.
+    """
+    flags, n_points = HEADER.unpack_from(packed)
+    payload = memoryview(packed)[HEADER.size:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload.tobytes())
+    dtype = np.dtype('<f8' if flags & FLAG_FLOAT64 else '<f4')
+    if flags & FLAG_HAS_X:
+        x = np.frombuffer(payload, dtype=dtype, count=n_points)
+        y = np.frombuffer(payload, dtype=dtype, count=n_points, offset=n_points * dtype.itemsize)
+        return (x, y)
+    return (None, np.frombuffer(payload, dtype=dtype, count=n_points))
+
+
+def series_to_list(x, y):
+    """ Convert an unpacked series back to its JSON form, NaN becoming None """
+    ys = [None if np.isnan(v) else v for v in y.tolist()]
+    if x is None:
+        return ys
+    xs = [None if np.isnan(v) else v for v in x.tolist()]
+    return [list(pair) for pair in zip(xs, ys)]
+
+
+def lttb(y, n_out, x=None):
+    """ Indices of n_out points that keep the visual shape of a series
+
+    Largest-Triangle-Three-Buckets: the first and last points are kept, the
+    others are split into n_out - 2 buckets and each bucket keeps the point
+    making the largest triangle with its neighbouring buckets. To compute all
+    buckets at once, the left corner of the triangle is the average of the
+    previous bucket rather than the point picked in it. x defaults to the
+    positions of the values. Missing (NaN) values are only picked for
+    buckets that have nothing else, so long gaps stay visible.
+    """
+    y = np.asarray(y, dtype=float)
+    n_points = len(y)
+    if n_out >= n_points or n_out < 3:
+        return np.arange(n_points)
+    x = np.arange(n_points, dtype=float) if x is None else np.asarray(x, dtype=float)
+
+    # Bucket boundaries for the points between the first and the last one
+    edges = np.floor(np.linspace(1, n_points - 1, n_out - 1)).astype(np.int64)
+    starts = edges[:-1]
+    bucket = np.repeat(np.arange(n_out - 2), np.diff(edges))
+    finite = np.isfinite(x) & np.isfinite(y)
+    weight = finite.astype(float)
+    counts = np.maximum(np.add.reduceat(weight[1:-1], starts - 1), 1)
+    x_avg = np.add.reduceat(np.where(finite, x, 0)[1:-1], starts - 1) / counts
+    y_avg = np.add.reduceat(np.where(finite, y, 0)[1:-1], starts - 1) / counts
+    # Triangle corners either side of each bucket: the first point, the bucket averages, the last point
+    left_x = np.concatenate([[x[0]], x_avg[:-1]])[bucket]
+    left_y = np.concatenate([[y[0]], y_avg[:-1]])[bucket]
+    right_x = np.concatenate([x_avg[1:], [x[-1]]])[bucket]
+    right_y = np.concatenate([y_avg[1:], [y[-1]]])[bucket]
+    mid_x = x[1:-1]
+    mid_y = y[1:-1]
+    with np.errstate(invalid='ignore'):
+        area = np.abs((left_x - right_x) * (mid_y - left_y) - (left_x - mid_x) * (right_y - left_y))
+    area[~finite[1:-1] | ~np.isfinite(area)] = -1
+    # The first point with the largest area in each bucket
+    best = np.maximum.reduceat(area, starts - 1)
+    is_best = area == best[bucket]
+    first_best = np.flatnonzero(is_best & np.concatenate([[True], (bucket[1:] != bucket[:-1]) | ~is_best[:-1]]))
+    picked = first_best[np.concatenate([[True], bucket[first_best][1:] != bucket[first_best][:-1]])]
+    return np.concatenate([[0], picked + 1, [n_points - 1]])
+
+
+def series_levels(x, y, factors, min_points):
+    """ Coarser copies of a series, with about 1/factor of its points
+
+    Yields (factor, x, y) for each factor that leaves at least min_points
+    points. The copies always have x values, the positions of the values
+    for y-only series.
+    """
+    if x is None:
+        x = np.arange(len(y), dtype=float)
+    for factor in sorted(factors):
+        n_out = len(y) // factor
+        if n_out < max(min_points, 3):
+            break
+        keep = lttb(y, n_out, x=x)
+        yield (factor, x[keep], y[keep])
+
+
+def window_indices(x, x_range):
+    """ Indices of the points with x in x_range, plus one either side so that lines reach the edges """
+    low, high = x_range
+    with np.errstate(invalid='ignore'):
+        inside = np.flatnonzero((x >= low) & (x <= high))
+    if len(inside):
+        return np.arange(max(inside[0] - 1, 0), min(inside[-1] + 2, len(x)))
+    # Zoomed in between two points
+    after = int(np.searchsorted(x, low))
+    return np.arange(max(after - 1, 0), min(after + 1, len(x)))
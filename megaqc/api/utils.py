@@ -1,31 +1,36 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import division
-from builtins import map, range, str
-from past.utils import old_div
+from builtins import map, object, range, str
 
 from datetime import datetime, timedelta
 from flask import current_app
-from hashlib import md5
+from hashlib import md5, sha1
 from megaqc.model.models import *
 from megaqc.user.models import User
 from megaqc.extensions import db
 from megaqc.utils import settings
-from megaqc.api.constants import comparators, type_to_tables_fields, valid_join_conditions
-from sqlalchemy import func, distinct, cast, Numeric, or_
-from sqlalchemy.exc import InvalidRequestError
+from megaqc.api.figures import align_series, box_stats, box_values, downsample_points, encode_figure, envelope_stats, \
+                                extreme_series, kde_grid, numeric_array, pivot_bar_data, plain_graph_objs, sample_values
+from megaqc.api.constants import comparators, numeric_fields, text_comparators, type_to_tables_fields, valid_join_conditions
+from megaqc.api.ingest import ingest_report_items, numeric_value
+from megaqc.api.notify import notify_upload
+from megaqc.api.series import lttb, unpack_series, window_indices
+from plotly.colors import DEFAULT_PLOTLY_COLORS
+from sqlalchemy import func, distinct, cast, literal_column, Numeric, or_
 from sqlalchemy.orm import aliased
 from sqlalchemy.sql import not_, or_, and_
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
 
-import copy
+import gzip
 import json
+import numpy as np
 import os
 import plotly.offline as py
-import plotly.figure_factory as ff
 import plotly.graph_objs as go
 import random
 import string
+import zlib
 
 import sys
 if sys.version_info.major == 2:
@@ -35,354 +40,254 @@ elif sys.version_info.major == 3:
 else:
     raise(Exception("Unsupported python version"))
 
+# Bytes read at a time when saving uploaded reports
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
 def generate_hash(d):
-    data = copy.deepcopy(d)
-    data.pop("config_creation_date")
-    data_string = json.dumps(data).encode('utf-8')
+    """ MD5 of the report serialised with json.dumps(), leaving out the creation date
+
+    Only the top level is copied. The JSON is built in a single json.dumps()
+    call, which uses the C encoder unlike iterencode().
+    """
+    data = d.copy()
+    data.pop("config_creation_date", None)
     md5er = md5()
-    md5er.update(data_string)
+    md5er.update(json.dumps(data).encode('utf-8'))
     ret = md5er.hexdigest()
     return ret
 
-def store_report_data(user, report_data, uploaded_file):
-    file_name = ''.join([random.choice(lc_string) for i in range(10)])
+def store_report_data(user, stream):
+    path, file_hash = spool_upload(stream)
+    if path is None:
+        return (False, 'No data received')
+    queue_upload(user, path, file_hash)
+    return (True, 'Data upload queued successfully')
+
+def spool_upload(stream):
+    """ Save an uploaded report to a new gzip file in the upload folder
+
+    The data is read in chunks: gzipped data is written as it is, anything
+    else is compressed on the way. Returns the path of the file and the SHA1
+    of the uncompressed data, or (None, None) if the stream is empty.
+    """
+    chunk = stream.read(UPLOAD_CHUNK_SIZE)
+    if not chunk:
+        return (None, None)
 
     if not os.path.isdir(current_app.config['UPLOAD_FOLDER']):
         os.mkdir(current_app.config['UPLOAD_FOLDER'])
 
-    if report_data:
-        with open(os.path.join(current_app.config['UPLOAD_FOLDER'], file_name),"wb") as fh:
-            fh.write(report_data)
-    else:
-        uploaded_file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], file_name))
-
+    file_name = ''.join([random.choice(lc_string) for i in range(10)])
+    path = os.path.join(current_app.config['UPLOAD_FOLDER'], '{}.json.gz'.format(file_name))
+    hasher = sha1()
+    with open(path, "wb") as fh:
+        if chunk[:2] == b'\x1f\x8b':
+            inflater = GzipInflater()
+            while chunk:
+                fh.write(chunk)
+                hasher.update(inflater.inflate(chunk))
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        else:
+            with gzip.GzipFile(fileobj=fh, mode='wb', compresslevel=current_app.config.get('UPLOAD_GZIP_LEVEL', 6)) as gz:
+                while chunk:
+                    gz.write(chunk)
+                    hasher.update(chunk)
+                    chunk = stream.read(UPLOAD_CHUNK_SIZE)
+    return (path, hasher.hexdigest())
+
+class GzipInflater(object):
+    """ Incrementally decompress gzip data, which may hold several members """
+
+    def __init__(self):
+        self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def inflate(self, data):
+        out = [self.inflater.decompress(data)]
+        while self.inflater.unused_data:
+            data = self.inflater.unused_data
+            self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out.append(self.inflater.decompress(data))
+        return b''.join(out)
+
+def queue_upload(user, path, file_hash=None):
+    """ Add a saved report file to the upload queue and wake up the workers """
     upload_row = Upload(
         status="NOT TREATED",
-        path=os.path.join(current_app.config['UPLOAD_FOLDER'], file_name),
+        path=path,
+        file_hash=file_hash,
         message="File has been created, loading in MegaQC is queued.",
         user_id=user.user_id
     )
     upload_row.save()
-    return (True, 'Data upload queued successfully')
+    notify_upload(upload_row.upload_id)
+    return upload_row
+
+def get_upload_status(user, upload_id):
+    """ Status and ingestion progress of an upload, or None if the user cannot see it """
+    upload = db.session.query(Upload).filter(Upload.upload_id == upload_id).first()
+    if upload is None or (upload.user_id != user.user_id and not user.is_admin):
+        return None
+    return {
+        'upload_id': upload.upload_id,
+        'status': upload.status,
+        'message': upload.message,
+        'created_at': upload.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'modified_at': upload.modified_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'progress': json.loads(upload.progress) if upload.progress else None
+    }
 
-def handle_report_data(user, report_data):
+def handle_report_data(user, report_data, progress=None, file_hash=None):
     if 'data' in report_data:
         report_data = report_data['data']
-    report_hash = generate_hash(report_data)
-
-    # Check that we don't already have a data file with this md5hash
-    if db.session.query(Report).filter(Report.report_hash==report_hash).first():
-        return (False, 'Report already uploaded')
-
-    # Pull the creation date if we can
-    try:
-        report_created_at = datetime.strptime(report_data['config_creation_date'], "%Y-%m-%d, %H:%M")
-    except:
-        report_created_at = datetime.now()
-
-    # Add to the main report table
-    new_report = Report(
-        report_hash = report_hash,
-        user_id = user.user_id,
-        created_at = report_created_at
-    )
-    try:
-        new_report.save()
-    except InvalidRequestError as e:
-        if 'UNIQUE constraint failed' in str(e):
-            return (False, 'Report already processed')
-        else:
-            raise e
-    current_app.logger.info("Created new report {} from {}".format(new_report.report_id, user.email))
-    report_id = new_report.report_id
-
-    # Save the user as a report meta value
-    # TODO: Replace this with special cases in get_report_metadata_fields()
-    user_report_meta = ReportMeta(
-        report_meta_key = 'username',
-        report_meta_value = user.username,
-        report_id = report_id
-    )
-    user_report_meta.save()
-
-    # Get top-level `config_` JSON keys (strings only).
-    # eg. config_title / config_short_version / config_creation_date etc
-    new_meta_cnt = 0
-    for key in report_data:
-        if key.startswith("config") and not isinstance(report_data[key], list) and not isinstance(report_data[key], dict) and report_data[key]:
-            new_meta_cnt += 1
-            new_meta = ReportMeta(
-                report_meta_key = key,
-                report_meta_value = report_data[key],
-                report_id = report_id
-            )
-            new_meta.save()
-    current_app.logger.info("Finished writing {} metadata fields for report {}".format(new_meta_cnt, new_report.report_id))
-
-    # Save the raw parsed data (stuff that ends up in the multiqc_data directory)
-    new_samp_cnt = 0
-    for s_key in report_data.get('report_saved_raw_data', {}):
-        section = s_key.replace('multiqc_', '')
-        # Go through each sample
-        for s_name in report_data['report_saved_raw_data'][s_key]:
-            new_samp_cnt += 1
-            report_sample = db.session.query(Sample).filter(Sample.sample_name==s_name).first()
-            if not report_sample:
-                report_sample = Sample(sample_name=s_name, report_id=report_id)
-                report_sample.save()
-            sample_id = report_sample.sample_id
-
-            # Go through each data key
-            for d_key in report_data['report_saved_raw_data'][s_key][s_name]:
-                # Save / load the data type
-                key_type = db.session.query(SampleDataType).filter(SampleDataType.data_id==d_key).first()
-                if not key_type:
-                    key_type = SampleDataType(
-                        data_key = "{}__{}".format(section, d_key),
-                        data_section = section,
-                        data_id = d_key
-                    )
-                    key_type.save()
-                type_id = key_type.sample_data_type_id
-
-                # Save the data value
-                value = report_data['report_saved_raw_data'][s_key][s_name][d_key]
-                new_data = SampleData(
-                    report_id = report_id,
-                    sample_data_type_id = type_id,
-                    sample_id = sample_id,
-                    value = str(value)
-                )
-                new_data.save()
-    current_app.logger.info("Finished writing {} samples for report {}".format(new_samp_cnt, new_report.report_id))
-
-    # Save report plot data and configs
-    new_plotcfg_cnt = 0
-    new_plotdata_cnt = 0
-    for plot in report_data.get('report_plot_data'):
-        #  skip custom plots
-        if 'mqc_hcplot_' in plot:
-            continue
-        # TODO: Add support for scatter / beeswarm / heatmap
-        if report_data['report_plot_data'][plot]['plot_type'] not in ["bar_graph", "xy_line"]:
-            continue
-        # Save the plot config as a JSON string
-        config = json.dumps(report_data['report_plot_data'][plot]['config'])
-        for dst_idx, dataset in enumerate(report_data['report_plot_data'][plot]['datasets']):
-            try:
-                if isinstance(report_data['report_plot_data'][plot]['config']['data_labels'][dst_idx], dict):
-                    dataset_name = report_data['report_plot_data'][plot]['config']['data_labels'][dst_idx]['ylab']
-                else:
-                    dataset_name = report_data['report_plot_data'][plot]['config']['data_labels'][dst_idx]
-            except KeyError:
-                try:
-                    dataset_name = report_data['report_plot_data'][plot]['config']['ylab']
-                except KeyError:
-                    dataset_name = report_data['report_plot_data'][plot]['config']['title']
-
-            plot_config = db.session.query(PlotConfig).filter(
-                PlotConfig.config_type==report_data['report_plot_data'][plot]['plot_type'],
-                PlotConfig.config_name==plot,
-                PlotConfig.config_dataset==dataset_name
-            ).first()
-            if not plot_config:
-                plot_config = PlotConfig(
-                    config_type = report_data['report_plot_data'][plot]['plot_type'],
-                    config_name = plot,
-                    config_dataset = dataset_name,
-                    data = config
-                )
-                plot_config.save()
-                new_plotcfg_cnt += 1
-            config_id = plot_config.config_id
-
-        # Save bar graph data
-            if report_data['report_plot_data'][plot]['plot_type'] == "bar_graph":
-
-                for sub_dict in dataset:
-                    data_key = str(sub_dict['name'])
-                    existing_category = db.session.query(PlotCategory).filter(PlotCategory.category_name==data_key).first()
-                    data = json.dumps({x:y for x,y in list(sub_dict.items()) if x != 'data'})
-                    if not existing_category:
-                        existing_category = PlotCategory(
-                            report_id = report_id,
-                            config_id = config_id,
-                            category_name = data_key,
-                            data = data
-                        )
-                        existing_category.save()
-                    else:
-                        existing_category.data = data
-                        existing_category.save()
-                        category_id = existing_category.plot_category_id
-                    for sa_idx, actual_data in enumerate(sub_dict['data']):
-                        existing_sample = db.session.query(Sample).filter(Sample.sample_name==report_data['report_plot_data'][plot]['samples'][dst_idx][sa_idx]).first()
-                        if existing_sample:
-                            sample_id = existing_sample.sample_id
-                        else:
-                            new_sample=Sample(sample_name=sub_dict['name'], report_id=report_id)
-                            new_sample.save()
-                            sample_id=new_sample.sample_id
-                        new_dataset_row = PlotData(
-                            report_id = report_id,
-                            config_id = config_id,
-                            sample_id = sample_id,
-                            plot_category_id = existing_category.plot_category_id,
-                            data = json.dumps(actual_data)
-                        )
-                        new_dataset_row.save()
-                        new_plotdata_cnt += 1
-
-        # Save line plot data
-            elif report_data['report_plot_data'][plot]['plot_type'] == "xy_line":
-                for sub_dict in dataset:
-                    try:
-                        data_key = report_data['report_plot_data'][plot]['config']['data_labels'][dst_idx]['ylab']
-                    except (KeyError, TypeError):
-                        try:
-                            data_key = report_data['report_plot_data'][plot]['config']['ylab']
-                        except KeyError:
-                            data_key = report_data['report_plot_data'][plot]['config']['title']
-
-                    existing_category = db.session.query(PlotCategory).filter(PlotCategory.category_name==data_key).first()
-                    data = json.dumps({x:y for x,y in list(sub_dict.items()) if x != 'data'})
-                    if not existing_category:
-                        existing_category = PlotCategory(
-                            report_id = report_id,
-                            config_id = config_id,
-                            category_name = data_key,
-                            data = data
-                        )
-                        existing_category.save()
-                    else:
-                        existing_category.data = data
-                        existing_category.save()
-                    category_id = existing_category.plot_category_id
-
-                    for sa_idx, actual_data in enumerate(sub_dict['data']):
-                        sample = db.session.query(Sample).filter(Sample.sample_name==sub_dict['name']).first()
-                        if not sample:
-                            sample = Sample(sample_name=sub_dict['name'], report_id=report_id)
-                            sample.save()
-                        sample_id = sample.sample_id
-
-                        new_dataset_row = PlotData(
-                            report_id = report_id,
-                            config_id = config_id,
-                            sample_id = sample_id,
-                            plot_category_id = category_id,
-                            data = json.dumps(sub_dict['data'])
-                        )
-                    new_dataset_row.save()
-                    new_plotdata_cnt += 1
-    current_app.logger.info("Finished writing plot data ({} cfg, {} data points) for report {}".format(new_plotcfg_cnt, new_plotdata_cnt, new_report.report_id))
-
-    # We made it this far - everything must have worked!
-    return (True, 'Data upload successful')
-
-
-
-def generate_report_plot(plot_type, sample_names):
-    # The common part of the query
-    query = db.session.query(
-        PlotConfig, PlotData, PlotCategory, Sample
-    ).join(
-        PlotData, PlotData.config_id == PlotConfig.config_id
-    ).join(
-        PlotCategory
-    ).join(
-        Sample
-    ).filter(
-        Sample.sample_name.in_(sample_names)
-    )
-
+    items = [('config', key, report_data[key]) for key in report_data]
+    for section in ('report_saved_raw_data', 'report_plot_data'):
+        items.extend((section, key, value) for key, value in report_data.get(section, {}).items())
+    return ingest_report_items(user, generate_hash(report_data), report_data.get('config_creation_date'),
+                               items, progress, file_hash)
+
+
+
+# Percentile bands of bucketed trend plots
+TREND_PERCENTILES = OrderedDict([('p10', 0.1), ('p25', 0.25), ('median', 0.5), ('p75', 0.75), ('p90', 0.9)])
+
+# Plotly toolbar settings shared by all plots
+PLOT_CONFIG = dict(
+    modeBarButtonsToRemove = [
+        'sendDataToCloud',
+        'resetScale2d',
+        'hoverClosestCartesian',
+        'hoverCompareCartesian',
+        'toggleSpikelines'
+    ],
+    displaylogo = False
+)
+
+def graph_objs():
+    """ plotly.graph_objs, or plain dict builders if PLOT_FAST_FIGURES is set
+
+    Validating every property of thousands of traces is slow, so by default
+    figures are built as plain dicts. Both give the same figures.
+    """
+    if current_app.config.get('PLOT_FAST_FIGURES', True):
+        return plain_graph_objs
+    return go
+
+def plot_output(figure, fmt='html'):
+    """ Render a figure as a standalone HTML div, or as a figure spec for fmt='json'
+
+    The spec is drawn in the browser with the plotly.js bundle that the page
+    loads once, instead of the bundle being embedded in every plot.
+    """
+    if fmt == 'json':
+        return dict(data=figure['data'], layout=figure.get('layout', {}), config=PLOT_CONFIG)
+    validate = not current_app.config.get('PLOT_FAST_FIGURES', True)
+    return py.plot(figure, output_type='div', show_link=False, validate=validate, config=PLOT_CONFIG)
+
+def plot_fields(plot, html_key='plot'):
+    """ API response fields for a plot: a figure spec, or HTML (also used for errors) """
+    if isinstance(plot, dict):
+        return {'figure': plot}
+    return {html_key: plot}
+
+def figure_json(obj):
+    """ Encode figure specs as JSON, also safe to embed in a <script> tag """
+    return encode_figure(obj).replace('<', '\\u003c')
+
+def generate_report_plot(plot_type, sample_names, fmt='html', summary='auto', x_range=None, width=None):
+    """ Plot a report plot for the given samples
+
+    xy_line plots are drawn one line per sample, or with summary='envelope'
+    as percentile bands over all samples plus the most unusual ones. With
+    summary='auto' the envelope is drawn above PLOT_SERIES_ENVELOPE_SAMPLES samples.
+    xy_line series are cropped to x_range if given, and read from the
+    coarsest stored level that still has about two points per pixel of width.
+    """
+    gobj = graph_objs()
+    config_query = db.session.query(PlotConfig.config_id, PlotConfig.config_type, PlotConfig.data)
     if " -- " in plot_type:
         # Plot type also contains data_key : True for most xy_lines
         plot_type = plot_type.split(" -- ")
-        rows = query.filter(
+        config_query = config_query.filter(
             PlotConfig.config_name == plot_type[0],
             PlotConfig.config_dataset == plot_type[1],
-        ).all()
+        )
     else:
-        rows = query.filter(PlotConfig.config_name == plot_type).all()
+        config_query = config_query.filter(PlotConfig.config_name == plot_type)
+    plot_configs = config_query.order_by(PlotConfig.config_id).all()
 
-    if len(rows) == 0:
+    if len(plot_configs) == 0:
         return '<div class="alert alert-danger">No samples found</div>'
-
-    if rows[0][0].config_type == "bar_graph":
-        #not using sets to keep the order
-        samples = []
-        series = []
-        colors = []
-        total_per_sample = defaultdict(lambda:0)
-        plot_data = defaultdict(lambda:defaultdict(lambda:0))
-        plot_data_perc = defaultdict(lambda:defaultdict(lambda:0))
+    config_ids = [x.config_id for x in plot_configs]
+    # Each config is parsed once, not once per data point
+    configs = {x.config_id: json.loads(x.data) for x in plot_configs}
+
+    if plot_configs[0].config_type == "bar_graph":
+        # Only fetch the columns needed, one narrow row per bar
+        rows = db.session.query(
+            Sample.sample_name, PlotData.plot_category_id, PlotData.config_id, PlotData.value, PlotData.data
+        ).select_from(
+            PlotData
+        ).join(
+            Sample, Sample.sample_id == PlotData.sample_id
+        ).filter(
+            PlotData.config_id.in_(config_ids),
+            Sample.sample_name.in_(sample_names)
+        ).order_by(PlotData.plot_data_id).all()
+        if len(rows) == 0:
+            return '<div class="alert alert-danger">No samples found</div>'
+        # The category names and settings, once per category
+        categories = {
+            x.plot_category_id: x for x in db.session.query(
+                PlotCategory.plot_category_id, PlotCategory.category_name, PlotCategory.data
+            ).filter(PlotCategory.plot_category_id.in_(set(row.plot_category_id for row in rows)))
+        }
         # get the latest config
-        config = json.loads(rows[-1][0].data)
-        for row in rows:
-            if row[3].sample_name not in samples:
-                samples.append(row[3].sample_name)
-            if row[2].category_name not in series:
-                series.append(row[2].category_name)
-                cat_config = json.loads(row[2].data)
-                if 'color' in cat_config:
-                    colors.append(cat_config['color'])
-            plot_data[row[2].category_name][row[3].sample_name] = float(row[1].data)
-            # count total per sample for percentages
-            total_per_sample[row[3].sample_name] = total_per_sample[row[3].sample_name] + float(row[1].data)
-        for key in plot_data:
-            for sample in plot_data[key]:
-                plot_data_perc[key][sample] = 100 * plot_data[key][sample] / total_per_sample[sample]
+        config = configs[rows[-1].config_id]
+        # Rows saved before the value column was added only have the JSON data
+        values = [row.value if row.value is not None else float(row.data) for row in rows]
+        samples, category_ids, plot_data, plot_data_perc = pivot_bar_data(
+            [row.sample_name for row in rows],
+            [row.plot_category_id for row in rows],
+            values
+        )
+        series = [categories[x].category_name for x in category_ids]
+        colors = []
+        for category_id in category_ids:
+            cat_config = json.loads(categories[category_id].data)
+            if 'color' in cat_config:
+                colors.append(cat_config['color'])
 
         # Build the plot bars
         plots = []
         if not colors:
             colors = settings.default_plot_colors
 
-        # Make the plot bars for the main count datasets
-        for idx, d in enumerate(series):
-            my_trace = go.Bar(
-                y = samples,
-                x = [plot_data[d][x] for x in samples],
-                name = d,
-                text = row[3].sample_name,
-                orientation = 'h',
-                visible = config.get('cpswitch_c_active', True),
-                marker = dict(
-                    color = colors[idx%len(colors)],
-                    line = dict(
+        # Make the plot bars for the main count datasets, then for the percentages
+        for matrix, visible in ((plot_data, config.get('cpswitch_c_active', True)), (plot_data_perc, not config.get('cpswitch_c_active', True))):
+            for idx, d in enumerate(series):
+                my_trace = gobj.Bar(
+                    y = samples,
+                    x = matrix[:, idx],
+                    name = d,
+                    text = samples,
+                    orientation = 'h',
+                    visible = visible,
+                    marker = dict(
                         color = colors[idx%len(colors)],
-                        width = 3
-                    )
-                ),
-                hoverinfo = 'text+x'
-            )
-            plots.append(my_trace)
-
-        # Make the plot traces for the bar graph percentages
-        for idx, d in enumerate(series):
-            my_trace = go.Bar(
-                y = samples,
-                x = [plot_data_perc[d][x] for x in samples],
-                name = d,
-                text = row[3].sample_name,
-                orientation = 'h',
-                visible = not config.get('cpswitch_c_active', True),
-                marker = dict(
-                    color = colors[idx%len(colors)],
-                    line = dict(
-                        color = colors[idx%len(colors)],
-                        width = 3)
-                ),
-                hoverinfo = 'text+x'
-            )
-            plots.append(my_trace)
+                        line = dict(
+                            color = colors[idx%len(colors)],
+                            width = 3
+                        )
+                    ),
+                    hoverinfo = 'text+x'
+                )
+                plots.append(my_trace)
 
         updated_layout = config_translate(
             'bar_graph',
             config,
             len(series),
-            go.Layout(
+            gobj.Layout(
                 barmode='stack',
                 hovermode = 'closest',
                 height = 500,
@@ -394,47 +299,100 @@ def generate_report_plot(plot_type, sample_names):
                 )
             )
         )
-        fig = go.Figure(data=plots, layout=updated_layout)
-        plot_div = py.plot(
-            fig,
-            output_type = 'div',
-            show_link = False,
-            config = dict(
-                modeBarButtonsToRemove = [
-                    'sendDataToCloud',
-                    'resetScale2d',
-                    'hoverClosestCartesian',
-                    'hoverCompareCartesian',
-                    'toggleSpikelines'
-                ],
-                displaylogo = False
-            )
-        )
+        fig = gobj.Figure(data=plots, layout=updated_layout)
+        plot_div = plot_output(fig, fmt)
         return plot_div
 
-    elif rows[0][0].config_type == "xy_line":
+    elif plot_configs[0].config_type == "xy_line":
+        # Two points per pixel are enough to draw every peak of a line
+        max_points = 2 * width if width else current_app.config.get('PLOT_SERIES_MAX_POINTS', 1000)
+        level = choose_plot_level(config_ids, sample_names, max_points, x_range) if max_points else None
+        # Only fetch the columns needed, the configs are already known
+        query = db.session.query(
+            Sample.sample_name, PlotData.config_id, PlotData.data
+        ).select_from(
+            PlotData
+        ).join(
+            Sample, Sample.sample_id == PlotData.sample_id
+        )
+        if level is None:
+            query = query.add_columns(PlotData.data_packed)
+        else:
+            # Series too short to have this level are read in full
+            query = query.outerjoin(PlotDataLevel, and_(
+                PlotDataLevel.report_id == PlotData.report_id,
+                PlotDataLevel.config_id == PlotData.config_id,
+                PlotDataLevel.sample_id == PlotData.sample_id,
+                PlotDataLevel.level == level
+            )).add_columns(func.coalesce(PlotDataLevel.data_packed, PlotData.data_packed).label('data_packed'))
+        rows = query.filter(
+            PlotData.config_id.in_(config_ids),
+            Sample.sample_name.in_(sample_names)
+        ).order_by(PlotData.plot_data_id).all()
+        if len(rows) == 0:
+            return '<div class="alert alert-danger">No samples found</div>'
         plots = []
-        config = json.loads(rows[-1][0].data) # grab latest config
-        for idx, row in enumerate(rows):
+        config = configs[rows[-1].config_id] # grab latest config
+        series = []
+        for row in rows:
             xs = []
             ys = []
-            data = json.loads(row[1].data)
-            config = json.loads(row[0].data)
-            if "categories" in config:
-                for d_idx, d in enumerate(data):
-                    xs.append(" "+str(config['categories'][d_idx]))
-                    ys.append(d)
-
+            row_config = configs[row.config_id]
+            if row.data_packed is not None:
+                # Packed series are decoded straight into arrays, levels always have x values
+                xs, ys = unpack_series(row.data_packed)
+                positions = xs if xs is not None else np.arange(len(ys), dtype=float)
+                if "categories" in row_config:
+                    categories = row_config['categories']
+                    # Points past the end of the categories have no label and are left out
+                    known = positions < len(categories)
+                    positions = positions[known]
+                    ys = ys[known]
+                    xs = [" "+str(categories[int(p)]) for p in positions]
             else:
-                for d in data:
-                    xs.append(d[0])
-                    ys.append(d[1])
+                data = json.loads(row.data)
+                if "categories" in row_config:
+                    for d_idx, d in enumerate(data):
+                        xs.append(" "+str(row_config['categories'][d_idx]))
+                        ys.append(d)
+
+                else:
+                    for d in data:
+                        xs.append(d[0])
+                        ys.append(d[1])
+                    x_values = numeric_array(xs)
+                    if np.isfinite(x_values).all():
+                        xs = x_values
+                positions = xs if isinstance(xs, np.ndarray) else np.arange(len(ys), dtype=float)
+            if x_range is not None:
+                keep = window_indices(positions, x_range)
+                xs = take_points(xs, keep)
+                ys = take_points(ys, keep)
+            series.append((xs, ys))
+        if summary == 'auto':
+            summary = 'envelope' if len(rows) > current_app.config.get('PLOT_SERIES_ENVELOPE_SAMPLES', 500) else 'samples'
+        if summary == 'envelope':
+            x_values, matrix = align_series(series, max_points)
+            extremes = extreme_series(matrix, current_app.config.get('PLOT_SERIES_ENVELOPE_EXTREMES', 5))
+            plots = envelope_traces(gobj, x_values, envelope_stats(matrix), DEFAULT_PLOTLY_COLORS[0])
+            series = [series[idx] for idx in extremes]
+            names = [rows[idx].sample_name for idx in extremes]
+            config = dict(config, title = "{}<br><span style=\"font-size:0.9rem\">Median of {} samples, with the 25-75% and 5-95% ranges{}</span>".format(
+                config.get('title') or '', len(rows), ", and the {} most unusual samples".format(len(extremes)) if len(extremes) else ''))
+        else:
+            names = [row.sample_name for row in rows]
+        for idx, (xs, ys) in enumerate(series):
+            if max_points and len(ys) > max_points:
+                # Text x values are drawn in order
+                keep = lttb(numeric_array(ys), max_points, x=xs if isinstance(xs, np.ndarray) else None)
+                xs = take_points(xs, keep)
+                ys = take_points(ys, keep)
             line_color = settings.default_plot_colors[ idx % len(settings.default_plot_colors) ]
-            plots.append(go.Scatter(
+            plots.append(gobj.Scatter(
                 y = ys,
                 x = xs,
-                name = row[3].sample_name,
-                text = row[3].sample_name,
+                name = names[idx],
+                text = names[idx],
                 mode = 'lines',
                 marker = dict(
                     color = line_color,
@@ -449,7 +407,7 @@ def generate_report_plot(plot_type, sample_names):
             'xy_line',
             config,
             len(rows),
-            go.Layout(
+            gobj.Layout(
                 xaxis = {'type': 'category'},
                 showlegend = False,
                 hovermode = 'closest',
@@ -462,26 +420,42 @@ def generate_report_plot(plot_type, sample_names):
                 )
             )
         )
-        fig = go.Figure(data=plots, layout=updated_layout)
-        plot_div = py.plot(
-            fig,
-            output_type = 'div',
-            show_link = False,
-            config = dict(
-                modeBarButtonsToRemove = [
-                    'sendDataToCloud',
-                    'resetScale2d',
-                    'hoverClosestCartesian',
-                    'hoverCompareCartesian',
-                    'toggleSpikelines'
-                ],
-                displaylogo = False
-            )
-        )
+        fig = gobj.Figure(data=plots, layout=updated_layout)
+        plot_div = plot_output(fig, fmt)
         return plot_div
 
-def config_translate(plot_type, config, series_nb, plotly_layout=go.Layout()):
-    plotly_layout.title = config.get('title')
+def choose_plot_level(config_ids, sample_names, n_points, x_range=None):
+    """ The coarsest stored level of xy_line series that shows at least n_points
+
+    Only the part of each series within x_range counts. Returns the level,
+    see PlotDataLevel, or None if the full series are needed.
+    """
+    rows = db.session.query(
+        PlotDataLevel.level, PlotDataLevel.n_points, PlotDataLevel.x_min, PlotDataLevel.x_max
+    ).join(
+        Sample, Sample.sample_id == PlotDataLevel.sample_id
+    ).filter(
+        PlotDataLevel.config_id.in_(config_ids),
+        Sample.sample_name.in_(sample_names)
+    ).all()
+    if not rows:
+        return None
+    levels, counts, x_min, x_max = [np.array(column, dtype=float) for column in zip(*rows)]
+    shown = np.ones(len(levels))
+    if x_range is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shown = (np.minimum(x_max, x_range[1]) - np.maximum(x_min, x_range[0])) / (x_max - x_min)
+        shown = np.clip(np.where(np.isfinite(shown), shown, 1), 0, 1)
+    for level in sorted(set(levels), reverse=True):
+        in_view = (levels == level) & (shown > 0)
+        if not in_view.any() or (counts[in_view] * shown[in_view]).min() >= n_points:
+            return int(level)
+    return None
+
+def config_translate(plot_type, config, series_nb, plotly_layout=None):
+    if plotly_layout is None:
+        plotly_layout = go.Layout()
+    plotly_layout['title'] = config.get('title')
     xaxis={}
     xaxis['title']=config.get('xlab')
     yaxis={}
@@ -493,8 +467,8 @@ def config_translate(plot_type, config, series_nb, plotly_layout=go.Layout()):
     #TODO : Figure out how yfloor and yceiling should be handled
     if plot_type=="bar_graph":
         # For stacked bar graphs, axes are reversed in Plotly
-        plotly_layout.yaxis = xaxis
-        plotly_layout.xaxis = yaxis
+        plotly_layout['yaxis'] = xaxis
+        plotly_layout['xaxis'] = yaxis
 
         updatemenus = list([
             dict(
@@ -522,8 +496,8 @@ def config_translate(plot_type, config, series_nb, plotly_layout=go.Layout()):
         ])
         plotly_layout['updatemenus'] = updatemenus
     elif plot_type=="xy_line":
-        plotly_layout.yaxis= yaxis
-        plotly_layout.xaxis= xaxis
+        plotly_layout['yaxis'] = yaxis
+        plotly_layout['xaxis'] = xaxis
 
         if 'xPlotBands' in config:
             # Treat them as shapes
@@ -543,7 +517,7 @@ def config_translate(plot_type, config, series_nb, plotly_layout=go.Layout()):
                         'opacity': 0.5
                         }
                 shapes.append(shape)
-            plotly_layout.shapes=shapes
+            plotly_layout['shapes'] = shapes
 
         if 'yPlotBands' in config:
             #Treat them as shapes
@@ -563,7 +537,7 @@ def config_translate(plot_type, config, series_nb, plotly_layout=go.Layout()):
                         'opacity': 0.5
                         }
                 shapes.append(shape)
-            plotly_layout.shapes=shapes
+            plotly_layout['shapes'] = shapes
 
     return plotly_layout
 
@@ -728,6 +702,7 @@ def build_filter(query, filters, source_table):
 
             #make named joins
             aliased_fields = []
+            numeric_aliased_fields = []
             current_source=source_table
             current_alias=source_table
             for idx, table in enumerate(type_to_tables_fields[one_filter['type']]):
@@ -742,12 +717,18 @@ def build_filter(query, filters, source_table):
                 current_alias=aliased_table
                 for field in type_to_tables_fields[one_filter['type']][table]:
                     aliased_fields.append(getattr(aliased_table, field))
+                    numeric_field = numeric_fields.get(table, {}).get(field)
+                    numeric_aliased_fields.append(getattr(aliased_table, numeric_field) if numeric_field else None)
 
             for idx, param in enumerate(params):
                 #field is a db_column
                 field = aliased_fields[idx]
                 if isinstance(params[idx], float):
-                    field=cast(field, Numeric)
+                    if numeric_aliased_fields[idx] is not None and cmps[idx] not in text_comparators:
+                        #numeric copy of the column, which can use an index
+                        field=numeric_aliased_fields[idx]
+                    else:
+                        field=cast(field, Numeric)
                 #sql_cmp is a comparison function
                 sql_cmp = getattr(field, comparators[cmps[idx]])
                 alchemy_and_cmps.append(sql_cmp(param))
@@ -823,8 +804,8 @@ def get_plot_favourites(user):
         ))
     return ret_data
 
-def get_favourite_plot_data(user, favourite_id):
-    """ Fetch a plot favourite by ID and return the HTML to generate the plot """
+def get_favourite_plot_data(user, favourite_id, fmt='html'):
+    """ Fetch a plot favourite by ID and return the HTML (or figure spec) to generate the plot """
     # Get the database row for this favourite
     fp_row = db.session \
         .query(
@@ -846,21 +827,25 @@ def get_favourite_plot_data(user, favourite_id):
         plot_type = api_data.get("plot_type")
         filters = api_data.get("filters", [])
         sample_names = get_samples(filters)
-        plot_html = generate_report_plot(plot_type, sample_names)
+        plot_html = generate_report_plot(plot_type, sample_names, fmt)
     # Distribution plot
     elif plot_type == 'distribution':
         my_filters = get_filter_from_data(api_data)
         data_keys = api_data.get("fields", {})
-        nbins = api_data.get("nbins", 20)
+        try:
+            # Favourites saved from the bins slider hold a string
+            nbins = max(int(api_data.get("nbins", 20)), 1)
+        except (TypeError, ValueError):
+            nbins = 20
         ptype = api_data.get("ptype", 20)
         plot_data = get_sample_fields_values(data_keys, my_filters)
-        plot_html = generate_distribution_plot(plot_data, nbins, ptype)
+        plot_html = generate_distribution_plot(plot_data, nbins, ptype, fmt)
     # Trend plot
     elif plot_type == 'trend':
         my_filters = get_filter_from_data(api_data)
         data_keys = api_data.get("fields", {})
-        plot_data = get_timeline_sample_data(my_filters, data_keys)
-        plot_html = generate_trend_plot(plot_data)
+        plot_data = get_trend_plot_data(my_filters, data_keys, api_data.get('bucket', 'auto'), parse_time(api_data.get('start')), parse_time(api_data.get('end')))
+        plot_html = generate_trend_plot(plot_data, fmt)
     # Comparison plot
     elif plot_type == 'comparison':
         my_filters = get_filter_from_data(api_data)
@@ -869,17 +854,18 @@ def get_favourite_plot_data(user, favourite_id):
         pointsize = api_data.get("pointsize", 10)
         joinmarkers = api_data.get("joinmarkers", False)
         plot_data = get_sample_fields_values(data_keys.values(), my_filters, num_fieldids=True)
-        plot_html = generate_comparison_plot(plot_data, data_keys, field_names, pointsize, joinmarkers)
+        plot_html = generate_comparison_plot(plot_data, data_keys, field_names, pointsize, joinmarkers, fmt)
     else:
         plot_html = '<p class="text-error">Plot type <code>{}</code> not recognised.</p>'.format(plot_type)
-    return {
+    results = {
         'user_id': fp_row[1],
         'title': fp_row[2],
         'description': fp_row[3],
         'plot_type': fp_row[4],
-        'created_at': fp_row[6],
-        'plot_html': plot_html
+        'created_at': fp_row[6]
     }
+    results.update(plot_fields(plot_html, 'plot_html'))
+    return results
 
 def save_plot_favourite_data(user, plot_type, data, title, description=None):
     """ Save a new plot favourite to the database """
@@ -961,6 +947,16 @@ def save_dashboard_data(user, title, data, is_public=False, dashboard_id=None):
     new_dashboard.save()
     return new_dashboard.dashboard_id
 
+def sample_data_value(value, value_num):
+    """ A SampleData value as a number if possible, using value_num when it is set """
+    if value_num is not None:
+        return value_num
+    # Rows saved before value_num was added, or text values
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
 def get_sample_fields_values(keys, filters=None, num_fieldids=False):
     if not filters:
         filters = []
@@ -985,7 +981,7 @@ def get_sample_fields_values(keys, filters=None, num_fieldids=False):
         }]]
     sample_list_query = db.session.query(Sample.sample_name).filter(Sample.sample_id.in_(sample_ids))
     sample_meta_ids_query = db.session.query(SampleDataType.data_key, SampleDataType.data_section, SampleDataType.sample_data_type_id).filter(SampleDataType.sample_data_type_id.in_(keys))
-    sample_metadata_query = db.session.query(Sample.sample_name).join(SampleData, Sample.sample_id==SampleData.sample_id).join(SampleDataType, SampleData.sample_data_type_id==SampleDataType.sample_data_type_id).add_columns(SampleDataType.data_key, SampleDataType.data_section, SampleData.value, SampleDataType.sample_data_type_id)
+    sample_metadata_query = db.session.query(Sample.sample_name).join(SampleData, Sample.sample_id==SampleData.sample_id).join(SampleDataType, SampleData.sample_data_type_id==SampleDataType.sample_data_type_id).add_columns(SampleDataType.data_key, SampleDataType.data_section, SampleData.value, SampleDataType.sample_data_type_id, SampleData.value_num)
     sample_metadata_query = build_filter(sample_metadata_query, new_filters, SampleData)
     results={}
     for row in sample_list_query.all():
@@ -1004,37 +1000,67 @@ def get_sample_fields_values(keys, filters=None, num_fieldids=False):
         nicename = "{0}: {1}".format(nice_section.replace('_', ' '), nicename.replace('_', ' ').strip())
         if num_fieldids:
             nicename = row[4]
-        try:
-            results[row[0]][nicename]=float(row[3])
-        except ValueError:
-            results[row[0]][nicename]=row[3]
+        results[row[0]][nicename] = sample_data_value(row[3], row[5])
 
     return results
 
-def generate_distribution_plot(plot_data, nbins=20, ptype='boxplot'):
+def generate_distribution_plot(plot_data, nbins=20, ptype='boxplot', fmt='html'):
+    gobj = graph_objs()
     dtypes = set()
     for s_name in plot_data:
         dtypes.update(plot_data[s_name])
+    if ptype not in ('boxplot', 'dotplot', 'hist', 'violin'):
+        return 'Error - unrecognised plot type: {}'.format(ptype)
+    dtypes = sorted(dtypes)
+    values = []
+    for dtype in dtypes:
+        pdata = numeric_array([plot_data[s_name].get(dtype) for s_name in plot_data])
+        values.append(pdata[~np.isnan(pdata)])
+    # Large distributions are summarised here, so only the aggregates are sent to the browser
+    summarise = any(len(pdata) > current_app.config.get('PLOT_DISTRIBUTION_SUMMARY_THRESHOLD', 10000) for pdata in values)
+    max_points = current_app.config.get('PLOT_DISTRIBUTION_MAX_POINTS', 5000)
     figs = []
-    for dtype in sorted(dtypes):
-        pdata = []
-        for s_name in plot_data:
-            try:
-                pdata.append(float(plot_data[s_name][dtype]))
-            except:
-                pass
-        if ptype == 'boxplot':
+    layout = {}
+    for idx, (dtype, pdata) in enumerate(zip(dtypes, values)):
+        name = "{} ({})".format(dtype, len(pdata))
+        color = DEFAULT_PLOTLY_COLORS[idx % len(DEFAULT_PLOTLY_COLORS)]
+        if ptype == 'violin':
+            figs.extend(violin_traces(gobj, idx, name, pdata, color))
+        elif ptype == 'boxplot' and summarise and len(pdata):
+            # The smallest set of values that plotly.js draws as this box, outliers on their own
+            stats = box_stats(pdata)
             figs.append(
-                go.Box(
+                gobj.Box(
+                    y = box_values(stats),
+                    name = name,
+                    boxpoints = False,
+                    marker = dict(color = color)
+                )
+            )
+            outliers = sample_values(stats['outliers'], max_points)
+            figs.append(
+                gobj.Scatter(
+                    x = [name] * len(outliers),
+                    y = outliers,
+                    mode = 'markers',
+                    name = name,
+                    showlegend = False,
+                    hoverinfo = 'y',
+                    marker = dict(color = color, size = 4)
+                )
+            )
+        elif ptype == 'boxplot':
+            figs.append(
+                gobj.Box(
                     y = pdata,
-                    name = "{} ({})".format(dtype, len(pdata))
+                    name = name
                 )
             )
         elif ptype == 'dotplot':
             figs.append(
-                go.Box(
-                    y = pdata,
-                    name = "{} ({})".format(dtype, len(pdata)),
+                gobj.Box(
+                    y = sample_values(pdata, max_points) if summarise else pdata,
+                    name = name,
                     boxpoints = 'all',
                     jitter = 0.5,
                     pointpos = 0,
@@ -1043,25 +1069,31 @@ def generate_distribution_plot(plot_data, nbins=20, ptype='boxplot'):
                     fillcolor = 'rgba(0, 0, 0, 0)'
                 )
             )
+        elif ptype == 'hist' and summarise and len(pdata):
+            # Binned here, plotly.js only sums up the count of each bin
+            counts, edges = np.histogram(pdata, bins=nbins)
+            figs.append(
+                gobj.Histogram(
+                    x = (edges[:-1] + edges[1:]) / 2,
+                    y = counts,
+                    histfunc = 'sum',
+                    autobinx = False,
+                    xbins = dict(start = edges[0], end = edges[-1], size = edges[1] - edges[0]),
+                    opacity = 0.75,
+                    name = name
+                )
+            )
         elif ptype == 'hist':
             figs.append(
-                go.Histogram(
+                gobj.Histogram(
                     x = pdata,
                     opacity = 0.75,
                     nbinsx = nbins,
-                    name = "{} ({})".format(dtype, len(pdata))
+                    name = name
                 )
             )
-        elif ptype == 'violin':
-            if len(figs) == 0:
-                figs = {}
-            dname = "{} ({})".format(dtype, len(pdata))
-            figs[dname] = pdata
-        else:
-            return 'Error - unrecognised plot type: {}'.format(ptype)
-    layout = {}
     if ptype == 'hist':
-        layout = go.Layout(
+        layout = gobj.Layout(
             barmode = 'overlay',
             showlegend = True,
             xaxis = dict(
@@ -1072,115 +1104,211 @@ def generate_distribution_plot(plot_data, nbins=20, ptype='boxplot'):
                 # TODO - integers only
             )
         )
-    if ptype == 'violin':
-        figure = ff.create_violin(figs)
-    else:
-        figure = go.Figure(data = figs, layout = layout)
-    plot_div = py.plot(
-        figure,
-        output_type = 'div',
-        show_link = False,
-        config = dict(
-            modeBarButtonsToRemove = [
-                'sendDataToCloud',
-                'resetScale2d',
-                'hoverClosestCartesian',
-                'hoverCompareCartesian',
-                'toggleSpikelines'
-            ],
-            displaylogo = False
+    elif ptype == 'violin':
+        layout = gobj.Layout(
+            showlegend = False,
+            hovermode = 'closest',
+            xaxis = dict(
+                tickvals = list(range(len(dtypes))),
+                ticktext = ["{} ({})".format(dtype, len(pdata)) for dtype, pdata in zip(dtypes, values)],
+                zeroline = False,
+                showgrid = False
+            ),
+            yaxis = dict(
+                zeroline = False
+            )
         )
-    )
+    figure = gobj.Figure(data = figs, layout = layout)
+    plot_div = plot_output(figure, fmt)
     return plot_div
 
+def violin_traces(gobj, position, name, pdata, color):
+    """ A violin drawn from a density estimate, with the box and median inside """
+    if not len(pdata):
+        return []
+    grid, density = kde_grid(pdata)
+    width = density / density.max() * 0.4
+    stats = box_stats(pdata)
+    return [
+        gobj.Scatter(
+            x = np.concatenate([position - width, (position + width)[::-1]]),
+            y = np.concatenate([grid, grid[::-1]]),
+            fill = 'toself',
+            mode = 'lines',
+            name = name,
+            hoverinfo = 'name',
+            line = dict(color = color, width = 1)
+        ),
+        gobj.Scatter(
+            x = [position, position],
+            y = [stats['lowerfence'], stats['upperfence']],
+            mode = 'lines',
+            name = name,
+            hoverinfo = 'y',
+            line = dict(color = 'rgb(0, 0, 0)', width = 1.5)
+        ),
+        gobj.Scatter(
+            x = [position, position],
+            y = [stats['q1'], stats['q3']],
+            mode = 'lines',
+            name = name,
+            hoverinfo = 'y',
+            line = dict(color = 'rgb(0, 0, 0)', width = 4)
+        ),
+        gobj.Scatter(
+            x = [position],
+            y = [stats['median']],
+            mode = 'markers',
+            name = name,
+            hoverinfo = 'y',
+            marker = dict(color = 'rgb(255, 255, 255)', size = 6)
+        )
+    ]
+
 
 
-def generate_trend_plot(plot_data):
+def generate_trend_plot(plot_data, fmt='html'):
+    gobj = graph_objs()
     # return '<pre>{}</pre>'.format(plot_data)
     ptype = 'line'
     figs = []
-    for field in sorted(plot_data.keys()):
-        if ptype == 'line':
-            yvals = []
-            yvalcount = 0
-            for x in plot_data[field]:
-                try:
-                    yvals.append(float(x['value']))
-                    yvalcount += 1
-                except ValueError:
-                    yvals.append(None)
+    layout = gobj.Layout(hovermode= 'closest')
+    max_points = current_app.config.get('PLOT_SERIES_MAX_POINTS', 1000)
+    for idx, field in enumerate(sorted(plot_data.keys())):
+        if isinstance(plot_data[field], dict):
+            # Aggregated per time bucket by get_timeline_bucket_data
+            figs.extend(trend_bucket_traces(gobj, field, plot_data[field], DEFAULT_PLOTLY_COLORS[idx % len(DEFAULT_PLOTLY_COLORS)]))
+            layout['title'] = '<span style="font-size:0.9rem">Median per {}, with the 25-75% and 10-90% ranges</span>'.format(plot_data[field]['bucket'])
+        elif ptype == 'line':
+            # Same test as SampleData.value_num, which aggregated trends use
+            yvals = [ numeric_value(x['value']) for x in plot_data[field] ]
+            yvalcount = sum(1 for y in yvals if y is not None)
+            not_numeric = len(yvals) - yvalcount
+            times = [ x['time'] for x in plot_data[field] ]
+            names = [ x['name'] for x in plot_data[field] ]
+            if max_points and len(yvals) > max_points:
+                # Keep the samples that shape the trend, the spikes in particular
+                keep = lttb(numeric_array(yvals), max_points, x=np.array(times, dtype='datetime64[us]').astype(float))
+                times = take_points(times, keep)
+                yvals = take_points(yvals, keep)
+                names = take_points(names, keep)
             figs.append(
-                go.Scatter(
-                    x = [ x['time'] for x in plot_data[field] ],
+                gobj.Scatter(
+                    x = times,
                     y = yvals,
                     mode = 'markers',
-                    text = [ x['name'] for x in plot_data[field] ],
-                    name = "{} ({})".format(field, yvalcount),
+                    text = names,
+                    name = trend_legend(field, yvalcount, not_numeric),
                     hoverinfo = 'text+x+y'
                 )
             )
         else:
             return 'Error - unrecognised plot type: {}'.format(ptype)
-    plot_div = py.plot(
-        go.Figure(
-            data = figs,
-            layout = go.Layout(hovermode= 'closest')
-        ),
-        output_type = 'div',
-        show_link = False,
-        config = dict(
-            modeBarButtonsToRemove = [
-                'sendDataToCloud',
-                'resetScale2d',
-                'hoverClosestCartesian',
-                'hoverCompareCartesian',
-                'toggleSpikelines'
-            ],
-            displaylogo = False
-        )
-    )
+    plot_div = plot_output(gobj.Figure(
+        data = figs,
+        layout = layout
+    ), fmt)
     return plot_div
 
-def generate_comparison_plot(plot_data, data_keys, field_names=None, pointsize=10, joinmarkers=False):
+def trend_legend(field, count, not_numeric=0):
+    """ Legend of a trend series: the number of values plotted, and of values left out """
+    if not_numeric:
+        return "{} ({}, {} not numeric)".format(field, count, not_numeric)
+    return "{} ({})".format(field, count)
+
+def take_points(values, keep):
+    """ The values at the indices in keep, from a list or an array """
+    if isinstance(values, np.ndarray):
+        return values[keep]
+    return [values[i] for i in keep]
+
+def band_traces(gobj, x, bands, color, legendgroup=None):
+    """ Filled bands between (low, high, opacity) pairs of y values """
+    traces = []
+    for low, high, opacity in bands:
+        for values, fill in ((low, 'none'), (high, 'tonexty')):
+            traces.append(gobj.Scatter(
+                x = x,
+                y = values,
+                mode = 'lines',
+                fill = fill,
+                fillcolor = color.replace('rgb(', 'rgba(').replace(')', ', {})'.format(opacity)),
+                line = dict(width = 0, color = color),
+                legendgroup = legendgroup,
+                showlegend = False,
+                hoverinfo = 'none'
+            ))
+    return traces
+
+def envelope_traces(gobj, x, stats, color):
+    """ Median line of many series, over filled 25-75% and 5-95% bands """
+    p5, p25, median, p75, p95 = stats
+    traces = band_traces(gobj, x, ((p5, p95, 0.15), (p25, p75, 0.3)), color)
+    traces.append(gobj.Scatter(
+        x = x,
+        y = median,
+        mode = 'lines',
+        line = dict(color = color, width = 2),
+        name = 'Median',
+        text = ["Median {:.4g}<br>25-75%: {:.4g} - {:.4g}<br>5-95%: {:.4g} - {:.4g}".format(*values)
+                for values in zip(median, p25, p75, p5, p95)],
+        hoverinfo = 'text+x'
+    ))
+    return traces
+
+def trend_bucket_traces(gobj, field, series, color):
+    """ Median line of a bucketed trend, over filled 25-75% and 10-90% bands """
+    traces = band_traces(gobj, series['time'], ((series['p10'], series['p90'], 0.15), (series['p25'], series['p75'], 0.3)), color, field)
+    traces.append(gobj.Scatter(
+        x = series['time'],
+        y = series['median'],
+        mode = 'lines+markers',
+        line = dict(color = color),
+        name = trend_legend(field, sum(series['count']), series.get('not_numeric', 0)),
+        legendgroup = field,
+        text = ["{} samples, mean {:.4g}<br>10-90%: {:.4g} - {:.4g}".format(n, mean, p10, p90)
+                for n, mean, p10, p90 in zip(series['count'], series['mean'], series['p10'], series['p90'])],
+        hoverinfo = 'text+x+y'
+    ))
+    return traces
+
+def generate_comparison_plot(plot_data, data_keys, field_names=None, pointsize=10, joinmarkers=False, fmt='html'):
+    gobj = graph_objs()
     if field_names is None:
         field_names = data_keys
     ptitle = 'MegaQC Comparison Plot'
-    plot_x = []
-    plot_y = []
-    plot_z = []
-    plot_col = []
-    plot_size = []
-    plot_names = plot_data.keys()
-    annotations = go.Annotations([])
-    # Sort the data by the x, y variables (needed when joining dots with lines)
-    plot_names = sorted(plot_names, key=lambda s_name: (plot_data[s_name][data_keys['x']], plot_data[s_name][data_keys['y']]))
-    # Collect the variables
-    for s_name in plot_names:
-        try:
-            plot_x.append(plot_data[s_name][data_keys['x']])
-            plot_y.append(plot_data[s_name][data_keys['y']])
-        except KeyError:
-            current_app.logger.error("Couldn't find key {} (available: {})".format(list(plot_data[s_name].keys()), data_keys))
-        try:
-            plot_z.append(plot_data[s_name][data_keys['z']])
-        except KeyError:
-            plot_z.append(None)
-        try:
-            plot_col.append(plot_data[s_name][data_keys['col']])
-        except KeyError:
-            plot_col.append(None)
-        try:
-            plot_size.append(plot_data[s_name][data_keys['size']])
-        except KeyError:
-            plot_size.append(None)
+    # One NumPy array per variable, in the order of the x then y values (needed when joining dots with lines)
+    plot_names = np.array(list(plot_data.keys()), dtype=object)
+    rows = [plot_data[s_name] for s_name in plot_names]
+    columns = {}
+    for axis in ('x', 'y', 'z', 'col', 'size'):
+        columns[axis] = numeric_array([row.get(data_keys.get(axis)) for row in rows])
+    order = np.lexsort((columns['y'], columns['x']))
+    plot_names = plot_names[order]
+    for axis in columns:
+        columns[axis] = columns[axis][order]
+    has_z = not np.all(np.isnan(columns['z']))
+
+    # Thin out very large comparisons, keeping the outliers and the shape of dense regions
+    n_samples = len(plot_names)
+    keep = downsample_points(
+        [columns[axis] for axis in (('x', 'y', 'z') if has_z else ('x', 'y'))],
+        current_app.config.get('PLOT_COMPARISON_MAX_POINTS', 0)
+    )
+    if len(keep) < n_samples:
+        plot_names = plot_names[keep]
+        for axis in columns:
+            columns[axis] = columns[axis][keep]
+        ptitle += '<br><span style="font-size:0.7rem">Showing {} of {} samples</span>'.format(len(keep), n_samples)
+    annotations = gobj.Annotations([])
 
     # Colour with a colour scale
     markers = {}
-    if not all([x == None for x in plot_col]):
-        markers['color'] = plot_col
+    if not np.all(np.isnan(columns['col'])):
+        markers['color'] = columns['col']
         markers['colorscale'] = 'Viridis'
         markers['showscale'] = True
-        annotations.append(go.Annotation(
+        annotations.append(gobj.Annotation(
             text = field_names['col'],
             x = 1.02,
             y = 0.5,
@@ -1191,44 +1319,43 @@ def generate_comparison_plot(plot_data, data_keys, field_names=None, pointsize=1
         ))
 
     # Scale the marker size according to a variable
-    if not all([x == None for x in plot_size]):
-        smax = max([x for x in plot_size if type(x) is float])
-        smin = min([x for x in plot_size if type(x) is float])
+    plot_size = columns['size']
+    if not np.all(np.isnan(plot_size)):
+        smax = np.nanmax(plot_size)
+        smin = np.nanmin(plot_size)
         srange = smax - smin
         if srange > 0:
-            norm_plot_size = []
-            for x in plot_size:
-                if type(x) is float:
-                    norm_plot_size.append(((old_div((x - smin),srange))*35)+2)
-                else:
-                    norm_plot_size.append(2)
-            markers['size'] = norm_plot_size
+            markers['size'] = np.where(np.isnan(plot_size), 2, (plot_size - smin) / srange * 35 + 2)
             ptitle += '<br><span style="font-size:0.7rem">Marker Size represents "{}"</span>'.format(field_names['size'])
     else:
         markers['size'] = pointsize
 
     plot_height = 600
-    if all([x == None for x in plot_z]):
-        fig = go.Scatter(
-            x = plot_x,
-            y = plot_y,
+    if not has_z:
+        # SVG gets too slow to draw with many points, WebGL does not
+        scatter = gobj.Scatter
+        if len(plot_names) > current_app.config.get('PLOT_WEBGL_THRESHOLD', 5000):
+            scatter = gobj.Scattergl
+        fig = scatter(
+            x = columns['x'],
+            y = columns['y'],
             mode = 'lines+markers' if joinmarkers else 'markers',
             marker = markers,
             text = plot_names
         )
     else:
         markers.update({'opacity':0.8})
-        fig = go.Scatter3d(
-            x = plot_x,
-            y = plot_y,
-            z = plot_z,
+        fig = gobj.Scatter3d(
+            x = columns['x'],
+            y = columns['y'],
+            z = columns['z'],
             mode = 'markers',
             marker = markers,
             text = plot_names
         )
         plot_height = 800
     # Make the plot
-    layout = go.Layout(
+    layout = gobj.Layout(
         title = ptitle,
         # For 2D plots
         xaxis = dict(
@@ -1252,21 +1379,7 @@ def generate_comparison_plot(plot_data, data_keys, field_names=None, pointsize=1
         annotations = annotations,
         height = plot_height
     )
-    plot_div = py.plot(
-        go.Figure(data = [fig], layout = layout),
-        output_type = 'div',
-        show_link = False,
-        config = dict(
-            modeBarButtonsToRemove = [
-                'sendDataToCloud',
-                'resetScale2d',
-                'hoverClosestCartesian',
-                'hoverCompareCartesian',
-                'toggleSpikelines'
-            ],
-            displaylogo = False
-        )
-    )
+    plot_div = plot_output(gobj.Figure(data = [fig], layout = layout), fmt)
     return plot_div
 
 def update_user_filter(user, method, filter_id, filter_object=None):
@@ -1293,7 +1406,29 @@ def get_filter_from_data(data):
     return my_filter
 
 
-def get_timeline_sample_data(filters, fields):
+def data_type_nicename(data_key, data_section):
+    nicename = data_key[len(data_section):] if data_key.startswith(data_section) else data_key
+    nice_section = data_section.title() if data_section.islower() else data_section
+    return "{0}: {1}".format(nice_section.replace('_', ' '), nicename.replace('_', ' '))
+
+def parse_time(value):
+    """ Parse a date or a plotly.js axis time (eg. 2018-06-01 12:00:00.5), or return None """
+    if not value:
+        return None
+    value = str(value).replace('T', ' ')
+    for fmt, length in (("%Y-%m-%d %H:%M:%S", 19), ("%Y-%m-%d %H:%M", 16), ("%Y-%m-%d", 10)):
+        try:
+            return datetime.strptime(value[:length], fmt)
+        except ValueError:
+            pass
+    return None
+
+def timeline_query(filters, fields, columns, start=None, end=None):
+    """ Query the columns for the values of the fields, joined to their sample and report
+
+    Only the samples matching the filters and the reports created between
+    start and end are included.
+    """
     if not filters:
         filters=[]
     sample_ids = get_samples(filters, ids=True)
@@ -1310,32 +1445,132 @@ def get_timeline_sample_data(filters, fields):
             'cmp':'inlist',
             'value':fields
             }]]
+    query = db.session.query(*columns).select_from(Sample).join(SampleData, Sample.sample_id==SampleData.sample_id).join(SampleDataType, SampleData.sample_data_type_id==SampleDataType.sample_data_type_id).join(Report, Report.report_id==Sample.report_id)
+    query = build_filter(query, new_filters, SampleData)
+    if start is not None:
+        query = query.filter(Report.created_at >= start)
+    if end is not None:
+        query = query.filter(Report.created_at <= end)
+    return query
 
+def get_timeline_sample_data(filters, fields, start=None, end=None):
     sample_meta_ids_query = db.session.query(SampleDataType.data_key, SampleDataType.data_section).filter(SampleDataType.sample_data_type_id.in_(fields))
-    sample_metadata_query = db.session.query(Sample.sample_id, Sample.sample_name).join(SampleData, Sample.sample_id==SampleData.sample_id).join(SampleDataType, SampleData.sample_data_type_id==SampleDataType.sample_data_type_id).join(Report, Report.report_id==Sample.report_id).add_columns(SampleDataType.data_key, SampleDataType.data_section, SampleData.value, Report.created_at)
-    sample_metadata_query = build_filter(sample_metadata_query, new_filters, SampleData)
+    sample_metadata_query = timeline_query(filters, fields, [Sample.sample_id, Sample.sample_name, SampleDataType.data_key, SampleDataType.data_section, SampleData.value, Report.created_at, SampleData.value_num], start, end)
     sample_metadata_query = sample_metadata_query.order_by(Report.created_at)
     results={}
     for row in sample_meta_ids_query.all():
-        nicename = row[0][len(row[1]):] if row[0].startswith(row[1]) else row[0]
-        nice_section = row[1].title() if row[1].islower() else row[1]
-        nicename = "{0}: {1}".format(nice_section.replace('_', ' '), nicename.replace('_', ' '))
-        results[nicename]=[]
+        results[data_type_nicename(row[0], row[1])]=[]
     for row in sample_metadata_query.all():
-        nicename = row[2][len(row[3]):] if row[2].startswith(row[3]) else row[2]
-        nice_section = row[3].title() if row[3].islower() else row[3]
-        nicename = "{0}: {1}".format(nice_section.replace('_', ' '), nicename.replace('_', ' '))
-        try:
-            value = float(row[4])
-        except ValueError:
-            value = row[4]
+        nicename = data_type_nicename(row[2], row[3])
+        value = sample_data_value(row[4], row[6])
 
         res_dict = {"id":row[0], "name":row[1], "time":row[5].isoformat(), 'value':value}
         results[nicename].append(res_dict)
 
     return results
 
+def get_trend_plot_data(filters, fields, bucket='auto', start=None, end=None):
+    """ Trend plot data: every sample, or aggregates per day, week or month
+
+    With bucket='auto' the bucket depends on the number of samples and the
+    time window, see choose_trend_bucket.
+    """
+    if bucket == 'auto':
+        bucket = choose_trend_bucket(filters, fields, start, end)
+    if bucket not in ('day', 'week', 'month'):
+        return get_timeline_sample_data(filters, fields, start, end)
+    return get_timeline_bucket_data(filters, fields, bucket, start, end)
+
+def choose_trend_bucket(filters, fields, start=None, end=None):
+    """ The time bucket to aggregate a trend plot by, or None to plot every sample
+
+    Samples are plotted one by one if there are few of them or the time
+    window is short, otherwise the bucket is the shortest of day, week and
+    month that keeps the number of buckets under PLOT_TREND_MAX_BUCKETS.
+    """
+    count, first, last = timeline_query(filters, fields, [func.count(SampleData.sample_data_id), func.min(Report.created_at), func.max(Report.created_at)], start, end).one()
+    if not count or count <= current_app.config.get('PLOT_TREND_RAW_POINTS', 5000):
+        return None
+    span = (last - first).total_seconds() / 86400.0
+    if span <= current_app.config.get('PLOT_TREND_RAW_DAYS', 14):
+        return None
+    for bucket, days in (('day', 1), ('week', 7)):
+        if span / days <= current_app.config.get('PLOT_TREND_MAX_BUCKETS', 200):
+            return bucket
+    return 'month'
+
+def bucket_dates(times, bucket):
+    """ The first day of the day, week (starting on Monday) or month of each time """
+    days = np.array(times, dtype='datetime64[us]').astype('datetime64[D]')
+    if bucket == 'week':
+        # 1970-01-01 was a Thursday
+        day_numbers = days.astype(np.int64)
+        return (day_numbers - (day_numbers + 3) % 7).astype('datetime64[D]')
+    if bucket == 'month':
+        return days.astype('datetime64[M]').astype('datetime64[D]')
+    return days
+
+def get_timeline_bucket_data(filters, fields, bucket, start=None, end=None):
+    """ Count, mean and percentiles of the numeric values of the fields, per day, week or month
+
+    The number of values left out because they are not numeric is given
+    as not_numeric. Postgres computes them in the database with percentile_cont. Elsewhere
+    only the numeric values and report times are fetched, and NumPy does the
+    aggregation.
+    """
+    results = OrderedDict()
+    names = {}
+    for row in db.session.query(SampleDataType.sample_data_type_id, SampleDataType.data_key, SampleDataType.data_section).filter(SampleDataType.sample_data_type_id.in_(fields)):
+        names[row.sample_data_type_id] = data_type_nicename(row.data_key, row.data_section)
+        results[names[row.sample_data_type_id]] = dict((key, []) for key in ['time', 'count', 'mean'] + list(TREND_PERCENTILES))
+    for name in results:
+        results[name]['bucket'] = bucket
+        results[name]['not_numeric'] = 0
+    # Values without a number cannot be aggregated, they are only counted for the legend
+    query = timeline_query(filters, fields, [SampleData.sample_data_type_id, func.count(SampleData.sample_data_id)], start, end)
+    for type_id, count in query.filter(SampleData.value_num == None).group_by(SampleData.sample_data_type_id):
+        results[names[type_id]]['not_numeric'] = count
+
+    if db.engine.dialect.name == 'postgresql':
+        # A literal, so the GROUP BY expression is identical to the selected one
+        bucket_col = func.date_trunc(literal_column("'{}'".format(bucket)), Report.created_at)
+        columns = [SampleData.sample_data_type_id, bucket_col, func.count(SampleData.value_num), func.avg(SampleData.value_num)]
+        columns.extend(func.percentile_cont(fraction).within_group(SampleData.value_num) for fraction in TREND_PERCENTILES.values())
+        query = timeline_query(filters, fields, columns, start, end).filter(SampleData.value_num != None)
+        for row in query.group_by(SampleData.sample_data_type_id, bucket_col).order_by(bucket_col):
+            series = results[names[row[0]]]
+            series['time'].append(row[1].date().isoformat())
+            series['count'].append(row[2])
+            series['mean'].append(float(row[3]))
+            for key, value in zip(TREND_PERCENTILES, row[4:]):
+                series[key].append(float(value))
+        return results
+
+    rows = timeline_query(filters, fields, [SampleData.sample_data_type_id, Report.created_at, SampleData.value_num], start, end).filter(SampleData.value_num != None).all()
+    if not rows:
+        return results
+    type_ids, times, values = zip(*rows)
+    type_ids = np.array(type_ids)
+    buckets = bucket_dates(times, bucket)
+    values = np.array(values, dtype=float)
+    # Sort by field then bucket, and split into groups
+    order = np.lexsort((values, buckets, type_ids))
+    type_ids, buckets, values = type_ids[order], buckets[order], values[order]
+    starts = np.flatnonzero(np.concatenate([[True], (type_ids[1:] != type_ids[:-1]) | (buckets[1:] != buckets[:-1])]))
+    counts = np.diff(np.append(starts, len(values)))
+    means = np.add.reduceat(values, starts) / counts
+    for group, first in enumerate(starts):
+        series = results[names[type_ids[first]]]
+        series['time'].append(str(buckets[first]))
+        series['count'].append(int(counts[group]))
+        series['mean'].append(float(means[group]))
+        group_values = values[first:first + counts[group]]
+        for key, fraction in TREND_PERCENTILES.items():
+            series[key].append(float(np.percentile(group_values, 100 * fraction)))
+    return results
+
 def delete_report_data(report_id):
+    PlotDataLevel.query.filter(PlotDataLevel.report_id==report_id).delete()
     PlotData.query.filter(PlotData.report_id==report_id).delete()
     db.session.commit()
     PlotCategory.query.filter(PlotCategory.plot_category_id.in_(db.session.query(PlotCategory.plot_category_id).outerjoin(PlotData).filter(PlotData.plot_data_id==None))).delete(synchronize_session='fetch')
@@ -1,15 +1,17 @@
 # -*- coding: utf-8 -*-
 """Public section, including homepage and signup."""
-from flask import Blueprint, request, jsonify, abort
+from flask import Blueprint, Response, request, jsonify, abort, url_for
 
 from megaqc.extensions import db
 from megaqc.user.models import User
 from megaqc.model.models import PlotData, Report, SampleFilter, PlotFavourite, Dashboard
-from megaqc.api.utils import handle_report_data, generate_report_plot, generate_distribution_plot, \
+from megaqc.api.utils import generate_report_plot, generate_distribution_plot, \
                             generate_trend_plot, generate_comparison_plot, get_samples, get_report_metadata_fields, \
                             get_sample_metadata_fields, aggregate_new_parameters, get_user_filters, update_fav_report_plot_type, \
-                            get_sample_fields_values, update_user_filter, get_filter_from_data, get_timeline_sample_data, \
+                            get_sample_fields_values, update_user_filter, get_filter_from_data, \
+                            get_trend_plot_data, parse_time, \
                             get_reports_data, delete_report_data, store_report_data, get_queued_uploads, \
+                            spool_upload, queue_upload, get_upload_status, plot_fields, figure_json, \
                             get_favourite_plot_data, save_plot_favourite_data, get_dashboard_data, save_dashboard_data
 from megaqc.user.forms import AdminForm
 
@@ -43,6 +45,31 @@ def check_admin(function):
         return function(*args, **kwargs) #else add "user" to kwargs so it can be used in the request handling
     return user_wrap_function
 
+def plot_format(data):
+    """ Plots are returned as HTML divs, or as figure specs with format=json """
+    fmt = data.get('format') or request.args.get('format', 'html')
+    return 'json' if fmt == 'json' else 'html'
+
+def plot_window(data):
+    """ The x range and pixel width a line plot is drawn for, None if not given """
+    try:
+        x_range = [float(x) for x in data['x_range']]
+        if len(x_range) != 2:
+            x_range = None
+    except (KeyError, TypeError, ValueError):
+        x_range = None
+    try:
+        width = max(int(data['width']), 1)
+    except (KeyError, TypeError, ValueError):
+        width = None
+    return (x_range, width)
+
+def plot_response(results):
+    """ JSON response for a plot endpoint, figure specs may hold NumPy arrays """
+    if 'figure' in results:
+        return Response(figure_json(results), mimetype='application/json')
+    return jsonify(results)
+
 
 @api_blueprint.route('/api/test', methods=['GET'])
 @check_user
@@ -63,12 +90,10 @@ def test_post(user, *args, **kwargs):
 @api_blueprint.route('/api/upload_data', methods=['POST'])
 @check_user
 def queue_multiqc_data(user, *args, **kwargs):
-    data = request.data
-    try:
-        uploaded_file = request.files['file']
-    except:
-        uploaded_file = None
-    success, msg = store_report_data(user, data, uploaded_file)
+    # Stream the body to disk instead of buffering it in memory
+    uploaded_file = request.files.get('file')
+    stream = uploaded_file.stream if uploaded_file else request.stream
+    success, msg = store_report_data(user, stream)
     response = jsonify({
         'success': success,
         'message': msg
@@ -80,16 +105,47 @@ def queue_multiqc_data(user, *args, **kwargs):
 @api_blueprint.route('/api/upload_parse', methods=['POST'])
 @check_user
 def handle_multiqc_data(user, *args, **kwargs):
-    data = request.get_json().get('data')
-    success, msg = handle_report_data(user, data)
+    # The report is parsed by the upload workers, follow it with /api/upload_status
+    path, file_hash = spool_upload(request.stream)
+    if path is None:
+        response = jsonify({
+            'success': False,
+            'message': 'No data received'
+        })
+        response.status_code = 400
+        return response
+    upload = queue_upload(user, path, file_hash)
     response = jsonify({
-        'success': success,
-        'message': msg
+        'success': True,
+        'message': 'Data upload queued successfully',
+        'upload_id': upload.upload_id,
+        'status_url': url_for('api.upload_status', upload_id=upload.upload_id)
     })
-    if not success:
-        response.status_code = 400
+    response.status_code = 202
     return response
 
+@api_blueprint.route('/api/report_exists/<report_hash>', methods=['GET', 'HEAD'])
+@check_user
+def report_exists(user, report_hash, *args, **kwargs):
+    # Lets clients check generate_hash() of a report before sending it
+    exists = db.session.query(Report.report_id).filter(Report.report_hash == report_hash).first() is not None
+    response = jsonify({
+        'success': True,
+        'exists': exists
+    })
+    if not exists:
+        response.status_code = 404
+    return response
+
+@api_blueprint.route('/api/upload_status/<int:upload_id>', methods=['GET'])
+@check_user
+def upload_status(user, upload_id, *args, **kwargs):
+    status = get_upload_status(user, upload_id)
+    if status is None:
+        abort(404)
+    status['success'] = True
+    return jsonify(status)
+
 
 @api_blueprint.route('/api/update_users', methods=['POST'])
 @check_admin
@@ -176,11 +232,9 @@ def get_report_plot(user, *args, **kwargs):
     plot_type = data.get("plot_type")
     filters = data.get("filters", [])
     sample_names = get_samples(filters)
-    html = generate_report_plot(plot_type, sample_names)
-    return jsonify({
-        'success': True,
-        'plot': html
-    })
+    x_range, width = plot_window(data)
+    plot = generate_report_plot(plot_type, sample_names, plot_format(data), data.get('summary', 'auto'), x_range, width)
+    return plot_response(dict(success=True, **plot_fields(plot)))
 
 @api_blueprint.route('/api/count_samples', methods=['POST'])
 @check_user
@@ -289,14 +343,22 @@ def get_distribution_plot(user, *args, **kwargs):
     data = request.get_json()
     my_filters = get_filter_from_data(data)
     data_keys = data.get("fields", {})
-    nbins = data.get("nbins", 20)
+    try:
+        # The bins slider sends its value as a string
+        nbins = int(data.get("nbins", 20))
+    except (TypeError, ValueError):
+        nbins = 0
+    if nbins < 1:
+        response = jsonify({
+            'success': False,
+            'message': 'nbins must be a positive integer'
+        })
+        response.status_code = 400
+        return response
     ptype = data.get("ptype", 20)
     plot_data = get_sample_fields_values(data_keys, my_filters)
-    html = generate_distribution_plot(plot_data, nbins, ptype)
-    return jsonify({
-        'success': True,
-        'plot': html
-    })
+    plot = generate_distribution_plot(plot_data, nbins, ptype, plot_format(data))
+    return plot_response(dict(success=True, **plot_fields(plot)))
 
 @api_blueprint.route('/api/get_trend_plot', methods=['POST'])
 @check_user
@@ -304,12 +366,9 @@ def get_trend_plot(user, *args, **kwargs):
     data = request.get_json()
     my_filters = get_filter_from_data(data)
     data_keys = data.get("fields", {})
-    plot_data = get_timeline_sample_data(my_filters, data_keys)
-    html = generate_trend_plot(plot_data)
-    return jsonify({
-        'success': True,
-        'plot': html
-    })
+    plot_data = get_trend_plot_data(my_filters, data_keys, data.get('bucket', 'auto'), parse_time(data.get('start')), parse_time(data.get('end')))
+    plot = generate_trend_plot(plot_data, plot_format(data))
+    return plot_response(dict(success=True, **plot_fields(plot)))
 
 @api_blueprint.route('/api/get_comparison_plot', methods=['POST'])
 @check_user
@@ -321,11 +380,8 @@ def get_comparison_plot(user, *args, **kwargs):
     pointsize = data.get("pointsize", 10)
     joinmarkers = data.get("joinmarkers", False)
     plot_data = get_sample_fields_values(data_keys.values(), my_filters, num_fieldids=True)
-    html = generate_comparison_plot(plot_data, data_keys, field_names, pointsize, joinmarkers)
-    return jsonify({
-        'success': True,
-        'plot': html
-    })
+    plot = generate_comparison_plot(plot_data, data_keys, field_names, pointsize, joinmarkers, plot_format(data))
+    return plot_response(dict(success=True, **plot_fields(plot)))
 
 @api_blueprint.route('/api/update_filters', methods=['POST'])
 @check_user
@@ -345,7 +401,8 @@ def timeline_sample_data(user, *args, **kwargs):
     data = request.get_json()
     my_filters = get_filter_from_data(data)
     data_keys = data.get("fields", {})
-    ret_data = get_timeline_sample_data(my_filters, data_keys)
+    # Every sample, never aggregated per time bucket
+    ret_data = get_trend_plot_data(my_filters, data_keys, bucket=None)
     return jsonify(ret_data)
 
 @api_blueprint.route('/api/get_reports', methods=['GET', 'POST'])
@@ -382,9 +439,9 @@ def delete_report(user, *args, **kwargs):
 def get_favourite_plot(user, *args, **kwargs):
     data = request.get_json()
     favourite_id = data.get("favourite_id")
-    plot_results = get_favourite_plot_data(user, favourite_id)
+    plot_results = get_favourite_plot_data(user, favourite_id, plot_format(data))
     plot_results['success'] = True
-    return jsonify(plot_results)
+    return plot_response(plot_results)
 
 @api_blueprint.route('/api/save_plot_favourite', methods=['POST'])
 @check_user
@@ -8,6 +8,7 @@ from future import standard_library
 standard_library.install_aliases()
 
 import jinja2
+import plotly
 import logging
 import markdown
 
@@ -27,6 +28,9 @@ def create_app(config_object):
     log_level = getattr(config_object, 'LOG_LEVEL', logging.INFO)
     app.logger.setLevel(log_level)
     app.config.from_object(config_object)
+    # Worker processes rebuild the app from the name of its config class
+    config_class = config_object if isinstance(config_object, type) else type(config_object)
+    app.config['CONFIG_NAME'] = '{}.{}'.format(config_class.__module__, config_class.__name__)
     if app.config['SERVER_NAME'] is not None:
         print(" * Server name: {}".format(app.config['SERVER_NAME']))
     register_extensions(app)
@@ -34,7 +38,8 @@ def create_app(config_object):
     register_errorhandlers(app)
     register_shellcontext(app)
     register_commands(app)
-    init_scheduler(app)
+    if app.config.get('SCHEDULER_ENABLED', True):
+        init_scheduler(app)
     return app
 
 
@@ -49,7 +54,7 @@ def register_extensions(app):
     @app.context_processor
     def inject_debug():
         """ Make the debug variable available to templates """
-        return dict(debug=app.debug, version=version)
+        return dict(debug=app.debug, version=version, plotly_version=plotly.__version__)
 
     @app.template_filter()
     def safe_markdown(text):
@@ -115,3 +120,6 @@ def register_commands(app):
     app.cli.add_command(commands.urls)
     app.cli.add_command(commands.initdb)
     app.cli.add_command(commands.upload)
+    app.cli.add_command(commands.worker)
+    app.cli.add_command(commands.ingest)
+    app.cli.add_command(commands.db_indexes)
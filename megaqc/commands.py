@@ -152,6 +152,177 @@ def initdb():
     print('Initialized the database.')
 
 
+@click.command()
+@click.option('-p', '--processes', default=None, type=int,
+              help='Number of worker processes to run (default: UPLOAD_WORKER_PROCESSES)')
+@click.option('--poll-interval', default=None, type=int,
+              help='Seconds between fallback checks for new uploads (default: UPLOAD_POLL_INTERVAL)')
+@with_appcontext
+def worker(processes, poll_interval):
+    """ Process queued uploads
+
+    Several workers, on one or more hosts, can safely process the same
+    upload queue: each upload is claimed by exactly one of them. Set
+    SCHEDULER_ENABLED to False so that the web server leaves uploads to them.
+    """
+    from megaqc.scheduler import run_workers
+    if processes is None:
+        processes = current_app.config.get('UPLOAD_WORKER_PROCESSES', 1)
+    run_workers(current_app._get_current_object(), processes, poll_interval)
+
+
+@click.command()
+@click.argument('paths', type=click.Path(exists=True), nargs=-1, required=True)
+@click.option('-p', '--processes', default=None, type=int,
+              help='Number of processes parsing reports (default: number of CPUs)')
+@click.option('-u', '--user', 'username', default=None,
+              help='Username or email of the owner of the reports (default: the first admin)')
+@click.option('--pattern', default='multiqc_data.json*', show_default=True,
+              help='File name pattern of the reports to load from directories')
+@click.option('--state-file', default='megaqc_ingest.state', show_default=True, type=click.Path(),
+              help='File listing the reports already loaded, so an interrupted run can resume')
+@click.option('--batch-size', default=None, type=int,
+              help='Rows per INSERT statement (default: INGEST_BATCH_SIZE)')
+@with_appcontext
+def ingest(paths, processes, username, pattern, state_file, batch_size):
+    """ Load MultiQC JSON files straight into the database
+
+    Meant for back-filling large numbers of reports from the MegaQC server
+    itself. Directories are searched recursively for files matching
+    --pattern. Reports are parsed and hashed in parallel, and each one is
+    saved by the main process in its own transaction. Run the same command
+    again to resume after an interruption.
+    """
+    import multiprocessing
+    import time
+    from collections import deque
+    from fnmatch import fnmatch
+    from megaqc.api.ingest import IngestProgress, ingest_report_items, load_report_file
+    from megaqc.user.models import User
+
+    if username is None:
+        user = User.query.filter_by(is_admin=True).order_by(User.user_id).first()
+    else:
+        user = User.query.filter((User.username == username) | (User.email == username)).first()
+    if user is None:
+        raise click.ClickException('No user found to own the reports, use --user')
+    if batch_size is not None:
+        current_app.config['INGEST_BATCH_SIZE'] = batch_size
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                files.extend(os.path.join(dirpath, fn) for fn in sorted(filenames) if fnmatch(fn, pattern))
+        else:
+            files.append(path)
+    done = set()
+    if os.path.exists(state_file):
+        with open(state_file) as fh:
+            done = set(line.rstrip('\n') for line in fh)
+    files = [os.path.abspath(fn) for fn in files]
+    todo = [fn for fn in files if fn not in done]
+    click.echo('Found {} reports, {} already loaded'.format(len(files), len(files) - len(todo)))
+
+    def parsed_reports():
+        """ Parse reports in a process pool, with a bounded number waiting to be saved """
+        if processes == 1:
+            for fn in todo:
+                yield load_report_file(fn)
+            return
+        n_procs = processes or multiprocessing.cpu_count()
+        # The parsing processes never use the database connections they inherit
+        pool = multiprocessing.Pool(n_procs)
+        try:
+            pending = deque()
+            for fn in todo:
+                pending.append(pool.apply_async(load_report_file, (fn,)))
+                if len(pending) >= 2 * n_procs:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+    counts = {'loaded': 0, 'duplicate': 0, 'failed': 0, 'rows': 0}
+    started = time.time()
+    with open(state_file, 'a') as state:
+        for fn, report_hash, creation_date, items, error in parsed_reports():
+            if error is not None:
+                success, msg = False, error
+            else:
+                progress = IngestProgress()
+                try:
+                    success, msg = ingest_report_items(user, report_hash, creation_date, items, progress)
+                except Exception as e:
+                    success, msg = False, '{}: {}'.format(type(e).__name__, e)
+            if success:
+                counts['loaded'] += 1
+                counts['rows'] += sum(phase['rows'] for phase in progress.as_dict()['phases'])
+            elif msg in ('Report already uploaded', 'Report already processed'):
+                counts['duplicate'] += 1
+            else:
+                # Failed reports are not recorded, so they are retried on the next run
+                counts['failed'] += 1
+                click.echo('Could not load {}: {}'.format(fn, msg), err=True)
+                continue
+            state.write('{}\n'.format(fn))
+            state.flush()
+
+    elapsed = max(time.time() - started, 1e-6)
+    click.echo('Loaded {} reports ({} already in the database, {} failed) in {:.1f}s'.format(
+        counts['loaded'], counts['duplicate'], counts['failed'], elapsed))
+    click.echo('{:.1f} reports/s, {:.0f} rows/s'.format(counts['loaded'] / elapsed, counts['rows'] / elapsed))
+
+
+@click.command('db-indexes')
+@click.option('--check', default=False, is_flag=True,
+              help='Only report missing and unused indexes, without creating any')
+@with_appcontext
+def db_indexes(check):
+    """ Create the indexes that are missing from the database
+
+    With --check, only list the indexes defined by the models that are
+    missing, and exit with status 1 if there are any. On PostgreSQL,
+    indexes that were never used since the statistics were last reset
+    are listed too.
+    """
+    from sqlalchemy import inspect, text
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        missing.extend(index for index in sorted(table.indexes, key=lambda x: x.name) if index.name not in existing)
+
+    for index in missing:
+        columns = ', '.join(column.name for column in index.columns)
+        if check:
+            click.echo('Missing index {} on {} ({})'.format(index.name, index.table.name, columns))
+        else:
+            click.echo('Creating index {} on {} ({})'.format(index.name, index.table.name, columns))
+            index.create(bind=db.engine)
+    if not missing:
+        click.echo('No missing indexes')
+
+    if db.engine.dialect.name == 'postgresql':
+        unused = db.session.execute(text("""
+            SELECT s.relname, s.indexrelname, pg_size_pretty(pg_relation_size(s.indexrelid))
+            FROM pg_stat_user_indexes s JOIN pg_index i ON i.indexrelid = s.indexrelid
+            WHERE s.idx_scan = 0 AND NOT i.indisunique AND NOT i.indisprimary
+            ORDER BY pg_relation_size(s.indexrelid) DESC
+        """)).fetchall()
+        for table_name, index_name, size in unused:
+            click.echo('Unused index {} on {} ({})'.format(index_name, table_name, size))
+    elif check:
+        click.echo('Index usage statistics are only available on PostgreSQL')
+
+    if check and missing:
+        click.get_current_context().exit(1)
+
+
 @click.command( context_settings=dict( help_option_names = ['-h', '--help'] ) )
 @click.argument('json_files', type=click.Path(exists=True), nargs=-1, required=True, metavar="<multiqc_data.json>" )
 def upload(json_files):
@@ -186,11 +357,33 @@ def upload(json_files):
         else:
             # Loop through supplied JSON files
             for fn in json_files:
-                multiqc_config.logger.info("Uploading file '{}'".format(fn))
                 if fn.endswith('.gz'):
                     with gzip.open(fn, 'rb') as fh:
                         multiqc_json_dump = json.load(fh)
                 else:
                     with open(fn, 'r') as fh:
                         multiqc_json_dump = json.load(fh)
+                if report_exists(multiqc_config, multiqc_json_dump):
+                    multiqc_config.logger.info("Skipping file '{}', MegaQC already has this report".format(fn))
+                    continue
+                multiqc_config.logger.info("Uploading file '{}'".format(fn))
                 multiqc_megaqc.multiqc_api_post(multiqc_json_dump)
+
+
+def report_exists(multiqc_config, multiqc_json_dump):
+    """ Ask the MegaQC server whether it already has a report, before sending it """
+    import requests
+    from megaqc.api.utils import generate_hash
+    if 'data' in multiqc_json_dump:
+        multiqc_json_dump = multiqc_json_dump['data']
+    # megaqc_url points to the upload endpoint, eg. http://megaqc.example.com/api/upload_data
+    url = '{}/report_exists/{}'.format(multiqc_config.megaqc_url.rstrip('/').rsplit('/', 1)[0], generate_hash(multiqc_json_dump))
+    headers = {}
+    if getattr(multiqc_config, 'megaqc_access_token', None):
+        headers['access_token'] = multiqc_config.megaqc_access_token
+    try:
+        r = requests.head(url, headers=headers, timeout=getattr(multiqc_config, 'megaqc_timeout', 30))
+    except requests.exceptions.RequestException:
+        # Older servers, or no connection: let the upload itself report the problem
+        return False
+    return r.status_code == 200
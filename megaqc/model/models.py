@@ -3,7 +3,7 @@ import datetime as dt
 
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Table, ForeignKey, Column, Boolean, Integer, Float, Unicode, TIMESTAMP, Binary, DateTime, func
+from sqlalchemy import Table, ForeignKey, Column, Boolean, Integer, Float, Unicode, TIMESTAMP, Binary, DateTime, Index, LargeBinary, func
 
 from megaqc.database import CRUDMixin
 from megaqc.extensions import db
@@ -27,7 +27,8 @@ class Report(db.Model, CRUDMixin):
     report_id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.user_id'), index=True)
     report_hash = Column(Unicode, index=True, unique=True)
-    created_at = Column(DateTime, nullable=False, default=dt.datetime.utcnow)
+    file_hash = Column(Unicode, index=True, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=dt.datetime.utcnow, index=True)
     uploaded_at = Column(DateTime, nullable=False, default=dt.datetime.utcnow)
 
     def __init__(self, **kwargs):
@@ -56,6 +57,9 @@ class PlotConfig(db.Model, CRUDMixin):
     data = Column(Unicode, nullable=False)
 
     fav_users = db.relationship('User', secondary=user_plotconfig_map, backref="favourite_plotconfigs")
+    __table_args__ = (
+        Index('ix_plot_config_name_dataset_type', 'config_name', 'config_dataset', 'config_type'),
+    )
 
 
 class PlotData(db.Model, CRUDMixin):
@@ -65,15 +69,40 @@ class PlotData(db.Model, CRUDMixin):
     config_id = Column(Integer, ForeignKey('plot_config.config_id'))
     plot_category_id = Column(Integer(), ForeignKey('plot_category.plot_category_id'))
     sample_id = Column(Integer, ForeignKey('sample.sample_id'), index=True)
-    data = Column(Unicode, nullable=False)
+    # JSON data, or NULL for bar graph values stored in value
+    # and xy_line series stored in data_packed (see megaqc.api.series)
+    data = Column(Unicode, nullable=True)
+    value = Column(Float, nullable=True)
+    data_packed = Column(LargeBinary, nullable=True)
+    __table_args__ = (
+        Index('ix_plot_data_config_sample', 'config_id', 'sample_id'),
+    )
+
+
+class PlotDataLevel(db.Model, CRUDMixin):
+    """ A coarser copy of a packed xy_line series in plot_data, for zoomed out plots """
+    __tablename__ = "plot_data_level"
+    plot_data_level_id = Column(Integer, primary_key=True)
+    report_id = Column(Integer, ForeignKey('report.report_id'), index=True)
+    config_id = Column(Integer, ForeignKey('plot_config.config_id'))
+    sample_id = Column(Integer, ForeignKey('sample.sample_id'))
+    # The series has about 1/level of the points of the full series
+    level = Column(Integer, nullable=False)
+    n_points = Column(Integer, nullable=False)
+    x_min = Column(Float, nullable=True)
+    x_max = Column(Float, nullable=True)
+    data_packed = Column(LargeBinary, nullable=False)
+    __table_args__ = (
+        Index('ix_plot_data_level_config_sample', 'config_id', 'sample_id', 'level'),
+    )
 
 
 class PlotCategory(db.Model, CRUDMixin):
     __tablename__ = "plot_category"
     plot_category_id = Column(Integer, primary_key=True)
     report_id = Column(Integer, ForeignKey('report.report_id'))
-    config_id = Column(Integer, ForeignKey('plot_config.config_id'))
-    category_name = Column(Unicode, nullable=True)
+    config_id = Column(Integer, ForeignKey('plot_config.config_id'), index=True)
+    category_name = Column(Unicode, nullable=True, index=True)
     data = Column(Unicode, nullable=False)
 
 
@@ -102,9 +131,12 @@ class Dashboard(db.Model, CRUDMixin):
 class SampleDataType(db.Model, CRUDMixin):
     __tablename__ = "sample_data_type"
     sample_data_type_id = Column(Integer, primary_key=True)
-    data_id = Column(Unicode)
+    data_id = Column(Unicode, index=True)
     data_section = Column(Unicode)
     data_key = Column(Unicode, nullable=False)
+    __table_args__ = (
+        Index('ix_sample_data_type_key_section', 'data_key', 'data_section'),
+    )
 
 
 class SampleData(db.Model, CRUDMixin):
@@ -114,12 +146,18 @@ class SampleData(db.Model, CRUDMixin):
     sample_data_type_id = Column(Integer, ForeignKey('sample_data_type.sample_data_type_id'))
     sample_id = Column(Integer, ForeignKey('sample.sample_id'), index=True)
     value = Column(Unicode)
+    # value as a number, or NULL if it is not numeric
+    value_num = Column(Float, nullable=True)
+    __table_args__ = (
+        Index('ix_sample_data_type_value_num', 'sample_data_type_id', 'value_num'),
+        Index('ix_sample_data_sample_type', 'sample_id', 'sample_data_type_id'),
+    )
 
 
 class Sample(db.Model, CRUDMixin):
     __tablename__ = "sample"
     sample_id = Column(Integer, primary_key=True)
-    sample_name = Column(Unicode)
+    sample_name = Column(Unicode, index=True)
     report_id = Column(Integer, ForeignKey('report.report_id'), index=True)
 
 
@@ -142,3 +180,7 @@ class Upload(db.Model, CRUDMixin):
     created_at = Column(DateTime, nullable=False, default=dt.datetime.utcnow)
     modified_at = Column(DateTime, nullable=False, default=dt.datetime.utcnow)
     user_id = Column(Integer, ForeignKey('users.user_id'))
+    worker = Column(Unicode, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+    progress = Column(Unicode, nullable=True)
+    file_hash = Column(Unicode, nullable=True)
@@ -4,7 +4,7 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import bytes
 
-from flask import Blueprint, flash, redirect, render_template, request, url_for, abort, json, Request
+from flask import Blueprint, current_app, flash, redirect, render_template, request, send_file, url_for, abort, json, Request
 from flask_login import login_required, login_user, logout_user, current_user
 
 from collections import OrderedDict
@@ -14,12 +14,14 @@ from megaqc.public.forms import LoginForm
 from megaqc.user.forms import RegisterForm
 from megaqc.user.models import User
 from megaqc.model.models import Report, PlotConfig, PlotData, PlotCategory
-from megaqc.api.utils import get_samples, get_reports_data, get_user_filters, aggregate_new_parameters, get_report_metadata_fields, get_queued_uploads, get_plot_favourites, get_favourite_plot_data, get_dashboards, get_dashboard_data
+from megaqc.api.utils import figure_json, get_samples, get_reports_data, get_user_filters, aggregate_new_parameters, get_report_metadata_fields, get_queued_uploads, get_plot_favourites, get_favourite_plot_data, get_dashboards, get_dashboard_data
 from megaqc.utils import settings, flash_errors
 
 from sqlalchemy.sql import func, distinct
 from urllib.parse import unquote_plus
 
+import pkg_resources
+
 blueprint = Blueprint('public', __name__, static_folder='../static')
 
 
@@ -91,6 +93,16 @@ def about():
     form = LoginForm(request.form)
     return render_template('public/about.html', form=form)
 
+@blueprint.route('/plotly.min.js')
+def plotly_js():
+    """The plotly.js bundle of the installed plotly package, shared by all plots."""
+    return send_file(
+        pkg_resources.resource_filename('plotly', 'package_data/plotly.min.js'),
+        mimetype = 'application/javascript',
+        conditional = True,
+        cache_timeout = current_app.config.get('PLOTLY_JS_CACHE_TIMEOUT', 31536000)
+    )
+
 @blueprint.route('/plot_type/')
 def choose_plot_type():
     """Choose plot type."""
@@ -178,9 +190,11 @@ def plot_favourites():
 @login_required
 def plot_favourite(fav_id):
     """View and edit saved plots."""
+    plot_data = get_favourite_plot_data(current_user, fav_id, 'json')
     return render_template(
         'users/plot_favourite.html',
-        plot_data = get_favourite_plot_data(current_user, fav_id),
+        plot_data = plot_data,
+        figure_json = figure_json(plot_data['figure']) if 'figure' in plot_data else None,
         raw = request.path.endswith('/raw'),
         user_token = current_user.api_token,
     )
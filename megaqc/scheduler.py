@@ -1,67 +1,323 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-from builtins import str
+from builtins import range, str
 
 from flask import current_app
-from flask_apscheduler import APScheduler
-from megaqc.model.models import Upload
+from megaqc.model.models import Report, Upload
 from megaqc.user.models import User
 from megaqc.extensions import db
 from megaqc.api.utils import handle_report_data
+from megaqc.api.ingest import IngestProgress, ingest_report_file, open_report_file
+from megaqc.api.notify import UploadWaiter
+from sqlalchemy import and_, func, or_
 
 import datetime
-import gzip
+import errno
+import importlib
 import json
-import io
+import multiprocessing
 import os
+import socket
+import sys
+import threading
+import time
 import traceback
 
-scheduler = APScheduler()
+_listener = None
+_listener_lock = threading.Lock()
 
 def init_scheduler(app):
-    scheduler.init_app(app)
-    scheduler.start()
-
-def upload_reports_job():
-    with scheduler.app.app_context():
-        queued_uploads = db.session.query(Upload).filter(Upload.status == "NOT TREATED").all()
-        for row in queued_uploads:
-            user = db.session.query(User).filter(User.user_id == row.user_id).one()
-            current_app.logger.info("Beginning process of upload #{} from {}".format(row.upload_id, user.email))
-            row.status = "IN TREATMENT"
-            db.session.add(row)
+    """ Process queued uploads in a background thread of this process
+
+    The thread is woken up as soon as an upload is queued, and polls the
+    queue every UPLOAD_POLL_INTERVAL seconds in case it missed one.
+    """
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            # There is a single upload listener per process, even if several apps are created
+            return
+        _listener = threading.Thread(target=run_worker, args=(app,), name='upload-listener')
+        _listener.daemon = True
+        _listener.start()
+
+def worker_name():
+    """ Identify this worker in the uploads table """
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(), threading.current_thread().name)
+
+def current_rss_mb():
+    """ Resident memory of this process, in MB """
+    try:
+        with open('/proc/self/statm') as fh:
+            pages = int(fh.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+    except (IOError, OSError, ValueError, IndexError):
+        # No procfs: fall back to the peak memory use, in kB on Linux but bytes on macOS
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            peak /= 1024.0
+        return peak / 1024.0
+
+def memory_exceeded(max_rss_mb):
+    """ True if the worker grew past max_rss_mb and should be recycled """
+    if not max_rss_mb:
+        return False
+    rss = current_rss_mb()
+    if rss <= max_rss_mb:
+        return False
+    current_app.logger.info("Upload worker {} uses {:.0f}MB, more than the {}MB limit".format(worker_name(), rss, max_rss_mb))
+    return True
+
+def worker_alive(worker):
+    """ True if the named worker is known to still run on this host
+
+    Workers on other hosts, or with names that are not from worker_name(),
+    cannot be checked and are reported as not running.
+    """
+    try:
+        host, pid, thread = worker.split(':', 2)
+        pid = int(pid)
+    except (AttributeError, ValueError):
+        return False
+    if host != socket.gethostname():
+        return False
+    if pid == os.getpid():
+        return any(t.name == thread for t in threading.enumerate())
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def claimable_uploads():
+    """ Queued uploads, and uploads whose worker stopped sending heartbeats """
+    stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=current_app.config.get('UPLOAD_STALE_TIMEOUT', 300))
+    return or_(
+        Upload.status == "NOT TREATED",
+        and_(Upload.status == "IN TREATMENT", func.coalesce(Upload.heartbeat_at, Upload.modified_at) < stale)
+    )
+
+def claim_upload(worker):
+    """ Atomically claim the next upload to process, or return None
+
+    Postgres uses SELECT ... FOR UPDATE SKIP LOCKED so concurrent workers
+    never wait on each other. Other databases use a conditional UPDATE that
+    only succeeds for the first worker to flip the row's status. There,
+    uploads without recent heartbeats are only reclaimed once their worker
+    process is gone, as heartbeats cannot be written during ingestion.
+    """
+    now = datetime.datetime.utcnow()
+    claim = {'status': "IN TREATMENT", 'worker': worker, 'heartbeat_at': now, 'modified_at': now}
+    if db.engine.dialect.name == 'postgresql':
+        row = (db.session.query(Upload)
+                .filter(claimable_uploads())
+                .order_by(Upload.created_at)
+                .with_for_update(skip_locked=True)
+                .first())
+        if row is None:
             db.session.commit()
-            # Check if we have a gzipped file
-            gzipped = False
-            with open(row.path, 'rb') as fh:
-                # Check if we have a gzipped file
-                file_start = fh.read(3)
-                if file_start == b'\x1f\x8b\x08':
-                    gzipped = True
+            return None
+        for key, value in claim.items():
+            setattr(row, key, value)
+        db.session.commit()
+        return row
+    candidates = db.session.query(Upload.upload_id, Upload.status, Upload.worker).filter(claimable_uploads()).order_by(Upload.created_at).limit(10).all()
+    for upload_id, status, claimed_by in candidates:
+        if status == "IN TREATMENT" and worker_alive(claimed_by):
+            # SQLite cannot record heartbeats while a report is written, the worker is just busy
+            continue
+        claimed = (db.session.query(Upload)
+                    .filter(Upload.upload_id == upload_id, claimable_uploads())
+                    .update(claim, synchronize_session=False))
+        db.session.commit()
+        if claimed:
+            return db.session.query(Upload).get(upload_id)
+    return None
+
+
+class Heartbeat(threading.Thread):
+    """ Keep refreshing a claimed upload's heartbeat and progress while it is processed """
+
+    def __init__(self, upload_id, worker, interval, progress=None):
+        super(Heartbeat, self).__init__(name='heartbeat-{}'.format(upload_id))
+        self.daemon = True
+        self.upload_id = upload_id
+        self.worker = worker
+        self.interval = interval
+        self.progress = progress
+        self.engine = db.engine
+        self.logger = current_app.logger
+        self.stopped = threading.Event()
+
+    def run(self):
+        table = Upload.__table__
+        while not self.stopped.wait(self.interval):
+            values = {'heartbeat_at': datetime.datetime.utcnow()}
+            if self.progress is not None:
+                values['progress'] = json.dumps(self.progress.as_dict())
+            try:
+                # A separate connection, the ingestion transaction stays open meanwhile
+                with self.engine.begin() as conn:
+                    conn.execute(table.update().where(and_(
+                        table.c.upload_id == self.upload_id,
+                        table.c.worker == self.worker
+                    )).values(**values))
+            except Exception:
+                # SQLite locks the whole database while a report is written
+                self.logger.debug("Could not send heartbeat for upload {}: {}".format(self.upload_id, traceback.format_exc()))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def process_upload(row, worker):
+    """ Save a claimed upload to the database and record the outcome """
+    user = db.session.query(User).filter(User.user_id == row.user_id).one()
+    upload_id = row.upload_id
+    path = row.path
+    file_hash = row.file_hash
+    current_app.logger.info("Beginning process of upload #{} from {} ({})".format(upload_id, user.email, worker))
+    progress = IngestProgress()
+    heartbeat = Heartbeat(upload_id, worker, current_app.config.get('UPLOAD_HEARTBEAT_INTERVAL', 30), progress)
+    heartbeat.start()
+    try:
+        if file_hash and db.session.query(Report.report_id).filter(Report.file_hash == file_hash).first():
+            # The very same file was already saved, no need to parse it again
+            ret = (False, 'Report already uploaded')
+        elif current_app.config.get('UPLOAD_STREAMING_PARSE', True):
+            # Parse the file incrementally, without holding the whole document in memory
+            ret = ingest_report_file(user, path, progress, file_hash)
+        else:
+            with open_report_file(path) as fh:
+                data = json.loads(fh.read().decode('utf-8'))
+            # Now save the parsed JSON data to the database
+            ret = handle_report_data(user, data, progress, file_hash)
+    except Exception:
+        db.session.rollback()
+        ret = (False, '<pre><code>{}</code></pre>'.format(traceback.format_exc()))
+        current_app.logger.error("Error processing upload {}: {}".format(upload_id, traceback.format_exc()))
+    finally:
+        heartbeat.stop()
+    if ret[0]:
+        status = "TREATED"
+        message = "The document has been uploaded successfully"
+    else:
+        status = "FAILED"
+        message = "The document has not been uploaded : {0}".format(ret[1])
+    # Only record the outcome if the claim was not handed to another worker meanwhile
+    updated = (db.session.query(Upload)
+                .filter(Upload.upload_id == upload_id, Upload.worker == worker)
+                .update({
+                    'status': status,
+                    'message': message,
+                    'progress': json.dumps(progress.as_dict()),
+                    'modified_at': datetime.datetime.utcnow()
+                }, synchronize_session=False))
+    db.session.commit()
+    if not updated:
+        current_app.logger.warning("Upload #{} was reclaimed by another worker, discarding result {}".format(upload_id, status))
+        return
+    if ret[0]:
+        os.remove(path)
+    current_app.logger.info("Finished processing upload #{} to state {}".format(upload_id, status))
+
+def drain_upload_queue(worker=None, max_rss_mb=None):
+    """ Process uploads until the queue is empty, returning how many were processed
+
+    Stops early once the process uses more than max_rss_mb of memory.
+    """
+    if worker is None:
+        worker = worker_name()
+    processed = 0
+    while not memory_exceeded(max_rss_mb):
+        row = claim_upload(worker)
+        if row is None:
+            break
+        try:
+            process_upload(row, worker)
+        finally:
+            # Each upload gets a fresh session, so its objects do not pile up in the identity map
+            db.session.remove()
+        processed += 1
+    return processed
+
+def upload_poll_interval():
+    """ Seconds between fallback checks of the upload queue, see UPLOAD_POLL_INTERVAL """
+    interval = current_app.config.get('UPLOAD_POLL_INTERVAL')
+    if interval:
+        return interval
+    # Without NOTIFY, workers in other processes only see new uploads when they poll
+    return 300 if db.engine.dialect.name == 'postgresql' else 30
+
+def run_worker(app, poll_interval=None, max_rss_mb=None):
+    """ Process queued uploads until the worker uses more than max_rss_mb
+
+    The worker is woken up as soon as an upload is queued and polls the
+    queue every poll_interval seconds in case it missed a notification.
+    """
+    with app.app_context():
+        if poll_interval is None:
+            poll_interval = upload_poll_interval()
+        waiter = UploadWaiter(db.engine)
+        app.logger.info("Upload worker {} started".format(worker_name()))
+        while True:
             try:
-                if gzipped:
-                    with io.BufferedReader(gzip.open(row.path, 'rb')) as fh:
-                        raw_data = fh.read().decode('utf-8')
-                else:
-                    with io.open(row.path, 'rb') as fh:
-                        raw_data = fh.read().decode('utf-8')
-                data = json.loads(raw_data)
-                # Now save the parsed JSON data to the database
-                ret = handle_report_data(user, data)
+                drain_upload_queue(max_rss_mb=max_rss_mb)
             except Exception:
-                ret = (False, '<pre><code>{}</code></pre>'.format(traceback.format_exc()))
-                current_app.logger.error("Error processing upload {}: {}".format(row.upload_id, traceback.format_exc()))
-            if ret[0]:
-                row.status = "TREATED"
-                row.message = "The document has been uploaded successfully"
-                os.remove(row.path)
-            else:
-                if ret[1] == "Report already processed":
-                    current_app.logger.info("Upload {} already being processed by another worker, skipping".format(row.upload_id))
+                db.session.rollback()
+                app.logger.error("Upload worker {} failed: {}".format(worker_name(), traceback.format_exc()))
+            finally:
+                db.session.remove()
+            if memory_exceeded(max_rss_mb):
+                waiter.close()
+                app.logger.info("Upload worker {} stopping to release memory".format(worker_name()))
+                return
+            waiter.wait(poll_interval)
+
+def worker_process(config_name, poll_interval=None, max_rss_mb=None):
+    """ Entry point of a `megaqc worker` process
+
+    The process builds its own app from the dotted name of the config class,
+    as an app cannot be handed over with the spawn start method. Settings
+    are read again, including the MEGAQC_CONFIG file.
+    """
+    from megaqc.app import create_app
+    module, name = config_name.rsplit('.', 1)
+    config = getattr(importlib.import_module(module), name)()
+    config.SCHEDULER_ENABLED = False
+    run_worker(create_app(config), poll_interval, max_rss_mb)
+
+def run_workers(app, processes=1, poll_interval=None):
+    """ Run several upload worker processes, restarting any that exit
+
+    Workers exit once they use more than UPLOAD_WORKER_MAX_RSS_MB, and are
+    replaced by a fresh process. Any number of hosts can run workers against
+    the same database: uploads are claimed atomically, so each one is only
+    processed once.
+    """
+    max_rss_mb = app.config.get('UPLOAD_WORKER_MAX_RSS_MB')
+    if processes <= 1 and not max_rss_mb:
+        return run_worker(app, poll_interval)
+    workers = [None] * processes
+    try:
+        while True:
+            for idx in range(processes):
+                proc = workers[idx]
+                if proc is not None and proc.is_alive():
                     continue
-                row.status = "FAILED"
-                row.message = "The document has not been uploaded : {0}".format(ret[1])
-            row.modified_at = datetime.datetime.utcnow()
-            current_app.logger.info("Finished processing upload #{} to state {}".format(row.upload_id, row.status))
-            db.session.add(row)
-            db.session.commit()
+                if proc is not None:
+                    app.logger.info("Upload worker {} exited with code {}, restarting".format(proc.name, proc.exitcode))
+                # Forked children must not share the parent's database connections
+                with app.app_context():
+                    db.engine.dispose()
+                proc = multiprocessing.Process(target=worker_process, args=(app.config['CONFIG_NAME'], poll_interval, max_rss_mb), name='megaqc-worker-{}'.format(idx))
+                proc.daemon = True
+                proc.start()
+                workers[idx] = proc
+            time.sleep(1)
+    finally:
+        for proc in workers:
+            if proc is not None and proc.is_alive():
+                proc.terminate()
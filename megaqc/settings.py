@@ -3,8 +3,6 @@
 from __future__ import print_function
 from builtins import object
 
-from megaqc.scheduler import upload_reports_job
-
 import logging
 import os
 import yaml
@@ -21,8 +19,36 @@ class Config(object):
     DEBUG_TB_INTERCEPT_REDIRECTS = False
     CACHE_TYPE = 'simple'  # Can be "memcached", "redis", etc.
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    JOBS = [{'id': 'job1','func': upload_reports_job,'trigger': 'interval','seconds': 30}]
-    SCHEDULER_API_ENABLED = True
+    INGEST_BATCH_SIZE = 1000  # Rows per multi-row INSERT when saving reports
+    UPLOAD_GZIP_LEVEL = 6  # Compression level for uploads that are not sent gzipped
+    UPLOAD_STREAMING_PARSE = True  # Parse queued uploads incrementally instead of loading them whole
+    PLOT_DATA_PACKED = True  # Store xy_line series as packed binary arrays instead of JSON
+    PLOT_DATA_COMPRESS = True  # zlib-compress packed series when it makes them smaller
+    PLOT_DATA_FLOAT32 = True  # Use float32 for packed series that fit without losing precision
+    PLOT_DATA_LEVELS = (4, 16, 64)  # Also store packed xy_line series with 1/4, 1/16 and 1/64 of their points, for zoomed out plots
+    PLOT_DATA_LEVEL_MIN_POINTS = 250  # Only store the levels that keep at least this many points
+    PLOT_FAST_FIGURES = True  # Build plots as plain dicts, without plotly's graph_objs validation
+    PLOT_WEBGL_THRESHOLD = 5000  # Draw 2D comparison plots with WebGL above this many samples
+    PLOT_COMPARISON_MAX_POINTS = 100000  # Downsample comparison plots with more samples than this, 0 to disable
+    PLOT_DISTRIBUTION_SUMMARY_THRESHOLD = 10000  # Summarise distribution plots of more samples than this on the server
+    PLOT_DISTRIBUTION_MAX_POINTS = 5000  # Raw points sent for a summarised dot plot or box plot outliers
+    PLOT_SERIES_MAX_POINTS = 1000  # Downsample xy_line and raw trend series with more points than this, 0 to disable
+    PLOT_SERIES_ENVELOPE_SAMPLES = 500  # Draw xy_line plots of more samples than this as percentile envelopes
+    PLOT_SERIES_ENVELOPE_EXTREMES = 5  # Samples furthest from the median drawn over the envelopes
+    PLOT_TREND_RAW_POINTS = 5000  # Trend plots with more samples than this are aggregated per day, week or month...
+    PLOT_TREND_RAW_DAYS = 14  # ...unless they span fewer days than this
+    PLOT_TREND_MAX_BUCKETS = 200  # Use the shortest of day, week and month that gives fewer buckets than this
+    PLOTLY_JS_CACHE_TIMEOUT = 31536000  # Browsers cache the shared plotly.js, its URL changes with the plotly version
+    # Seconds between fallback checks for uploads that were not notified. Every web process also runs
+    # an upload worker unless SCHEDULER_ENABLED is off. PostgreSQL notifies all of them at once and
+    # defaults to 300s; other databases only wake the worker of the process that got the upload,
+    # so the others poll every 30s by default
+    UPLOAD_POLL_INTERVAL = None
+    UPLOAD_HEARTBEAT_INTERVAL = 30  # Seconds between heartbeats from a worker processing an upload
+    UPLOAD_STALE_TIMEOUT = 300  # Seconds without heartbeat before an upload can be claimed again. On SQLite, only once its worker has exited
+    SCHEDULER_ENABLED = True  # Process uploads inside the web app. Disable when running `megaqc worker`
+    UPLOAD_WORKER_PROCESSES = 1  # Default number of processes started by `megaqc worker`
+    UPLOAD_WORKER_MAX_RSS_MB = 2048  # Memory (MB) after which a `megaqc worker` process is replaced. 0 to disable
     EXTRA_CONFIG = os.environ.get("MEGAQC_CONFIG", None)
     SERVER_NAME = None
     DB_PATH = None
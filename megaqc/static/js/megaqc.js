@@ -61,3 +61,39 @@ function save_plot_favourite(plot_type, request_data){
         }
     });
 }
+
+// Plots drawn by show_plot, resized with the window by a single listener
+var shown_plots = [];
+
+// Forget the plots that were replaced or removed from the page
+function prune_shown_plots(){
+    shown_plots = shown_plots.filter(function(plot_div){
+        return document.body.contains(plot_div);
+    });
+}
+
+function resize_shown_plots(){
+    prune_shown_plots();
+    shown_plots.forEach(function(plot_div){
+        Plotly.Plots.resize(plot_div);
+    });
+}
+window.addEventListener('resize', resize_shown_plots);
+
+// Show the result of a plot API call, requested with 'format': 'json'
+// Figure specs are drawn with the shared plotly.js, anything else is HTML
+// Returns the plotly div, or null if there was no figure
+function show_plot(target, data, html_key){
+    var el = $(target);
+    if(!data['figure']){
+        el.html(data[html_key || 'plot']);
+        return null;
+    }
+    var plot_div = $('<div class="plotly-graph-div" style="height:100%; width:100%;"></div>');
+    el.html(plot_div);
+    var figure = data['figure'];
+    Plotly.newPlot(plot_div[0], figure['data'], figure['layout'], figure['config']);
+    prune_shown_plots();
+    shown_plots.push(plot_div[0]);
+    return plot_div[0];
+}
@@ -48,16 +48,14 @@ function init_btns(){
         $.ajax({
             url:"/api/get_report_plot",
             type: 'post',
-            data:JSON.stringify({"samples":selected_samples, "plot_type":window.graph_type}),
+            data:JSON.stringify({"samples":selected_samples, "plot_type":window.graph_type, "format":"json"}),
             headers : {access_token:window.token},
             dataType: 'json',
             contentType:"application/json; charset=UTF-8",
             success: function(json){
                 console.log(json);
-                html=json['plot'];
-                //$("#plot_modal_body").html(html);
                 //$("#result_plot").modal();
-                $('#plot_location').html(html);
+                show_plot('#plot_location', json);
                 }
         });
 
@@ -53,7 +53,7 @@ class User(db.Model, CRUDMixin):
     last_name = Column(Unicode, nullable=True)
     active = Column(Boolean(), default=False)
     is_admin = Column(Boolean(), default=False)
-    api_token = Column(Unicode, nullable=True)
+    api_token = Column(Unicode, nullable=True, index=True)
 
     def __init__(self, password=None, **kwargs):
         """Create instance."""
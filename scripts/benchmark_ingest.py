@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+""" Benchmark MegaQC report ingestion.
+
+Builds a synthetic MultiQC report and times how long it takes to save it to a
+fresh database, reporting the number of rows written per second. Run it with
+different batch sizes to compare the bulk insert path with row-by-row writes:
+
+    python scripts/benchmark_ingest.py --samples 500 --fields 200 --batch-size 1 --batch-size 1000
+"""
+
+from __future__ import print_function, division
+
+import click
+import os
+import shutil
+import tempfile
+import time
+
+
+def synthetic_report(n_samples, n_fields, n_points, seed):
+    samples = ['bench_{}_sample_{}'.format(seed, i) for i in range(n_samples)]
+    return {
+        'config_title': 'Benchmark report {}'.format(seed),
+        'config_creation_date': '2018-06-01, 12:00',
+        'report_saved_raw_data': {
+            'multiqc_bench': {
+                s: {'field_{}'.format(f): float(i * f) for f in range(n_fields)}
+                for i, s in enumerate(samples)
+            }
+        },
+        'report_plot_data': {
+            'bench_bar_plot': {
+                'plot_type': 'bar_graph',
+                'config': {'title': 'Benchmark bar graph'},
+                'samples': [samples],
+                'datasets': [[
+                    {'name': 'Category {}'.format(c), 'data': [float(i) for i in range(n_samples)]}
+                    for c in range(4)
+                ]]
+            },
+            'bench_line_plot': {
+                'plot_type': 'xy_line',
+                'config': {'title': 'Benchmark line graph', 'ylab': 'Value'},
+                'datasets': [[
+                    {'name': s, 'data': [[x, float(x * i)] for x in range(n_points)]}
+                    for i, s in enumerate(samples)
+                ]]
+            }
+        }
+    }
+
+
+@click.command()
+@click.option('--samples', default=500, help='Number of samples in the report')
+@click.option('--fields', default=200, help='Number of raw data fields per sample')
+@click.option('--points', default=100, help='Number of points per line graph curve')
+@click.option('--batch-size', 'batch_sizes', multiple=True, type=int, default=[1000],
+              help='INGEST_BATCH_SIZE to benchmark (can be given more than once)')
+@click.option('--db-uri', default=None, help='Database URI (default: a temporary SQLite file)')
+def main(samples, fields, points, batch_sizes, db_uri):
+    from megaqc.app import create_app
+    from megaqc.extensions import db
+    from megaqc.settings import TestConfig
+    from megaqc.user.models import User
+    from megaqc.api.utils import handle_report_data
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        config = TestConfig()
+        config.SQLALCHEMY_DATABASE_URI = db_uri or 'sqlite:///{}'.format(os.path.join(tmp_dir, 'bench.db'))
+        config.SCHEDULER_ENABLED = False
+        app = create_app(config)
+        with app.app_context():
+            db.create_all()
+            user = User(username='benchmark', email='benchmark@example.com')
+            user.save()
+            for seed, batch_size in enumerate(batch_sizes):
+                report = synthetic_report(samples, fields, points, seed)
+                app.config['INGEST_BATCH_SIZE'] = batch_size
+                start = time.time()
+                success, msg = handle_report_data(user, report)
+                elapsed = time.time() - start
+                n_rows = samples * fields + samples * 4 + samples
+                print("batch size {:>6}: {} in {:.2f}s ({:.0f} rows/s)".format(batch_size, msg, elapsed, n_rows / elapsed))
+            if not db_uri:
+                db.drop_all()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+""" Fill sample_data.value_num for rows saved before the column was added.
+
+Works with any database, for example SQLite, where sample_data_value_num.sql
+cannot be used as it is. Add the column and index first:
+
+    alter table sample_data add column value_num float;
+    create index ix_sample_data_type_value_num on sample_data (sample_data_type_id, value_num);
+
+Then run this script with the same environment variables as the MegaQC server.
+"""
+
+from __future__ import print_function
+
+import click
+
+from migration_utils import batches, migration_app
+
+
+@click.command()
+@click.option('--batch-size', default=10000, help='Rows updated per transaction')
+def main(batch_size):
+    from sqlalchemy import bindparam, select
+    from megaqc.api.ingest import numeric_value
+    from megaqc.extensions import db
+    from megaqc.model.models import SampleData
+
+    app = migration_app()
+    table = SampleData.__table__
+    update = table.update().where(table.c.sample_data_id == bindparam('row_id')).values(value_num=bindparam('num'))
+    query = select([table.c.sample_data_id, table.c.value]).where(table.c.value_num == None)
+    with app.app_context():
+        updated = 0
+        for rows in batches(db.session, query, table.c.sample_data_id, batch_size):
+            params = [{'row_id': row_id, 'num': numeric_value(value)} for row_id, value in rows]
+            params = [p for p in params if p['num'] is not None]
+            if params:
+                db.session.execute(update, params)
+            updated += len(params)
+            print("Updated {} rows (up to sample_data_id {})".format(updated, rows[-1][0]))
+
+
+if __name__ == '__main__':
+    main()
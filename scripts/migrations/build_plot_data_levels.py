@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+""" Store the coarser levels of the existing packed xy_line series.
+
+Run plot_data_level.sql (PostgreSQL) or plot_data_level_sqlite.sql (SQLite)
+first, then this script with the same environment variables as the MegaQC
+server. Series that already have levels are skipped, so it can be run again.
+"""
+
+from __future__ import print_function
+
+import click
+
+from migration_utils import batches, migration_app
+
+
+@click.command()
+@click.option('--batch-size', default=1000, help='Series processed per transaction')
+def main(batch_size):
+    from sqlalchemy import and_, exists, select
+    from megaqc.api.ingest import plot_data_levels
+    from megaqc.extensions import db
+    from megaqc.model.models import PlotData, PlotDataLevel
+
+    app = migration_app()
+    table = PlotData.__table__
+    levels = PlotDataLevel.__table__
+    query = (select([table.c.plot_data_id, table.c.report_id, table.c.config_id, table.c.sample_id, table.c.data_packed])
+             .where(and_(
+                 table.c.data_packed != None,
+                 ~exists().where(and_(
+                     levels.c.report_id == table.c.report_id,
+                     levels.c.config_id == table.c.config_id,
+                     levels.c.sample_id == table.c.sample_id
+                 ))
+             )))
+    with app.app_context():
+        options = dict(
+            compress = app.config.get('PLOT_DATA_COMPRESS', True),
+            allow_float32 = app.config.get('PLOT_DATA_FLOAT32', True)
+        )
+        factors = app.config.get('PLOT_DATA_LEVELS', ())
+        min_points = app.config.get('PLOT_DATA_LEVEL_MIN_POINTS', 250)
+        if not factors:
+            print("PLOT_DATA_LEVELS is empty, nothing to do")
+            return
+        stored = 0
+        for rows in batches(db.session, query, table.c.plot_data_id, batch_size):
+            params = []
+            for row_id, report_id, config_id, sample_id, packed in rows:
+                params.extend(plot_data_levels(report_id, config_id, sample_id, packed, factors, min_points, **options))
+            if params:
+                db.session.execute(levels.insert(), params)
+            stored += len(params)
+            print("Stored {} levels (up to plot_data_id {})".format(stored, rows[-1][0]))
+
+
+if __name__ == '__main__':
+    main()
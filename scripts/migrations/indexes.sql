@@ -0,0 +1,13 @@
+begin;
+-- indexes for the lookups done by the API, report plots, sample filters and ingestion
+create index if not exists ix_sample_sample_name on sample (sample_name) ;
+create index if not exists ix_sample_data_type_data_id on sample_data_type (data_id) ;
+create index if not exists ix_sample_data_type_key_section on sample_data_type (data_key, data_section) ;
+create index if not exists ix_sample_data_sample_type on sample_data (sample_id, sample_data_type_id) ;
+create index if not exists ix_plot_config_name_dataset_type on plot_config (config_name, config_dataset, config_type) ;
+create index if not exists ix_plot_category_category_name on plot_category (category_name) ;
+create index if not exists ix_plot_category_config_id on plot_category (config_id) ;
+create index if not exists ix_plot_data_config_sample on plot_data (config_id, sample_id) ;
+create index if not exists ix_report_created_at on report (created_at) ;
+create index if not exists ix_users_api_token on users (api_token) ;
+commit ;
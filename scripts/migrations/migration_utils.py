@@ -0,0 +1,43 @@
+""" Helpers shared by the Python migration scripts in this directory.
+
+The scripts import this module from their own directory, so run them as
+`python scripts/migrations/<script>.py`.
+"""
+
+from __future__ import print_function
+
+import os
+
+
+def migration_app():
+    """ The MegaQC app, configured from the same environment variables as the server """
+    from megaqc.app import create_app
+    from megaqc.settings import DevConfig, ProdConfig, TestConfig
+
+    if os.environ.get('FLASK_DEBUG', False):
+        config = DevConfig()
+    elif os.environ.get('MEGAQC_PRODUCTION', False):
+        config = ProdConfig()
+    else:
+        config = TestConfig()
+    # Migrations must not process queued uploads meanwhile
+    config.SCHEDULER_ENABLED = False
+    return create_app(config)
+
+
+def batches(session, query, id_column, batch_size):
+    """ Yield the rows of a select in batches of increasing id_column
+
+    id_column must be the first column of the select. The session is
+    committed after each batch, once the caller asks for the next one.
+    """
+    last_id = 0
+    while True:
+        rows = session.execute(
+            query.where(id_column > last_id).order_by(id_column).limit(batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        yield rows
+        session.commit()
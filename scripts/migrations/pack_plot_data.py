@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+""" Convert the JSON xy_line series in plot_data to the packed binary format.
+
+Run plot_data_packed.sql (PostgreSQL) or plot_data_packed_sqlite.sql (SQLite)
+first, then this script with the same environment variables as the MegaQC
+server. Series that cannot be packed (eg. with text x values) are left as JSON.
+"""
+
+from __future__ import print_function
+
+import click
+import json
+
+from migration_utils import batches, migration_app
+
+
+@click.command()
+@click.option('--batch-size', default=1000, help='Rows converted per transaction')
+def main(batch_size):
+    from sqlalchemy import and_, bindparam, select
+    from megaqc.api.series import pack_series
+    from megaqc.extensions import db
+    from megaqc.model.models import PlotConfig, PlotData
+
+    app = migration_app()
+    table = PlotData.__table__
+    configs = PlotConfig.__table__
+    update = table.update().where(table.c.plot_data_id == bindparam('row_id')).values(
+        data=None, data_packed=bindparam('packed'))
+    query = (select([table.c.plot_data_id, table.c.data])
+             .select_from(table.join(configs, configs.c.config_id == table.c.config_id))
+             .where(and_(configs.c.config_type == 'xy_line', table.c.data_packed == None)))
+    with app.app_context():
+        options = dict(
+            compress = app.config.get('PLOT_DATA_COMPRESS', True),
+            allow_float32 = app.config.get('PLOT_DATA_FLOAT32', True)
+        )
+        converted = 0
+        for rows in batches(db.session, query, table.c.plot_data_id, batch_size):
+            params = [{'row_id': row_id, 'packed': pack_series(json.loads(data), **options)} for row_id, data in rows]
+            params = [p for p in params if p['packed'] is not None]
+            if params:
+                db.session.execute(update, params)
+            converted += len(params)
+            print("Converted {} series (up to plot_data_id {})".format(converted, rows[-1][0]))
+
+
+if __name__ == '__main__':
+    main()
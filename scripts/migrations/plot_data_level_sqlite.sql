@@ -0,0 +1,20 @@
+begin;
+-- plot_data_level: coarser copies of packed xy_line series
+create table plot_data_level (
+    plot_data_level_id integer not null,
+    report_id integer,
+    config_id integer,
+    sample_id integer,
+    level integer not null,
+    n_points integer not null,
+    x_min float,
+    x_max float,
+    data_packed blob not null,
+    primary key (plot_data_level_id),
+    foreign key(report_id) references report (report_id),
+    foreign key(config_id) references plot_config (config_id),
+    foreign key(sample_id) references sample (sample_id)
+) ;
+create index ix_plot_data_level_report_id on plot_data_level (report_id) ;
+create index ix_plot_data_level_config_sample on plot_data_level (config_id, sample_id, level) ;
+commit ;
@@ -0,0 +1,5 @@
+begin;
+-- plot_data: packed binary xy_line series, the JSON data becomes optional
+alter table plot_data add column "data_packed" bytea ;
+alter table plot_data alter column "data" drop not null ;
+commit ;
@@ -0,0 +1,24 @@
+-- SQLite cannot drop a NOT NULL constraint: rebuild plot_data instead
+begin;
+alter table plot_data rename to plot_data_old ;
+create table plot_data (
+    plot_data_id integer not null,
+    report_id integer,
+    config_id integer,
+    plot_category_id integer,
+    sample_id integer,
+    data varchar,
+    data_packed blob,
+    primary key (plot_data_id),
+    foreign key(report_id) references report (report_id),
+    foreign key(config_id) references plot_config (config_id),
+    foreign key(plot_category_id) references plot_category (plot_category_id),
+    foreign key(sample_id) references sample (sample_id)
+) ;
+insert into plot_data (plot_data_id, report_id, config_id, plot_category_id, sample_id, data)
+    select plot_data_id, report_id, config_id, plot_category_id, sample_id, data from plot_data_old ;
+drop table plot_data_old ;
+create index ix_plot_data_report_id on plot_data (report_id) ;
+create index ix_plot_data_sample_id on plot_data (sample_id) ;
+create index ix_plot_data_config_sample on plot_data (config_id, sample_id) ;
+commit ;
@@ -0,0 +1,8 @@
+begin;
+-- plot_data: bar graph values as numbers instead of JSON text
+-- (run plot_data_packed.sql or plot_data_packed_sqlite.sql first, so that data can be null)
+alter table plot_data add column "value" double precision ;
+update plot_data set value = cast(data as double precision), data = null
+    where config_id in (select config_id from plot_config where config_type = 'bar_graph')
+    and data not in ('null', 'NaN', 'Infinity', '-Infinity') ;
+commit ;
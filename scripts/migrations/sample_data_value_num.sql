@@ -0,0 +1,7 @@
+begin;
+-- sample_data: numeric copy of the values, for filtering and sorting with an index
+alter table sample_data add column "value_num" double precision ;
+update sample_data set value_num = cast(value as double precision)
+    where value ~ '^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$' ;
+create index ix_sample_data_type_value_num on sample_data (sample_data_type_id, value_num) ;
+commit ;
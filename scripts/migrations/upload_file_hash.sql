@@ -0,0 +1,6 @@
+begin;
+-- uploads and reports: SHA1 of the uploaded file, to skip identical uploads
+alter table uploads add column "file_hash" text ;
+alter table report add column "file_hash" text ;
+create index ix_report_file_hash on report (file_hash) ;
+commit ;
@@ -0,0 +1,4 @@
+begin;
+-- uploads: ingestion progress, as JSON
+alter table uploads add column "progress" text ;
+commit ;
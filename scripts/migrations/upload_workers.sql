@@ -0,0 +1,5 @@
+begin;
+-- uploads: claims for the upload queue workers
+alter table uploads add column "worker" text ;
+alter table uploads add column "heartbeat_at" timestamp ;
+commit ;
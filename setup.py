@@ -17,7 +17,6 @@ dev_reqs = [
     # MegaQC
     "argon2-cffi>=16.3.0",
     "click>=5.0",
-    "Flask-APScheduler>=1.7.0",
     "Flask-Caching>=1.0.0",
     "Flask-DebugToolbar>=0.10.1",
     "Flask-Login>=0.4.0",
@@ -25,6 +24,8 @@ dev_reqs = [
     "Flask-WTF==0.14.2",
     "Flask==1.0.2",
     "future==0.16.0",
+    "ijson>=2.3; python_version < '3'",
+    "ijson>=3.0; python_version >= '3'",
     "itsdangerous>=0.24",
     "Jinja2>=2.9.5",
     "markdown>=2.6.11",
@@ -32,6 +33,7 @@ dev_reqs = [
     "passlib==1.7.1",
     "plotly==2.0.15",
     "pyyaml==3.12",
+    "requests>=2.18",
     "SQLAlchemy>=1.1.5",
     "Werkzeug==0.14.1",
     "WTForms>=2.1",
@@ -11,10 +11,15 @@ from megaqc.settings import TestConfig
 from .factories import UserFactory
 
 
+class SchedulerlessConfig(TestConfig):
+    """Uploads are processed explicitly by the tests."""
+    SCHEDULER_ENABLED = False
+
+
 @pytest.yield_fixture(scope='function')
 def app():
     """An application for the tests."""
-    _app = create_app(TestConfig)
+    _app = create_app(SchedulerlessConfig)
     ctx = _app.test_request_context()
     ctx.push()
 
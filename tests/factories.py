@@ -29,3 +29,38 @@ class UserFactory(BaseFactory):
         """Factory configuration."""
 
         model = User
+
+
+def multiqc_report(n_samples=3, title='Test report', creation_date='2018-06-01, 12:00', sample_prefix='sample'):
+    """A minimal MultiQC data export with raw data, a bar graph and a line graph."""
+    samples = ['{0}_{1}'.format(sample_prefix, i) for i in range(n_samples)]
+    return {
+        'config_title': title,
+        'config_short_version': '1.5',
+        'config_creation_date': creation_date,
+        'report_saved_raw_data': {
+            'multiqc_fastqc': {
+                s: {'total_sequences': 1000.0 * (i + 1), 'percent_gc': 40 + i}
+                for i, s in enumerate(samples)
+            }
+        },
+        'report_plot_data': {
+            'fastqc_sequence_counts_plot': {
+                'plot_type': 'bar_graph',
+                'config': {'title': 'Sequence Counts', 'ylab': 'Number of reads'},
+                'samples': [samples],
+                'datasets': [[
+                    {'name': 'Unique Reads', 'color': '#7cb5ec', 'data': [10 * (i + 1) for i in range(n_samples)]},
+                    {'name': 'Duplicate Reads', 'color': '#434348', 'data': [5 * (i + 1) for i in range(n_samples)]},
+                ]]
+            },
+            'fastqc_per_base_sequence_quality_plot': {
+                'plot_type': 'xy_line',
+                'config': {'title': 'Mean Quality Scores', 'ylab': 'Phred Score'},
+                'datasets': [[
+                    {'name': s, 'data': [[1, 30.0 + i], [2, 31.5], [3, 32.0 - i]]}
+                    for i, s in enumerate(samples)
+                ]]
+            }
+        }
+    }
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""API tests."""
+import gzip
+import hashlib
+import io
+import json
+
+import pytest
+
+from megaqc.api.utils import generate_hash, handle_report_data
+from megaqc.model.models import Report, SampleDataType, Upload
+from megaqc.scheduler import drain_upload_queue
+
+from .factories import UserFactory, multiqc_report
+
+
+@pytest.mark.usefixtures('db')
+class TestUploadParse:
+    """Reports posted to /api/upload_parse are ingested in the background."""
+
+    def post_report(self, testapp, user, report):
+        return testapp.post('/api/upload_parse', json.dumps({'data': report}),
+                            headers={'access_token': str(user.api_token)},
+                            content_type='application/json')
+
+    def test_upload_is_queued(self, app, testapp, user, tmpdir):
+        """The endpoint returns straight away with the id of the queued upload."""
+        app.config['UPLOAD_FOLDER'] = str(tmpdir)
+        res = self.post_report(testapp, user, multiqc_report())
+        assert res.status_code == 202
+        upload = Upload.query.get(res.json['upload_id'])
+        assert upload.status == 'NOT TREATED'
+        assert Report.query.count() == 0
+
+    def test_status_reports_progress(self, app, testapp, user, tmpdir):
+        """Once processed, the status lists the rows written in each phase."""
+        app.config['UPLOAD_FOLDER'] = str(tmpdir)
+        token = str(user.api_token)
+        res = self.post_report(testapp, user, multiqc_report())
+        assert drain_upload_queue('worker-1') == 1
+        status = testapp.get(res.json['status_url'], headers={'access_token': token}).json
+        assert status['status'] == 'TREATED'
+        progress = status['progress']
+        assert progress['finished']
+        phases = dict((phase['name'], phase['rows']) for phase in progress['phases'])
+        # username + 3 config keys, 3 samples x 2 fields, 3 samples x 2 bar categories + 3 lines
+        assert phases == {'metadata': 4, 'raw samples': 6, 'plot data': 9}
+
+    def test_status_of_other_users_upload(self, app, testapp, user, tmpdir):
+        """Users cannot follow each other's uploads."""
+        app.config['UPLOAD_FOLDER'] = str(tmpdir)
+        other = UserFactory(password='other')
+        other.is_admin = False
+        other.save()
+        res = self.post_report(testapp, user, multiqc_report())
+        testapp.get(res.json['status_url'], headers={'access_token': str(other.api_token)}, status=404)
+
+
+@pytest.mark.usefixtures('db')
+class TestUploadData:
+    """Reports posted to /api/upload_data are spooled to gzip files."""
+
+    def test_plain_and_gzipped_uploads(self, app, testapp, user, tmpdir):
+        """Both are stored gzipped, with the hash of the uncompressed report."""
+        app.config['UPLOAD_FOLDER'] = str(tmpdir)
+        body = json.dumps({'data': multiqc_report()}).encode('utf-8')
+        headers = {'access_token': str(user.api_token)}
+        testapp.post('/api/upload_data', body, headers=headers, content_type='application/json')
+        gzipped = io.BytesIO()
+        with gzip.GzipFile(fileobj=gzipped, mode='wb') as fh:
+            fh.write(body)
+        testapp.post('/api/upload_data', gzipped.getvalue(), headers=headers, content_type='application/json')
+        uploads = Upload.query.order_by(Upload.upload_id).all()
+        assert [u.file_hash for u in uploads] == [hashlib.sha1(body).hexdigest()] * 2
+        for upload in uploads:
+            with gzip.open(upload.path) as fh:
+                assert fh.read() == body
+
+        # The second, identical, upload is skipped without being parsed
+        upload_ids = [u.upload_id for u in uploads]
+        assert drain_upload_queue('worker-1') == 2
+        assert Report.query.count() == 1
+        assert Report.query.one().file_hash == hashlib.sha1(body).hexdigest()
+        statuses = [Upload.query.get(upload_id) for upload_id in upload_ids]
+        assert [u.status for u in statuses] == ['TREATED', 'FAILED']
+        assert 'already uploaded' in statuses[1].message
+
+
+@pytest.mark.usefixtures('db')
+class TestReportExists:
+    """Clients can check whether a report was already uploaded."""
+
+    def test_report_exists(self, testapp, user):
+        report = multiqc_report()
+        handle_report_data(user, report)
+        headers = {'access_token': str(user.api_token)}
+        url = '/api/report_exists/{}'.format(generate_hash(report))
+        assert testapp.get(url, headers=headers).json['exists']
+        testapp.head(url, headers=headers, status=200)
+        testapp.head('/api/report_exists/{}'.format(generate_hash(multiqc_report(title='Other'))), headers=headers, status=404)
+
+
+@pytest.mark.usefixtures('db')
+class TestPlotFormat:
+    """Plot endpoints return figure specs with format=json."""
+
+    def get_plot(self, testapp, user, **params):
+        params['plot_type'] = 'fastqc_sequence_counts_plot'
+        return testapp.post('/api/get_report_plot', json.dumps(params),
+                            headers={'access_token': str(user.api_token)},
+                            content_type='application/json').json
+
+    def test_json_figure(self, testapp, user):
+        handle_report_data(user, multiqc_report())
+        res = self.get_plot(testapp, user, format='json')
+        assert 'plot' not in res
+        figure = res['figure']
+        assert [trace['name'] for trace in figure['data']] == ['Unique Reads', 'Duplicate Reads'] * 2
+        assert figure['data'][0]['type'] == 'bar'
+        assert figure['config']['displaylogo'] is False
+
+    def test_html_div(self, testapp, user):
+        """The default output still embeds plotly.js, for existing API clients."""
+        handle_report_data(user, multiqc_report())
+        res = self.get_plot(testapp, user)
+        assert 'figure' not in res
+        assert 'plotly-graph-div' in res['plot']
+        assert len(res['plot']) > 1000000
+
+    def test_histogram_bins_from_slider(self, app, testapp, user):
+        """The bins slider sends a string, summarised histograms need a number."""
+        handle_report_data(user, multiqc_report())
+        app.config['PLOT_DISTRIBUTION_SUMMARY_THRESHOLD'] = 1
+        field_id = SampleDataType.query.filter_by(data_id='percent_gc').one().sample_data_type_id
+        params = dict(fields=[field_id], ptype='hist', nbins='30', format='json')
+        res = testapp.post('/api/get_distribution_plot', json.dumps(params),
+                           headers={'access_token': str(user.api_token)},
+                           content_type='application/json')
+        trace = res.json['figure']['data'][0]
+        assert len(trace['x']) == 30
+        params['nbins'] = 'many'
+        res = testapp.post('/api/get_distribution_plot', json.dumps(params),
+                           headers={'access_token': str(user.api_token)},
+                           content_type='application/json', expect_errors=True)
+        assert res.status_code == 400
+
+    def test_shared_plotly_js(self, testapp):
+        res = testapp.get('/plotly.min.js')
+        assert res.content_type == 'application/javascript'
+        assert res.cache_control.max_age == 31536000
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Plot data builder tests."""
+import datetime
+import json
+
+import numpy as np
+import pytest
+
+from megaqc.api.figures import align_series, box_stats, box_values, downsample_points, encode_figure, envelope_stats, \
+    extreme_series, kde_grid, pivot_bar_data
+from megaqc.api.utils import generate_comparison_plot, generate_distribution_plot, generate_report_plot, \
+    generate_trend_plot, handle_report_data
+
+from .factories import multiqc_report
+
+
+class TestPivotBarData:
+    """Pivoting bar graph rows."""
+
+    def test_pivot(self):
+        samples, categories, counts, percentages = pivot_bar_data(
+            ['s2', 's2', 's1', 's3'],
+            [7, 3, 7, 3],
+            [30, 10, 5, 0]
+        )
+        assert samples == ['s2', 's1', 's3']
+        assert categories == [7, 3]
+        assert counts.tolist() == [[30, 10], [5, 0], [0, 0]]
+        assert percentages.tolist() == [[75, 25], [100, 0], [0, 0]]
+
+    def test_many_samples(self):
+        names = ['sample_{}'.format(i) for i in range(20000)]
+        samples, categories, counts, percentages = pivot_bar_data(names * 2, [1] * 20000 + [2] * 20000, np.ones(40000))
+        assert samples == names
+        assert counts.shape == (20000, 2)
+        assert np.all(percentages == 50)
+
+
+class TestDownsample:
+    """Thinning out large scatter plots."""
+
+    def test_small_plots_are_kept(self):
+        assert downsample_points([np.arange(10.0), np.arange(10.0)], 100).tolist() == list(range(10))
+
+    def test_outliers_are_kept(self):
+        rs = np.random.RandomState(1)
+        x, y = rs.normal(size=200000), rs.normal(size=200000)
+        x[:5] = 100
+        y[5] = np.nan
+        keep = downsample_points([x, y], 10000)
+        assert 9000 < len(keep) < 11000
+        assert set(range(5)) <= set(keep.tolist())
+        assert 5 not in keep
+        # The dense centre keeps roughly its share of the points
+        with np.errstate(invalid='ignore'):
+            centre = (np.abs(x) < 1) & (np.abs(y) < 1)
+        assert abs(np.mean(centre[keep]) - np.mean(centre)) < 0.1
+
+
+class TestSummaries:
+    """Distribution summaries computed on the server."""
+
+    def test_box_values(self):
+        """plotly.js draws the same box from the summary values as from the data."""
+        values = np.random.RandomState(3).lognormal(size=10001)
+        stats = box_stats(values)
+        assert len(stats['outliers']) > 0
+        assert np.all((stats['outliers'] > stats['upperfence']) | (stats['outliers'] < stats['lowerfence']))
+        summary = box_stats(np.array(box_values(stats)))
+        for key in ('q1', 'median', 'q3', 'lowerfence', 'upperfence'):
+            assert summary[key] == pytest.approx(stats[key])
+        assert len(summary['outliers']) == 0
+
+    def test_kde(self):
+        grid, density = kde_grid(np.random.RandomState(4).normal(size=100000))
+        assert len(grid) == 100
+        assert np.sum(density) * (grid[1] - grid[0]) == pytest.approx(1, abs=0.01)
+        assert abs(grid[np.argmax(density)]) < 0.2
+
+
+class TestEnvelopes:
+    """Percentile envelopes of many line series."""
+
+    def test_align_numeric_x(self):
+        x, matrix = align_series([(np.array([1.0, 2.0]), [10, 20]), (np.array([2.0, 3.0]), [21, 31])])
+        assert x.tolist() == [1, 2, 3]
+        assert np.isnan(matrix[0, 2]) and np.isnan(matrix[1, 0])
+        assert matrix[:, 1].tolist() == [20, 21]
+
+    def test_align_labels_and_grid(self):
+        x, matrix = align_series([([' a', ' b'], [1, 2]), ([' c', ' a'], [3, 4])])
+        assert x == [' a', ' b', ' c']
+        assert matrix[1].tolist()[0] == 4
+        x, matrix = align_series([(np.arange(100.0), np.arange(100.0))], max_columns=10)
+        assert len(x) == 10
+        assert matrix[0, -1] == 99
+
+    def test_stats_and_extremes(self):
+        matrix = np.tile(np.arange(10.0), (100, 1)) + np.random.RandomState(0).normal(size=(100, 10))
+        matrix[42] += 20
+        matrix[7, :5] = np.nan
+        stats = envelope_stats(matrix)
+        assert stats.shape == (5, 10)
+        assert np.all(np.diff(stats, axis=0) >= 0)
+        assert abs(stats[2, 3] - 3) < 0.5
+        assert extreme_series(matrix, 3)[0] == 42
+
+
+class TestEncodeFigure:
+    """Encoding figures as JSON."""
+
+    def test_numpy_and_nan(self):
+        encoded = encode_figure({'x': np.array([1.5, np.nan], dtype=np.float32), 'n': np.int64(3), 'y': [float('nan')]})
+        assert json.loads(encoded) == {'x': [1.5, None], 'n': 3, 'y': [None]}
+
+    def test_dates(self):
+        assert encode_figure([datetime.date(2018, 6, 1)]) == '["2018-06-01"]'
+
+
+@pytest.mark.usefixtures('db')
+class TestPlainFigures:
+    """Plain dict figures are the same as the ones built with plotly.graph_objs."""
+
+    def figures(self, app, build):
+        figures = []
+        for fast in (True, False):
+            app.config['PLOT_FAST_FIGURES'] = fast
+            figures.append(json.loads(encode_figure(build())))
+        return figures
+
+    def test_same_figures(self, app, user):
+        handle_report_data(user, multiqc_report())
+        samples = ['sample_0', 'sample_1', 'sample_2']
+        sample_data = {s: {'GC': 40 + i, 'Reads': 1000.0 * (i + 1)} for i, s in enumerate(samples)}
+        field_names = {'x': 'GC', 'y': 'Reads', 'z': None, 'col': None, 'size': None}
+        trend_data = {'GC': [{'time': '2018-06-01 12:00:00', 'value': 40 + i, 'name': s} for i, s in enumerate(samples)]}
+        builders = [
+            lambda: generate_report_plot('fastqc_sequence_counts_plot', samples, 'json'),
+            lambda: generate_report_plot('fastqc_per_base_sequence_quality_plot -- Phred Score', samples, 'json'),
+            lambda: generate_distribution_plot(sample_data, ptype='boxplot', fmt='json'),
+            lambda: generate_distribution_plot(sample_data, ptype='hist', fmt='json'),
+            lambda: generate_trend_plot(trend_data, 'json'),
+            lambda: generate_comparison_plot(sample_data, {'x': 'GC', 'y': 'Reads'}, field_names, fmt='json'),
+        ]
+        for build in builders:
+            fast, validated = self.figures(app, build)
+            assert fast['data']
+            assert fast == validated
+
+    def test_large_comparison(self, app):
+        app.config['PLOT_WEBGL_THRESHOLD'] = 100
+        app.config['PLOT_COMPARISON_MAX_POINTS'] = 500
+        rs = np.random.RandomState(2)
+        sample_data = {'s{}'.format(i): {'GC': v, 'Reads': 1} for i, v in enumerate(rs.normal(size=2000))}
+        field_names = {'x': 'GC', 'y': 'Reads', 'z': None, 'col': None, 'size': None}
+        figure = generate_comparison_plot(sample_data, {'x': 'GC', 'y': 'Reads'}, field_names, fmt='json')
+        trace = figure['data'][0]
+        assert trace['type'] == 'scattergl'
+        assert len(trace['x']) < 600
+        assert np.all(np.diff(trace['x']) >= 0)
+        assert 'of 2000 samples' in figure['layout']['title']
+
+    def test_summarised_distributions(self, app):
+        app.config['PLOT_DISTRIBUTION_SUMMARY_THRESHOLD'] = 1000
+        app.config['PLOT_DISTRIBUTION_MAX_POINTS'] = 100
+        values = np.random.RandomState(5).normal(size=5000)
+        sample_data = {'s{}'.format(i): {'GC': v} for i, v in enumerate(values)}
+        box = generate_distribution_plot(sample_data, ptype='boxplot', fmt='json')['data']
+        assert len(box[0]['y']) == 8
+        assert len(box[1]['y']) <= 100
+        hist = generate_distribution_plot(sample_data, nbins=30, ptype='hist', fmt='json')['data'][0]
+        assert len(hist['x']) == 30
+        assert sum(hist['y']) == 5000
+        dots = generate_distribution_plot(sample_data, ptype='dotplot', fmt='json')['data'][0]
+        assert len(dots['y']) == 100
+        assert dots['name'] == 'GC (5000)'
+        violin = generate_distribution_plot(sample_data, ptype='violin', fmt='json')['data']
+        assert [trace['type'] for trace in violin] == ['scatter'] * 4
+        assert len(encode_figure(violin)) < 10000
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""Sample filter tests."""
+import pytest
+
+from megaqc.api.ingest import numeric_value
+from megaqc.api.utils import get_sample_fields_values, get_samples, handle_report_data
+from megaqc.model.models import SampleData, SampleDataType
+
+from .factories import multiqc_report
+
+
+def test_numeric_value():
+    """Only finite numbers get a numeric value."""
+    assert numeric_value(42) == 42.0
+    assert numeric_value('3.5') == 3.5
+    assert numeric_value('pass') is None
+    assert numeric_value(float('nan')) is None
+    assert numeric_value(True) is None
+
+
+@pytest.mark.usefixtures('db')
+class TestNumericFilters:
+    """Numeric filters use SampleData.value_num."""
+
+    def test_value_num_is_saved(self, user):
+        handle_report_data(user, multiqc_report())
+        values = SampleData.query.join(SampleDataType).filter(SampleDataType.data_id == 'percent_gc')
+        assert sorted(row.value_num for row in values) == [40.0, 41.0, 42.0]
+
+    def test_numeric_filter(self, user):
+        handle_report_data(user, multiqc_report())
+        gc_filter = {'type': 'samplemeta', 'cmp': '>=', 'value': '41', 'key': 'fastqc__percent_gc', 'section': 'fastqc'}
+        assert sorted(get_samples([[gc_filter]])) == ['sample_1', 'sample_2']
+        gc_filter['cmp'] = 'lt'
+        assert get_samples([[gc_filter]]) == ['sample_0']
+
+    def test_field_values_are_numbers(self, user):
+        handle_report_data(user, multiqc_report())
+        type_id = SampleDataType.query.filter_by(data_id='percent_gc').one().sample_data_type_id
+        values = get_sample_fields_values([type_id], num_fieldids=True)
+        assert values['sample_2'][type_id] == 42.0
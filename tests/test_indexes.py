@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""Database index tests."""
+import pytest
+
+from megaqc.commands import db_indexes
+from megaqc.model.models import Sample
+
+
+@pytest.mark.usefixtures('db')
+class TestDbIndexes:
+    """The db-indexes command."""
+
+    def test_missing_index_is_reported_and_created(self, app, db):
+        index = [ix for ix in Sample.__table__.indexes if ix.name == 'ix_sample_sample_name'][0]
+        index.drop(bind=db.engine)
+        runner = app.test_cli_runner()
+        result = runner.invoke(db_indexes, ['--check'])
+        assert result.exit_code == 1
+        assert 'Missing index ix_sample_sample_name on sample (sample_name)' in result.output
+        result = runner.invoke(db_indexes)
+        assert 'Creating index ix_sample_sample_name' in result.output
+        result = runner.invoke(db_indexes, ['--check'])
+        assert result.exit_code == 0
+        assert 'No missing indexes' in result.output
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""Report ingestion tests."""
+import gzip
+import hashlib
+import io
+import json
+
+import pytest
+
+from megaqc.api.ingest import ReportIngester, ReportStream, ingest_report_file
+from megaqc.api.utils import generate_hash, handle_report_data
+from megaqc.model.models import PlotCategory, PlotConfig, PlotData, Report, ReportMeta, Sample, SampleData, SampleDataType
+
+from .factories import multiqc_report
+
+
+@pytest.mark.usefixtures('db')
+class TestHandleReportData:
+    """Bulk report ingestion."""
+
+    def test_writes_all_rows(self, user):
+        """A report is saved with its metadata, samples and plot data."""
+        success, msg = handle_report_data(user, multiqc_report(n_samples=3))
+        assert success is True
+        assert Report.query.count() == 1
+        # username + 3 config_ keys
+        assert ReportMeta.query.count() == 4
+        assert Sample.query.count() == 3
+        assert SampleDataType.query.count() == 2
+        assert SampleData.query.count() == 6
+        assert PlotConfig.query.count() == 2
+        assert PlotCategory.query.count() == 3
+        # 3 samples x 2 bar categories + 3 line curves
+        assert PlotData.query.count() == 9
+
+    def test_reuses_existing_samples_and_types(self, user):
+        """A second report with the same samples adds no new dimension rows."""
+        handle_report_data(user, multiqc_report(title='First'))
+        success, msg = handle_report_data(user, multiqc_report(title='Second'))
+        assert success is True
+        assert Report.query.count() == 2
+        assert Sample.query.count() == 3
+        assert SampleDataType.query.count() == 2
+        assert PlotConfig.query.count() == 2
+        assert SampleData.query.count() == 12
+
+    def test_updates_plot_category_settings(self, user):
+        """Existing plot categories take the display settings of the latest report."""
+        handle_report_data(user, multiqc_report(title='First'))
+        report = multiqc_report(title='Second')
+        report['report_plot_data']['fastqc_sequence_counts_plot']['datasets'][0][0]['color'] = '#ff0000'
+        handle_report_data(user, report)
+        category = PlotCategory.query.filter_by(category_name='Unique Reads').one()
+        assert '#ff0000' in category.data
+        assert PlotCategory.query.count() == 3
+
+    def test_duplicate_report_is_rejected(self, user):
+        """The same report cannot be uploaded twice."""
+        handle_report_data(user, multiqc_report())
+        success, msg = handle_report_data(user, multiqc_report(creation_date='2018-07-01, 12:00'))
+        assert success is False
+        assert msg == 'Report already uploaded'
+        assert Report.query.count() == 1
+
+    def test_failed_report_leaves_nothing_behind(self, user):
+        """A report that fails partway is rolled back completely."""
+        report = multiqc_report()
+        del report['report_plot_data']['fastqc_sequence_counts_plot']['datasets']
+        with pytest.raises(KeyError):
+            handle_report_data(user, report)
+        assert Report.query.count() == 0
+        assert ReportMeta.query.count() == 0
+        assert Sample.query.count() == 0
+        assert SampleData.query.count() == 0
+
+
+@pytest.mark.usefixtures('db')
+class TestIngestReportFile:
+    """Streaming ingestion of queued upload files."""
+
+    def write_report(self, tmpdir, data, gzipped=False):
+        path = str(tmpdir.join('upload.json.gz' if gzipped else 'upload.json'))
+        with (gzip.open(path, 'wb') if gzipped else open(path, 'wb')) as fh:
+            fh.write(json.dumps(data).encode('utf-8'))
+        return path
+
+    def test_generate_hash_is_unchanged(self):
+        """The hash is still the MD5 of json.dumps() without the creation date."""
+        report = multiqc_report()
+        expected = dict(report)
+        del expected['config_creation_date']
+        assert generate_hash(report) == hashlib.md5(json.dumps(expected).encode('utf-8')).hexdigest()
+        assert 'config_creation_date' in report
+
+    def test_generate_hash_of_known_report(self):
+        """Reports uploaded before the hash was optimised keep the same hash."""
+        report = {
+            'config_title': 'Fixed report',
+            'config_creation_date': '2018-06-01, 12:00',
+            'report_saved_raw_data': {'multiqc_fastqc': {'sample_0': {'percent_gc': 40, 'total_sequences': 1000.0}}}
+        }
+        assert generate_hash(report) == '1fad75539390ebf4e065de53a3922a64'
+
+    def test_stream_hash_matches_generate_hash(self):
+        """Streamed and fully loaded reports get the same hash."""
+        report = multiqc_report()
+        stream = ReportStream(io.BytesIO(json.dumps({'data': report}).encode('utf-8')))
+        sections = [(section, key) for section, key, value in stream]
+        assert stream.report_hash == generate_hash(report)
+        assert stream.creation_date == report['config_creation_date']
+        assert ('report_plot_data', 'fastqc_sequence_counts_plot') in sections
+        assert ('report_saved_raw_data', 'multiqc_fastqc') in sections
+
+    def test_numbers_parsed_like_json_loads(self, user, tmpdir):
+        """Integral floats and exponents stay floats, so the hash and saved values match json.loads()."""
+        report = multiqc_report()
+        text = json.dumps(report).replace('"total_sequences": 2000.0', '"total_sequences": 2e3')
+        assert '"total_sequences": 1000.0' in text and '"total_sequences": 2e3' in text
+        stream = ReportStream(io.BytesIO(text.encode('utf-8')))
+        raw_data = dict((key, value) for section, key, value in stream if section == 'report_saved_raw_data')
+        assert stream.report_hash == generate_hash(json.loads(text))
+        assert [type(d['total_sequences']) for d in raw_data['multiqc_fastqc'].values()] == [float] * 3
+        path = str(tmpdir.join('upload.json'))
+        with open(path, 'w') as fh:
+            fh.write(text)
+        assert ingest_report_file(user, path) == (True, 'Data upload successful')
+        values = set(v for v, in SampleData.query.with_entities(SampleData.value))
+        assert set(['1000.0', '2000.0', '3000.0']) <= values
+
+    def test_data_wrapper_in_any_position(self, user, tmpdir):
+        """{"data": {...}} is unwrapped wherever the key is, as by handle_report_data."""
+        report = multiqc_report()
+        wrapped = '{{"config_title": "Outer", "extra": [1, 2], "data": {}}}'.format(json.dumps(report))
+        stream = ReportStream(io.BytesIO(wrapped.encode('utf-8')))
+        sections = [(section, key, value) for section, key, value in stream]
+        assert stream.report_hash == generate_hash(report)
+        assert ('config', 'config_title', 'Outer') not in sections
+        assert ('config', 'config_title', report['config_title']) in sections
+        path = str(tmpdir.join('upload.json'))
+        with open(path, 'w') as fh:
+            fh.write(wrapped)
+        assert ingest_report_file(user, path) == (True, 'Data upload successful')
+        assert handle_report_data(user, json.loads(wrapped)) == (False, 'Report already uploaded')
+
+    def test_ingests_gzipped_file(self, user, tmpdir):
+        """A gzipped upload is saved like the same report sent as a dict."""
+        report = multiqc_report()
+        success, msg = ingest_report_file(user, self.write_report(tmpdir, report, gzipped=True))
+        assert success is True
+        saved = Report.query.one()
+        assert saved.report_hash == generate_hash(report)
+        assert saved.created_at.year == 2018
+        assert SampleData.query.count() == 6
+        assert PlotData.query.count() == 9
+
+    def test_duplicate_file_is_rejected(self, user, tmpdir, monkeypatch):
+        """A streamed report that is already in the database is turned down before writing anything."""
+        report = multiqc_report()
+        handle_report_data(user, report)
+        def fail(*args, **kwargs):
+            raise AssertionError('Nothing should be written for a duplicate')
+        monkeypatch.setattr(ReportIngester, 'begin', fail)
+        success, msg = ingest_report_file(user, self.write_report(tmpdir, report))
+        assert success is False
+        assert msg == 'Report already uploaded'
+        assert Report.query.count() == 1
+        assert SampleData.query.count() == 6
+
+
+@pytest.mark.usefixtures('db')
+class TestIngestCommand:
+    """Bulk loading report files with `megaqc ingest`."""
+
+    def test_ingest_and_resume(self, app, user, tmpdir):
+        """Reports are loaded once, and a second run skips them."""
+        from megaqc.commands import ingest
+        user.update(is_admin=True)
+        for i in range(3):
+            run_dir = tmpdir.mkdir('run{}'.format(i))
+            with gzip.open(str(run_dir.join('multiqc_data.json.gz')), 'wb') as fh:
+                fh.write(json.dumps(multiqc_report(title='Run {}'.format(i))).encode('utf-8'))
+        tmpdir.join('run0', 'other.json').write('{}')
+        state_file = str(tmpdir.join('state'))
+        runner = app.test_cli_runner()
+        result = runner.invoke(ingest, [str(tmpdir), '--processes', '2', '--state-file', state_file])
+        assert result.exit_code == 0, result.output
+        assert 'Loaded 3 reports (0 already in the database, 0 failed)' in result.output
+        assert Report.query.count() == 3
+        # Hashed like queued uploads and reports posted to the API
+        expected = set(generate_hash(multiqc_report(title='Run {}'.format(i))) for i in range(3))
+        assert set(report.report_hash for report in Report.query) == expected
+        assert len(open(state_file).readlines()) == 3
+        result = runner.invoke(ingest, [str(tmpdir), '--processes', '1', '--state-file', state_file])
+        assert 'Found 3 reports, 3 already loaded' in result.output
+        assert 'Loaded 0 reports' in result.output
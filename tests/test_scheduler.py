@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Upload queue tests."""
+import datetime as dt
+import json
+import os
+
+import pytest
+
+from megaqc.api.notify import UploadWaiter, notify_upload, upload_queued
+from megaqc.model.models import Report, Upload
+from megaqc.extensions import db as _db
+from megaqc.scheduler import claim_upload, drain_upload_queue, upload_poll_interval, worker_name, worker_process
+
+from .factories import multiqc_report
+
+
+def queue_upload(user, path, **kwargs):
+    upload = Upload(status='NOT TREATED', path=path, message='queued', user_id=user.user_id, **kwargs)
+    upload.save()
+    return upload
+
+
+@pytest.mark.usefixtures('db')
+class TestUploadQueue:
+    """Claiming and processing queued uploads."""
+
+    def test_upload_is_claimed_once(self, user):
+        """Only the first worker gets a queued upload."""
+        upload = queue_upload(user, '/nonexistent')
+        first = claim_upload('worker-1')
+        assert first.upload_id == upload.upload_id
+        assert first.status == 'IN TREATMENT'
+        assert first.worker == 'worker-1'
+        assert claim_upload('worker-2') is None
+
+    def test_stale_claim_is_reclaimed(self, user):
+        """An upload whose worker stopped sending heartbeats can be claimed again."""
+        stale = dt.datetime.utcnow() - dt.timedelta(hours=1)
+        queue_upload(user, '/nonexistent', worker='dead-worker').update(status='IN TREATMENT', heartbeat_at=stale)
+        alive = queue_upload(user, '/nonexistent', worker='busy-worker')
+        alive.update(status='IN TREATMENT', heartbeat_at=dt.datetime.utcnow())
+        claimed = claim_upload('worker-1')
+        assert claimed.worker == 'worker-1'
+        assert claimed.upload_id != alive.upload_id
+        assert claim_upload('worker-2') is None
+
+    def test_slow_ingest_is_not_reclaimed(self, user):
+        """On SQLite, a running worker keeps its upload even without recent heartbeats."""
+        stale = dt.datetime.utcnow() - dt.timedelta(hours=1)
+        busy = queue_upload(user, '/nonexistent', worker=worker_name())
+        busy.update(status='IN TREATMENT', heartbeat_at=stale)
+        assert claim_upload('worker-2') is None
+        assert Upload.query.get(busy.upload_id).worker == worker_name()
+
+    def test_drain_processes_queue(self, user, tmpdir):
+        """Queued files are saved to the database and removed."""
+        path = str(tmpdir.join('upload.json'))
+        with open(path, 'w') as fh:
+            json.dump(multiqc_report(), fh)
+        upload_id = queue_upload(user, path).upload_id
+        assert drain_upload_queue('worker-1') == 1
+        upload = Upload.query.get(upload_id)
+        assert upload.status == 'TREATED'
+        assert Report.query.count() == 1
+        assert not os.path.exists(path)
+
+    def test_upload_session_is_released(self, user, tmpdir):
+        """Objects loaded while processing an upload do not stay in the session."""
+        path = str(tmpdir.join('upload.json'))
+        with open(path, 'w') as fh:
+            json.dump(multiqc_report(), fh)
+        queue_upload(user, path)
+        assert drain_upload_queue('worker-1') == 1
+        assert len(_db.session.identity_map) == 0
+
+    def test_drain_stops_above_memory_limit(self, user, monkeypatch):
+        """A worker over its memory limit does not take new uploads."""
+        monkeypatch.setattr('megaqc.scheduler.current_rss_mb', lambda: 4096)
+        upload = queue_upload(user, '/nonexistent')
+        assert drain_upload_queue('worker-1', max_rss_mb=1024) == 0
+        assert Upload.query.get(upload.upload_id).status == 'NOT TREATED'
+
+    def test_queued_upload_wakes_worker(self, db):
+        """Workers wake up as soon as an upload is queued."""
+        upload_queued.clear()
+        waiter = UploadWaiter(db.engine)
+        assert waiter.wait(0.01) is False
+        notify_upload(1)
+        assert waiter.wait(5) is True
+        assert waiter.wait(0.01) is False
+
+    def test_poll_interval(self, app):
+        """Without NOTIFY, workers of other processes poll often by default."""
+        assert upload_poll_interval() == 30
+        app.config['UPLOAD_POLL_INTERVAL'] = 120
+        assert upload_poll_interval() == 120
+
+    def test_worker_process_builds_its_own_app(self, app, monkeypatch):
+        """Worker processes only get the config name, so they can be spawned."""
+        started = []
+        monkeypatch.setattr('megaqc.scheduler.run_worker', lambda worker_app, *args: started.append((worker_app, args)))
+        assert app.config['CONFIG_NAME'] == 'tests.conftest.SchedulerlessConfig'
+        worker_process(app.config['CONFIG_NAME'], 10, 512)
+        (worker_app, args), = started
+        assert worker_app is not app
+        assert worker_app.config['SCHEDULER_ENABLED'] is False
+        assert args == (10, 512)
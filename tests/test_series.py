@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Packed plot series tests."""
+import numpy as np
+import pytest
+
+from megaqc.api.series import lttb, pack_series, series_levels, series_to_list, unpack_series, window_indices
+from megaqc.api.utils import choose_plot_level, delete_report_data, generate_report_plot, handle_report_data
+from megaqc.model.models import PlotData, PlotDataLevel, Report
+
+from .factories import multiqc_report
+
+
+class TestPackedSeries:
+    """Packing and unpacking xy_line data."""
+
+    def test_round_trip(self):
+        data = [[1, 30.0], [2, None], [3, 32.25]]
+        x, y = unpack_series(pack_series(data))
+        assert x.dtype == np.float32
+        assert series_to_list(x, y) == [[1.0, 30.0], [2.0, None], [3.0, 32.25]]
+
+    def test_precision_is_kept(self):
+        """Values that do not fit in float32 are stored as float64."""
+        data = [[3000000001, 0.1], [3000000002, 0.2]]
+        x, y = unpack_series(pack_series(data))
+        assert x.dtype == np.float64
+        assert series_to_list(x, y) == data
+
+    def test_y_only_and_compressed(self):
+        data = [0.0] * 1000
+        packed = pack_series(data)
+        assert len(packed) < 1000
+        x, y = unpack_series(packed)
+        assert x is None
+        assert series_to_list(x, y) == data
+
+    def test_text_values_are_not_packed(self):
+        assert pack_series([['a', 1], ['b', 2]]) is None
+
+
+class TestLttb:
+    """Downsampling series to a fixed number of points."""
+
+    def test_short_series_are_kept(self):
+        assert lttb([1, 2, 3], 10).tolist() == [0, 1, 2]
+
+    def test_shape_is_kept(self):
+        y = np.sin(np.linspace(0, 10, 100001))
+        y[40000] = 5
+        y[70000] = -5
+        keep = lttb(y, 500)
+        assert len(keep) == 500
+        assert keep[0] == 0 and keep[-1] == 100000
+        assert np.all(np.diff(keep) > 0)
+        # Spikes and the sine peaks survive
+        assert 40000 in keep and 70000 in keep
+        assert y[keep].max() == 5 and y[keep].min() == -5
+        assert np.abs(np.sort(y[keep])[-2] - 1) < 0.01
+
+    def test_uneven_x_and_gaps(self):
+        x = np.cumsum(np.arange(1, 1001, dtype=float))
+        y = np.arange(1000, dtype=float)
+        y[100:900] = np.nan
+        keep = lttb(y, 50, x=x)
+        assert len(keep) == 50
+        # Buckets with values never pick a gap, all-missing buckets keep one
+        assert np.isnan(y[keep]).sum() < 50
+        assert np.isfinite(y[keep][:5]).all()
+
+
+class TestLevels:
+    """Coarser copies of long series."""
+
+    def test_levels(self):
+        y = np.arange(1000.0)
+        levels = list(series_levels(None, y, (4, 16, 64), 50))
+        assert [(level, len(ly)) for level, lx, ly in levels] == [(4, 250), (16, 62)]
+        level, x, y = levels[0]
+        assert x[0] == 0 and x[-1] == 999
+        assert np.all(x == y)
+
+    def test_window(self):
+        x = np.arange(10.0)
+        assert window_indices(x, [2.5, 5]).tolist() == [2, 3, 4, 5, 6]
+        assert window_indices(x, [4.2, 4.8]).tolist() == [4, 5]
+        assert window_indices(x, [20, 30]).tolist() == [9]
+
+
+@pytest.mark.usefixtures('db')
+class TestPackedPlotData:
+    """xy_line series are stored packed and plotted from the packed data."""
+
+    def test_line_plot(self, user):
+        handle_report_data(user, multiqc_report())
+        rows = PlotData.query.filter(PlotData.data_packed != None).all()
+        assert len(rows) == 3
+        assert all(row.data is None for row in rows)
+        plot = generate_report_plot('fastqc_per_base_sequence_quality_plot -- Phred Score', ['sample_0', 'sample_1'])
+        assert 'sample_1' in plot
+        assert '31.5' in plot
+
+    def test_envelope_plot(self, app, user):
+        handle_report_data(user, multiqc_report(n_samples=20))
+        app.config['PLOT_SERIES_ENVELOPE_SAMPLES'] = 10
+        app.config['PLOT_SERIES_ENVELOPE_EXTREMES'] = 2
+        names = ['sample_{}'.format(i) for i in range(20)]
+        plot = generate_report_plot('fastqc_per_base_sequence_quality_plot -- Phred Score', names, fmt='json')
+        # 5-95% and 25-75% bands, the median, then the two most unusual samples
+        assert len(plot['data']) == 7
+        median = plot['data'][4]
+        assert median['x'].tolist() == [1, 2, 3]
+        assert median['y'][1] == 31.5
+        assert [trace['name'] for trace in plot['data'][5:]] == ['sample_0', 'sample_19']
+        assert 'Median of 20 samples' in plot['layout']['title']
+        # Every sample is still drawn on request
+        plot = generate_report_plot('fastqc_per_base_sequence_quality_plot -- Phred Score', names, fmt='json', summary='samples')
+        assert len(plot['data']) == 20
+
+    def test_long_series_are_downsampled(self, app, user):
+        report = multiqc_report(n_samples=1)
+        report['report_plot_data']['fastqc_per_base_sequence_quality_plot']['datasets'] = [[
+            {'name': 'sample_0', 'data': [[i, float(i % 100)] for i in range(20000)]}
+        ]]
+        handle_report_data(user, report)
+        app.config['PLOT_SERIES_MAX_POINTS'] = 300
+        plot = generate_report_plot('fastqc_per_base_sequence_quality_plot -- Phred Score', ['sample_0'], fmt='json')
+        trace = plot['data'][0]
+        assert len(trace['x']) == len(trace['y']) == 300
+        assert trace['x'][0] == 0 and trace['x'][-1] == 19999
+        assert max(trace['y']) == 99 and min(trace['y']) == 0
+
+    def test_levels_of_detail(self, app, user):
+        report = multiqc_report(n_samples=2)
+        report['report_plot_data']['fastqc_per_base_sequence_quality_plot']['datasets'] = [[
+            {'name': 'sample_{}'.format(s), 'data': [[i, float(i % 100)] for i in range(20000)]}
+            for s in range(2)
+        ]]
+        handle_report_data(user, report)
+        assert sorted(row.level for row in PlotDataLevel.query.all()) == [4, 4, 16, 16, 64, 64]
+        config_ids = [row.config_id for row in PlotDataLevel.query.all()]
+        samples = ['sample_0', 'sample_1']
+        assert choose_plot_level(config_ids, samples, 300) == 64
+        assert choose_plot_level(config_ids, samples, 1000) == 16
+        assert choose_plot_level(config_ids, samples, 1000, x_range=[0, 10000]) == 4
+        assert choose_plot_level(config_ids, samples, 1000, x_range=[0, 1000]) is None
+        plot_type = 'fastqc_per_base_sequence_quality_plot -- Phred Score'
+        # A narrow plot is drawn from the coarsest level, two points per pixel
+        trace = generate_report_plot(plot_type, samples, fmt='json', width=150)['data'][0]
+        assert len(trace['x']) == 300
+        # Zoomed in, the full series is cropped to the window
+        trace = generate_report_plot(plot_type, samples, fmt='json', x_range=[100, 199], width=500)['data'][0]
+        assert trace['x'].tolist() == list(range(99, 201))
+        delete_report_data(Report.query.one().report_id)
+        assert PlotDataLevel.query.count() == 0
+
+    def test_level_past_the_categories(self, app, user):
+        """Points without a category label are dropped along with their values."""
+        report = multiqc_report(n_samples=1)
+        report['report_plot_data']['coverage_plot'] = {
+            'plot_type': 'xy_line',
+            'config': {'title': 'Coverage', 'ylab': 'Depth', 'categories': list(range(1500))},
+            'datasets': [[{'name': 'sample_0', 'data': [float(i % 50) for i in range(2000)]}]]
+        }
+        handle_report_data(user, report)
+        assert PlotDataLevel.query.filter_by(level=4).count() == 1
+        trace = generate_report_plot('coverage_plot -- Depth', ['sample_0'], fmt='json', width=200)['data'][0]
+        assert len(trace['x']) == len(trace['y'])
+        assert 0 < len(trace['x']) <= 400
+        assert all(int(x) < 1500 for x in trace['x'])
+
+
+@pytest.mark.usefixtures('db')
+class TestBarPlotData:
+    """Bar graph values are stored as numbers."""
+
+    def test_bar_plot(self, user):
+        handle_report_data(user, multiqc_report())
+        rows = PlotData.query.filter(PlotData.value != None).all()
+        assert sorted(row.value for row in rows) == [5, 10, 10, 15, 20, 30]
+        assert all(row.data is None for row in rows)
+        plot = generate_report_plot('fastqc_sequence_counts_plot', ['sample_0', 'sample_2'])
+        assert 'Unique Reads' in plot
+        assert '"x": [10.0, 30.0]' in plot
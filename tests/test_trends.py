@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Trend plot tests."""
+import datetime
+import json
+
+import numpy as np
+import pytest
+
+from megaqc.api.utils import bucket_dates, generate_trend_plot, get_trend_plot_data, handle_report_data, parse_time
+from megaqc.model.models import SampleDataType
+
+from .factories import multiqc_report
+
+
+def test_bucket_dates():
+    times = [datetime.datetime(2018, 6, 3, 23, 0), datetime.datetime(2018, 6, 4, 1, 0), datetime.datetime(2018, 6, 30)]
+    assert [str(d) for d in bucket_dates(times, 'day')] == ['2018-06-03', '2018-06-04', '2018-06-30']
+    assert [str(d) for d in bucket_dates(times, 'week')] == ['2018-05-28', '2018-06-04', '2018-06-25']
+    assert [str(d) for d in bucket_dates(times, 'month')] == ['2018-06-01'] * 3
+
+
+def test_parse_time():
+    assert parse_time('2018-06-01 12:30:15.25') == datetime.datetime(2018, 6, 1, 12, 30, 15)
+    assert parse_time('2018-06-01') == datetime.datetime(2018, 6, 1)
+    assert parse_time('soon') is None
+
+
+@pytest.mark.usefixtures('db')
+class TestTrendBuckets:
+    """Long trends are aggregated per time bucket."""
+
+    @pytest.fixture
+    def field_id(self, user):
+        for idx, date in enumerate(['2018-01-01, 12:00', '2018-01-02, 12:00', '2018-03-01, 12:00']):
+            handle_report_data(user, multiqc_report(title='Report {}'.format(idx), creation_date=date, sample_prefix='run{}'.format(idx)))
+        return SampleDataType.query.filter_by(data_id='percent_gc').one().sample_data_type_id
+
+    def test_few_samples_are_not_aggregated(self, field_id):
+        data = get_trend_plot_data(None, [field_id])
+        series, = data.values()
+        assert len(series) == 9
+        assert series[0]['name'] == 'run0_0'
+
+    def test_daily_buckets(self, app, field_id):
+        app.config['PLOT_TREND_RAW_POINTS'] = 0
+        data = get_trend_plot_data(None, [field_id])
+        series, = data.values()
+        assert series['bucket'] == 'day'
+        assert series['time'] == ['2018-01-01', '2018-01-02', '2018-03-01']
+        assert series['count'] == [3, 3, 3]
+        assert series['median'] == [41.0, 41.0, 41.0]
+        assert series['p10'][0] == pytest.approx(40.2)
+        figure = generate_trend_plot(data, 'json')
+        assert len(figure['data']) == 5
+        assert 'per day' in figure['layout']['title']
+
+    def test_monthly_buckets_and_zoom(self, app, field_id):
+        app.config['PLOT_TREND_RAW_POINTS'] = 0
+        app.config['PLOT_TREND_MAX_BUCKETS'] = 5
+        series, = get_trend_plot_data(None, [field_id]).values()
+        assert series['bucket'] == 'month'
+        assert series['time'] == ['2018-01-01', '2018-03-01']
+        assert series['count'] == [6, 3]
+        # Zoomed into a short window, every sample is plotted again
+        series, = get_trend_plot_data(None, [field_id], start=datetime.datetime(2018, 1, 1), end=datetime.datetime(2018, 1, 3)).values()
+        assert len(series) == 6
+
+    def test_raw_points_are_downsampled(self, app, field_id):
+        app.config['PLOT_SERIES_MAX_POINTS'] = 4
+        figure = generate_trend_plot(get_trend_plot_data(None, [field_id]), 'json')
+        trace, = figure['data']
+        assert len(trace['x']) == len(trace['text']) == 4
+        assert trace['text'][0] == 'run0_0' and trace['text'][-1] == 'run2_2'
+        assert '(9)' in trace['name']
+
+    def test_timeline_endpoint_is_never_aggregated(self, app, testapp, user, field_id):
+        app.config['PLOT_TREND_RAW_POINTS'] = 0
+        res = testapp.post('/api/get_timeline_sample_data', json.dumps({'fields': [field_id]}),
+                           headers={'access_token': str(user.api_token)},
+                           content_type='application/json')
+        series, = res.json.values()
+        assert len(series) == 9
+
+    def test_non_numeric_values_in_legend(self, app, user):
+        """Raw and aggregated trends both say how many values were not numbers."""
+        report = multiqc_report(title='With text', creation_date='2018-04-01, 12:00', sample_prefix='text')
+        report['report_saved_raw_data']['multiqc_fastqc']['text_0']['percent_gc'] = 'NA'
+        handle_report_data(user, report)
+        field_id = SampleDataType.query.filter_by(data_id='percent_gc').one().sample_data_type_id
+        raw, = generate_trend_plot(get_trend_plot_data(None, [field_id]), 'json')['data']
+        assert raw['name'].endswith('(2, 1 not numeric)')
+        app.config['PLOT_TREND_RAW_POINTS'] = 0
+        data = get_trend_plot_data(None, [field_id])
+        median = generate_trend_plot(data, 'json')['data'][-1]
+        assert median['name'].endswith('(2, 1 not numeric)')